@@ -0,0 +1,159 @@
+"""
+End-to-end benchmarks of catozer against local stand-ins for every external service.
+
+    python -m bench                         # all scenarios
+    python -m bench ingest drain --photos 100
+    python -m bench --latency gemini=300 --latency-scale 0.1
+    python -m bench --json results.json
+    python -m bench --baseline results.json --tolerance 0.2   # exits with 1 on a regression
+
+Scenarios:
+
+    ingest      a burst of photos through the bot's photo handler
+    drain       post_pending publishing a backlog of due posts
+    dashboard   dashboard pages and the posts API with 10k+ posts
+    fanout      bot messages to all subscribed chats
+
+Telegram, Instagram, Moondream and Gemini are served by a local HTTP server
+(their base URLs are configurable in catozer.main), Facebook and Imgur are
+replaced through the client registry. Every call sleeps for the typical
+latency of its service (see DEFAULT_LATENCIES).
+
+PostgreSQL is a throwaway cluster created with initdb (not as root; set
+BENCH_PG_BIN if initdb is not on the PATH), or a fresh database on the
+server BENCH_DB_DSN points at. Everything runs in a temporary directory.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+from bench.fakes import FakeServices, install_stub_clients, parse_latencies
+from bench.postgres import DisposablePostgres
+from bench.report import compare, format_results, save_results
+from bench.scenarios import SCENARIOS
+
+Logger = logging.getLogger('bench')
+
+BENCH_CONFIG = {
+    'TELEGRAM_BOT_TOKEN': '123456:bench',
+    'MOONDREAM_TOKEN': 'bench',
+    'GEMINI_TOKEN': 'bench',
+    'FACEBOOK_TOKEN': 'bench',
+    'IG_TOKEN': 'bench',
+    'IMGUR_CLIENT_ID': 'bench',
+    'IMGUR_CLIENT_SECRET': 'bench',
+    'PAGE_ID': 'bench',
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m bench', description='Catozer end-to-end benchmarks')
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help=f'scenarios to run: {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--latency', action='append', default=[], metavar='SERVICE=MS',
+                        help='override the latency of a service')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiply all latencies')
+    parser.add_argument('--photos', type=int, default=40, help='photos in the ingest burst')
+    parser.add_argument('--posts', type=int, default=40, help='due posts in the drain backlog')
+    parser.add_argument('--dashboard-posts', type=int, default=10000, help='posts in the table for dashboard')
+    parser.add_argument('--requests', type=int, default=300, help='dashboard requests')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent dashboard clients')
+    parser.add_argument('--subscribers', type=int, default=100, help='subscribed chats for fanout')
+    parser.add_argument('--messages', type=int, default=3, help='messages broadcast in fanout')
+    parser.add_argument('--json', metavar='PATH', help='save the results')
+    parser.add_argument('--baseline', metavar='PATH', help='compare with results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression as a fraction')
+    parser.add_argument('--keep-db', action='store_true', help='keep the database and the working directory')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(unknown)}')
+    return args
+
+
+def prepare_environment(db, fakes):
+    from catozer.ratelimit import DEFAULT_LIMITS
+
+    os.environ.update(db.env())
+    os.environ.update(fakes.env())
+    os.environ.update(BENCH_CONFIG)
+    # The stand-ins do not rate limit, so neither does the app; except for Telegram's
+    # global send rate, which paces the fanout in production too
+    for name in DEFAULT_LIMITS:
+        if name == 'telegram':
+            continue
+        os.environ[f'RATE_LIMIT_{name.upper()}'] = '1000000/1'
+
+
+def scenario_args(args):
+    return {
+        'ingest': {'photos': args.photos},
+        'drain': {'posts': args.posts},
+        'dashboard': {'posts': args.dashboard_posts, 'requests': args.requests, 'concurrency': args.concurrency},
+        'fanout': {'subscribers': args.subscribers, 'messages': args.messages},
+    }
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s in %(name)s -- %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    selected = args.scenarios or list(SCENARIOS)
+
+    # catozer.main keeps its downloads and log in the working directory
+    repo = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='catozer-bench-')
+    os.chdir(workdir)
+    Logger.info(f'Working in {workdir}')
+    if repo not in sys.path:
+        sys.path.insert(0, repo)
+
+    fakes = FakeServices(parse_latencies(args.latency, args.latency_scale)).start()
+    results = []
+    try:
+        with DisposablePostgres(keep=args.keep_db) as db:
+            prepare_environment(db, fakes)
+
+            import catozer.main as app
+            app.ImageStore.prepare()
+            app.ensure_schema()
+            app.CONFIG.update(BENCH_CONFIG)
+            app.Limiter.load()
+            install_stub_clients(app.Clients, fakes)
+
+            # The app logs every photo and post; only the report matters here
+            logging.getLogger('catozer').setLevel(logging.WARNING)
+            for name in ('httpx', 'google_genai'):
+                logging.getLogger(name).setLevel(logging.WARNING)
+            try:
+                kwargs = scenario_args(args)
+                for name in selected:
+                    Logger.info(f'Running {name}...')
+                    results.extend(SCENARIOS[name](app, fakes, db, **kwargs[name]))
+            finally:
+                app.BotNotifier.stop()
+                app.DBPool.close()
+    finally:
+        fakes.stop()
+        os.chdir(repo)
+        if not args.keep_db:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(format_results(results))
+    print('Calls to the stand-ins: ' + ', '.join(f'{name}={count}' for name, count in sorted(fakes.calls.items())))
+
+    if args.json:
+        save_results(results, args.json)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
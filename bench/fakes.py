@@ -0,0 +1,327 @@
+import asyncio
+import io
+import itertools
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+Logger = logging.getLogger(__name__)
+
+# Typical response times in ms of the real services, used unless overridden with --latency
+DEFAULT_LATENCIES = {
+    'telegram': 40,
+    'telegram_file': 120,
+    'moondream': 900,
+    'gemini': 1200,
+    'facebook': 350,
+    'imgur': 600,
+    'instagram': 450,
+}
+
+
+class Latency:
+    """
+    Sleeps for about `ms` milliseconds, uniformly spread by +-`jitter`.
+    """
+
+    def __init__(self, ms, jitter=0.5):
+        self.ms = ms
+        self.jitter = jitter
+        self._random = random.Random(ms)
+
+    def sample(self):
+        return self.ms / 1000 * self._random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def sleep(self):
+        time.sleep(self.sample())
+
+    async def sleep_async(self):
+        await asyncio.sleep(self.sample())
+
+
+def parse_latencies(overrides=(), scale=1.0):
+    """
+    Latencies from DEFAULT_LATENCIES and overrides like 'gemini=300', multiplied by `scale`.
+    """
+    latencies = dict(DEFAULT_LATENCIES)
+    for override in overrides:
+        try:
+            service, ms = override.split('=')
+            if service not in latencies:
+                raise ValueError(f'unknown service {service}')
+            latencies[service] = float(ms)
+        except ValueError as e:
+            raise ValueError(f'Invalid latency {override!r}, expected service=ms') from e
+    return {service: Latency(ms * scale) for service, ms in latencies.items()}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real APIs; the clients pool their connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.fakes.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.fakes.handle(self, 'POST')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return {k: v[-1] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+        return {}
+
+    def send_json(self, payload, status=200):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeServices:
+    """
+    One local HTTP server standing in for the APIs whose clients take a base
+    URL: the Telegram Bot API, the Instagram Graph API, Moondream and Gemini.
+    Every request sleeps for the latency of its service before answering, and
+    is counted in `calls`.
+
+    Facebook and Imgur clients have their API URLs hard coded in the SDKs;
+    they are replaced with `FakeFacebook` and `FakeImgur` through the client
+    registry instead (see `install_stub_clients`).
+    """
+
+    def __init__(self, latencies):
+        self.latencies = latencies
+        self.calls = Counter()
+        self.sent_messages = []
+
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fakes = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}'
+
+    def env(self):
+        """
+        The variables pointing catozer.main at this server.
+        """
+        return {
+            'TELEGRAM_API_URL': f'{self.url}/bot',
+            'INSTAGRAM_GRAPH_URL': f'{self.url}/instagram',
+            'MOONDREAM_ENDPOINT': f'{self.url}/moondream/v1',
+            'GEMINI_BASE_URL': f'{self.url}/gemini',
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='bench-fakes', daemon=True)
+        self._thread.start()
+        Logger.info(f'Fake services listening on {self.url}')
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    def handle(self, request, method):
+        path = urllib.parse.urlsplit(request.path).path
+        service, _, rest = path.lstrip('/').partition('/')
+        if service.startswith('bot'):
+            service, rest = 'telegram', rest
+        handler = getattr(self, f'_{service}', None)
+        if handler is None:
+            request.send_json({'error': {'message': f'No fake for {path}'}}, status=404)
+            return
+
+        body = request.read_body() if method == 'POST' else {}
+        self.latencies[service].sleep()
+        with self._lock:
+            self.calls[f'{service} {rest}'] += 1
+        status, payload = handler(rest, body)
+        request.send_json(payload, status)
+
+    def _telegram(self, method, body):
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Catozer',
+                                                'username': 'catozer_bench_bot'}}
+        if method == 'sendMessage':
+            with self._lock:
+                self.sent_messages.append((time.monotonic(), body.get('chat_id')))
+            chat_id = int(body.get('chat_id', 0))
+            return 200, {'ok': True, 'result': {'message_id': self.next_id(), 'date': int(time.time()),
+                                                'chat': {'id': chat_id, 'type': 'private'},
+                                                'text': body.get('text', '')}}
+        return 200, {'ok': True, 'result': True}
+
+    def _instagram(self, endpoint, body):
+        if 'access_token' not in body:
+            return 400, {'error': {'message': 'Missing access_token', 'code': 190}}
+        return 200, {'id': str(self.next_id())}
+
+    def _moondream(self, endpoint, body):
+        return 200, {'caption': f'A fluffy ragdoll cat lounging on a sofa (#{self.next_id()})'}
+
+    def _gemini(self, endpoint, body):
+        prompt = body['contents'][0]['parts'][0]['text']
+        if body.get('generationConfig', {}).get('responseMimeType') == 'application/json':
+            # A batch: one post per numbered caption
+            count = len(re.findall(r'^\d+\. ', prompt, flags=re.MULTILINE))
+            text = json.dumps([f'Marzipan post #{self.next_id()}' for _ in range(count)], ensure_ascii=False)
+        else:
+            text = f'Marzipan post #{self.next_id()}'
+        return 200, {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]},
+                                     'finishReason': 'STOP', 'index': 0}]}
+
+
+class FakeFacebook:
+    """
+    Stands in for `facebook.GraphAPI`.
+    """
+
+    def __init__(self, fakes):
+        self.fakes = fakes
+
+    def _call(self, name):
+        self.fakes.latencies['facebook'].sleep()
+        with self.fakes._lock:
+            self.fakes.calls[f'facebook {name}'] += 1
+        return {'id': str(self.fakes.next_id())}
+
+    def put_photo(self, image, album_path='me/photos', **kwargs):
+        image.read()
+        return self._call(album_path)
+
+    def put_object(self, parent_object, connection_name, **data):
+        return self._call(connection_name)
+
+
+class FakeImgur:
+    """
+    Stands in for `imgurpython.ImgurClient`.
+    """
+
+    def __init__(self, fakes):
+        self.fakes = fakes
+        self.credits = {'UserRemaining': 10000, 'ClientRemaining': 10000}
+
+    def _call(self, name):
+        self.fakes.latencies['imgur'].sleep()
+        with self.fakes._lock:
+            self.fakes.calls[f'imgur {name}'] += 1
+
+    def upload_from_path(self, path, config=None, anon=True):
+        with open(path, 'rb') as f:
+            f.read()
+        self._call('upload')
+        image_id = f'img{self.fakes.next_id()}'
+        return {'id': image_id, 'link': f'https://i.imgur.com/{image_id}.jpg'}
+
+    def delete_image(self, image_id):
+        self._call('delete')
+        return True
+
+    def get_auth_url(self, response_type='pin'):
+        return f'https://api.imgur.com/oauth2/authorize?client_id=bench&response_type={response_type}'
+
+
+def install_stub_clients(clients, fakes):
+    """
+    Registers the stand-ins for the clients whose SDKs can not be pointed elsewhere.
+    """
+    clients.register('facebook', (), lambda: FakeFacebook(fakes))
+    clients.register('imgur', (), lambda: FakeImgur(fakes))
+    clients.register('imgur_app', (), lambda: FakeImgur(fakes))
+    clients.invalidate()
+
+
+class FakeTelegramFile:
+    def __init__(self, data, latency):
+        self.data = data
+        self.latency = latency
+
+    async def download_to_memory(self, out):
+        await self.latency.sleep_async()
+        out.write(self.data)
+
+
+class FakePhotoSize:
+    def __init__(self, data, latency):
+        self.file_unique_id = f'bench{random.getrandbits(48):012x}'
+        self.file_size = len(data)
+        self._file = FakeTelegramFile(data, latency)
+
+    async def get_file(self):
+        return self._file
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+        self.first_name = 'Bench'
+        self.last_name = str(chat_id)
+
+
+class FakeMessage:
+    """
+    The parts of a Telegram photo message the handlers use; replies take the
+    Telegram latency.
+    """
+
+    def __init__(self, chat_id, photo, latency, media_group_id=None):
+        self.chat = FakeChat(chat_id)
+        self.photo = [photo]
+        self.media_group_id = media_group_id
+        self.latency = latency
+        self.replies = []
+
+    async def reply_text(self, text):
+        await self.latency.sleep_async()
+        self.replies.append(text)
+
+
+class FakeUpdate:
+    _ids = itertools.count(1)
+
+    def __init__(self, message):
+        self.update_id = next(self._ids)
+        self.message = message
+        self.effective_chat = message.chat
+
+
+def make_photo(seed, size=(1600, 1200)):
+    """
+    A JPEG that does not look like any other seed's, so the model cache and
+    the duplicate check see a new photo every time.
+    """
+    from PIL import Image
+
+    rng = random.Random(seed)
+    small = Image.frombytes('RGB', (16, 12), bytes(rng.getrandbits(8) for _ in range(16 * 12 * 3)))
+    image = small.resize(size, Image.BICUBIC)
+    out = io.BytesIO()
+    image.save(out, format='JPEG', quality=90)
+    return out.getvalue()
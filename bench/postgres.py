@@ -0,0 +1,175 @@
+import glob
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import uuid
+
+import psycopg2
+from psycopg2.extensions import parse_dsn
+
+Logger = logging.getLogger(__name__)
+
+# The tables catozer.main expects to exist; everything else is created by its SCHEMA
+BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS chat_users (
+    chat_name BIGINT PRIMARY KEY,
+    name TEXT,
+    subscribed BOOLEAN NOT NULL DEFAULT false,
+    verified BOOLEAN NOT NULL DEFAULT false
+);
+CREATE TABLE IF NOT EXISTS posts (
+    id SERIAL PRIMARY KEY,
+    caption TEXT,
+    text TEXT,
+    schedule_time TIMESTAMP,
+    image_name TEXT,
+    posted_on_fb BOOLEAN NOT NULL DEFAULT false,
+    posted_on_ig BOOLEAN NOT NULL DEFAULT false
+);
+"""
+
+# A benchmark database is thrown away afterwards, so durability is traded for speed
+FAST_SETTINGS = ('fsync=off', 'synchronous_commit=off', 'full_page_writes=off')
+
+
+def find_pg_bin():
+    """
+    Directory with initdb and pg_ctl: BENCH_PG_BIN, the PATH, pg_config or the
+    usual Debian/Ubuntu location. None if PostgreSQL is not installed.
+    """
+    candidates = [os.getenv('BENCH_PG_BIN')]
+    initdb = shutil.which('initdb')
+    if initdb:
+        candidates.append(os.path.dirname(initdb))
+    if shutil.which('pg_config'):
+        candidates.append(subprocess.run(['pg_config', '--bindir'], capture_output=True, text=True).stdout.strip())
+    candidates.extend(sorted(glob.glob('/usr/lib/postgresql/*/bin'), reverse=True))
+
+    for directory in candidates:
+        if directory and os.path.isfile(os.path.join(directory, 'initdb')):
+            return directory
+    return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class DisposablePostgres:
+    """
+    A PostgreSQL database that exists only for one benchmark run.
+
+    With BENCH_DB_DSN set, a uniquely named database is created on that server
+    and dropped afterwards. Otherwise a throwaway cluster is initialized with
+    initdb in a temporary directory, started on a free port and removed again.
+    There is no stand-in for PostgreSQL itself: the queries use LISTEN/NOTIFY,
+    SKIP LOCKED, triggers and other features no embedded database has.
+
+    Use it as a context manager; `env()` returns the DB_* variables for catozer.main.
+    """
+
+    def __init__(self, dsn=None, keep=False):
+        self.dsn = dsn if dsn is not None else os.getenv('BENCH_DB_DSN')
+        self.keep = keep
+        self.params = None
+
+        self._workdir = None
+        self._pg_bin = None
+        self._admin = None
+        self._dbname = None
+
+    def __enter__(self):
+        if self.dsn:
+            self._create_database(parse_dsn(self.dsn))
+        else:
+            self._start_cluster()
+        self._apply(BASE_SCHEMA)
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def env(self):
+        return {
+            'DB_HOST': self.params.get('host', ''),
+            'DB_PORT': str(self.params.get('port', '5432')),
+            'DB_NAME': self.params['dbname'],
+            'DB_USER': self.params.get('user', ''),
+            'DB_PASS': self.params.get('password', ''),
+        }
+
+    def connect(self, **overrides):
+        return psycopg2.connect(**dict(self.params, **overrides))
+
+    def _apply(self, sql):
+        conn = self.connect()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(sql)
+        finally:
+            conn.close()
+
+    def _create_database(self, admin):
+        self._admin = admin
+        self._dbname = f'catozer_bench_{uuid.uuid4().hex[:8]}'
+        self._admin_execute(f'CREATE DATABASE {self._dbname}')
+        self.params = dict(admin, dbname=self._dbname)
+        Logger.info(f'Created database {self._dbname} on {admin.get("host", "localhost")}')
+
+    def _admin_execute(self, sql):
+        conn = psycopg2.connect(**self._admin)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(sql)
+        finally:
+            conn.close()
+
+    def _start_cluster(self):
+        self._pg_bin = find_pg_bin()
+        if self._pg_bin is None:
+            raise RuntimeError('PostgreSQL is not installed; install it (initdb, pg_ctl) '
+                               'or point BENCH_DB_DSN at a server the benchmark may create databases on')
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            raise RuntimeError('initdb refuses to run as root; run the benchmark as another user '
+                               'or set BENCH_DB_DSN')
+
+        self._workdir = tempfile.mkdtemp(prefix='catozer-bench-pg-')
+        data = os.path.join(self._workdir, 'data')
+        port = free_port()
+        subprocess.run([os.path.join(self._pg_bin, 'initdb'), '-D', data, '-U', 'postgres', '-A', 'trust',
+                        '-E', 'UTF8', '--no-sync'], check=True, capture_output=True)
+
+        options = f"-k {self._workdir} -p {port} -c listen_addresses='' " + ' '.join(f'-c {s}' for s in FAST_SETTINGS)
+        subprocess.run([os.path.join(self._pg_bin, 'pg_ctl'), '-D', data, '-o', options, '-w',
+                        '-l', os.path.join(self._workdir, 'postgres.log'), 'start'], check=True, capture_output=True)
+        Logger.info(f'Started a throwaway PostgreSQL cluster in {self._workdir}')
+
+        self._admin = {'host': self._workdir, 'port': port, 'user': 'postgres', 'dbname': 'postgres'}
+        self._dbname = 'catozer'
+        self._admin_execute(f'CREATE DATABASE {self._dbname}')
+        self.params = dict(self._admin, dbname=self._dbname)
+
+    def close(self):
+        if self.params is None or self.keep:
+            return
+
+        if self._workdir is not None:
+            subprocess.run([os.path.join(self._pg_bin, 'pg_ctl'), '-D', os.path.join(self._workdir, 'data'),
+                            '-m', 'immediate', 'stop'], capture_output=True)
+            shutil.rmtree(self._workdir, ignore_errors=True)
+        else:
+            try:
+                self._admin_execute(f'DROP DATABASE IF EXISTS {self._dbname} WITH (FORCE)')
+            except Exception as e:
+                Logger.warning(f'Could not drop {self._dbname}: {e}')
+        self.params = None
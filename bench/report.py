@@ -0,0 +1,95 @@
+import json
+import math
+
+
+def percentile(values, p):
+    """
+    The `p`th percentile (0-100) of `values` by the nearest-rank method.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Result:
+    """
+    Outcome of one scenario: how many operations ran in how long, and the
+    latency of each of them (seconds).
+    """
+
+    def __init__(self, scenario, operation, count, seconds, latencies, extra=None):
+        self.scenario = scenario
+        self.operation = operation
+        self.count = count
+        self.seconds = seconds
+        self.latencies = latencies
+        self.extra = extra or {}
+
+    @property
+    def key(self):
+        return f'{self.scenario}/{self.operation}'
+
+    @property
+    def throughput(self):
+        return self.count / self.seconds if self.seconds else None
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'seconds': round(self.seconds, 3),
+            'throughput': self.throughput,
+            'p50_ms': _ms(percentile(self.latencies, 50)),
+            'p99_ms': _ms(percentile(self.latencies, 99)),
+            'max_ms': _ms(max(self.latencies, default=None)),
+            **self.extra,
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def _fmt(value, digits=1):
+    return '-' if value is None else f'{value:.{digits}f}'
+
+
+def format_results(results):
+    lines = [f'{"scenario/operation":<36} {"count":>7} {"ops/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9}']
+    for result in results:
+        s = result.summary()
+        lines.append(f'{result.key:<36} {s["count"]:>7} {_fmt(s["throughput"], 2):>9} {_fmt(s["p50_ms"]):>9} '
+                     f'{_fmt(s["p99_ms"]):>9} {_fmt(s["max_ms"]):>9}')
+        for name, value in result.extra.items():
+            lines.append(f'    {name}: {value}')
+    return '\n'.join(lines)
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump({result.key: result.summary() for result in results}, f, indent=2)
+
+
+def compare(results, baseline_path, tolerance=0.2):
+    """
+    Compares the results with an earlier run saved with `save_results`.
+
+    Returns:
+        list: A message for every operation whose p99 latency grew, or whose
+        throughput dropped, by more than `tolerance` (a fraction).
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    regressions = []
+    for result in results:
+        before = baseline.get(result.key)
+        if before is None:
+            continue
+        now = result.summary()
+        if before.get('p99_ms') and now['p99_ms'] and now['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            regressions.append(f'{result.key}: p99 {before["p99_ms"]:.1f} -> {now["p99_ms"]:.1f} ms')
+        if before.get('throughput') and now['throughput'] and now['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f'{result.key}: throughput {before["throughput"]:.2f} -> {now["throughput"]:.2f} ops/s')
+    return regressions
@@ -0,0 +1,248 @@
+import asyncio
+import gzip
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2.extras import execute_values
+
+from bench.fakes import FakeMessage, FakePhotoSize, FakeUpdate, make_photo
+from bench.report import Result
+
+Logger = logging.getLogger(__name__)
+
+# Chat ids of the seeded chats; verified senders and subscribers do not overlap
+SENDER_CHAT_BASE = 100000
+SUBSCRIBER_CHAT_BASE = 200000
+
+
+def seed_chatters(db, first_chat_id, count, subscribed):
+    conn = db.connect()
+    try:
+        with conn, conn.cursor() as cur:
+            execute_values(cur, """
+            INSERT INTO chat_users (chat_name, name, subscribed, verified) VALUES %s
+            ON CONFLICT (chat_name) DO UPDATE SET subscribed = EXCLUDED.subscribed, verified = true
+            """, [(first_chat_id + i, f'bench_{i}', subscribed, True) for i in range(count)])
+    finally:
+        conn.close()
+
+
+def run_timed(fn, items, concurrency):
+    """
+    Calls `fn(item)` for every item on `concurrency` threads.
+
+    Returns:
+        tuple: (total seconds, latency of every call in seconds)
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def call(item):
+        start = time.perf_counter()
+        fn(item)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, items))
+    return time.perf_counter() - start, latencies
+
+
+def ingest(app, fakes, db, photos=40, chats=4):
+    """
+    A burst of photos sent by a few verified chats at once, through the same
+    handler the bot runs (download, variants, captions, post texts, scheduling),
+    with as many updates in flight as the bot allows.
+    """
+    seed_chatters(db, SENDER_CHAT_BASE, chats, subscribed=False)
+    app.Chatters.load()
+
+    telegram = fakes.latencies['telegram']
+    telegram_file = fakes.latencies['telegram_file']
+    updates = [FakeUpdate(FakeMessage(SENDER_CHAT_BASE + i % chats, FakePhotoSize(make_photo(i), telegram_file),
+                                      telegram))
+               for i in range(photos)]
+
+    async def burst():
+        # Like concurrent_updates() of the bot
+        semaphore = asyncio.Semaphore(app.TELEGRAM_CONCURRENT_UPDATES)
+        latencies = []
+
+        async def handle(update):
+            async with semaphore:
+                start = time.perf_counter()
+                await app.handle_photo(update, None)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(handle(update) for update in updates))
+        return time.perf_counter() - start, latencies
+
+    seconds, latencies = asyncio.run(burst())
+    scheduled = sum(1 for update in updates if any(r.startswith('✅') for r in update.message.replies))
+    return [Result('ingest', 'photo', photos, seconds, latencies, {'scheduled': scheduled})]
+
+
+def drain(app, fakes, db, posts=40):
+    """
+    post_pending working off a backlog of due posts on every platform.
+    """
+    rows = []
+    for i in range(posts):
+        name = f'drain{i}.jpg'
+        with open(app.ImageStore.backend.local_path(name), 'wb') as f:
+            f.write(make_photo(f'drain{i}'))
+        app.ImageStore.add(name)
+        rows.append((f'caption {i}', f'text {i}', name, i))
+
+    conn = db.connect()
+    try:
+        with conn, conn.cursor() as cur:
+            execute_values(cur, """
+            INSERT INTO posts (caption, text, image_name, schedule_time)
+            SELECT v.caption, v.text, v.image_name, NOW()::timestamp - (v.n + 1) * INTERVAL '1 minute'
+            FROM (VALUES %s) AS v (caption, text, image_name, n)
+            """, rows)
+    finally:
+        conn.close()
+
+    latencies = {platform: [] for platform in app.PUBLISHERS}
+    lock = threading.Lock()
+    # Calls that have to reach the stand-ins, so a publisher that skips its API does not look fast
+    services = {'fb': ('facebook', ), 'ig': ('imgur', 'instagram')}
+    calls_before = dict(fakes.calls)
+
+    def timed_publisher(platform, publish):
+        def wrapper(post, send_tg_message):
+            start = time.perf_counter()
+            try:
+                return publish(post, send_tg_message)
+            finally:
+                with lock:
+                    latencies[platform].append(time.perf_counter() - start)
+        return wrapper
+
+    publishers = dict(app.PUBLISHERS)
+    for platform, publish in publishers.items():
+        app.PUBLISHERS[platform] = timed_publisher(platform, publish)
+    try:
+        start = time.perf_counter()
+        app.post_pending(send_tg_message=False)
+        seconds = time.perf_counter() - start
+        app.BotNotifier.flush()
+    finally:
+        app.PUBLISHERS.update(publishers)
+
+    def api_calls(platform):
+        return sum(count - calls_before.get(call, 0) for call, count in fakes.calls.items()
+                   if call.split(' ', 1)[0] in services[platform])
+
+    left = len(app.get_not_posted_but_scheduled())
+    results = []
+    for platform, values in latencies.items():
+        extra = {'API calls': api_calls(platform)}
+        if extra['API calls'] == 0 and values:
+            Logger.warning(f'Publishing on {platform} did not call any of its APIs')
+        if left:
+            extra['left unpublished'] = left
+        results.append(Result('drain', platform, len(values), seconds, values, extra))
+    return results
+
+
+def dashboard(app, fakes, db, posts=10000, requests=300, concurrency=4, pages=5):
+    """
+    The dashboard pages and the posts API on a posts table with `posts` rows.
+    """
+    from catozer.web import ServerApp
+
+    # Published posts in the past, pending ones far in the future, clear of the other scenarios' slots
+    conn = db.connect()
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute("""
+            INSERT INTO posts (caption, text, image_name, schedule_time, posted_on_fb, posted_on_ig)
+            SELECT 'caption ' || g, repeat('Marzipan ', 30) || g, 'dash' || g || '.jpg',
+                   CASE WHEN g %% 4 = 0 THEN TIMESTAMP '2100-01-01' ELSE TIMESTAMP '2000-01-01' END
+                       + g * INTERVAL '1 hour',
+                   g %% 4 <> 0, g %% 4 <> 0
+            FROM generate_series(1, %s) g
+            """, (posts, ))
+            cur.execute("ANALYZE posts")
+    finally:
+        conn.close()
+
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = ServerApp.test_client()
+        return local.client
+
+    def get(url):
+        # Like a browser; compression is part of the cost of a page
+        response = client().get(url, headers={'Accept-Encoding': 'gzip'})
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {url} returned {response.status_code}')
+        return response
+
+    def walk_pages(status):
+        cursor = None
+        for _ in range(pages):
+            url = '/api/posts' + (f'?status={status}' if status else '')
+            if cursor:
+                url += ('&' if status else '?') + f'cursor={cursor}'
+            response = get(url)
+            data = response.get_data()
+            if response.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            cursor = json.loads(data)['next_cursor']
+            if cursor is None:
+                break
+
+    operations = {
+        'index': lambda _: get('/'),
+        'index_pending': lambda _: get('/?status=pending'),
+        f'api_posts_{pages}_pages': lambda _: walk_pages(None),
+        f'api_published_{pages}_pages': lambda _: walk_pages('published'),
+    }
+
+    results = []
+    for operation, fn in operations.items():
+        count = max(1, requests // len(operations))
+        seconds, latencies = run_timed(fn, range(count), concurrency)
+        results.append(Result('dashboard', operation, count, seconds, latencies))
+    return results
+
+
+def fanout(app, fakes, db, subscribers=100, messages=3):
+    """
+    Broadcasts to all subscribed chats, one message after the other.
+    """
+    seed_chatters(db, SUBSCRIBER_CHAT_BASE, subscribers, subscribed=True)
+    app.BotNotifier.invalidate_subscribers()
+
+    sent_before = len(fakes.sent_messages)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(messages):
+        sent_at = time.perf_counter()
+        app.send_chat_subs_message(f'Benchmark message {i}').result(timeout=600)
+        latencies.append(time.perf_counter() - sent_at)
+    seconds = time.perf_counter() - start
+
+    deliveries = len(fakes.sent_messages) - sent_before
+    return [Result('fanout', 'broadcast', messages, seconds, latencies,
+                   {'deliveries': deliveries, 'deliveries/s': round(deliveries / seconds, 1)})]
+
+
+SCENARIOS = {
+    'ingest': ingest,
+    'drain': drain,
+    'dashboard': dashboard,
+    'fanout': fanout,
+}
@@ -1,5 +1,11 @@
+import os
+
+if os.getenv("CATOZER_STARTUP_REPORT") == "1":
+    # Installed before anything else is imported so the imports are measured too
+    from catozer.startup import ImportTimer
+    ImportTimer.install()
+
 from catozer.main import main
-import asyncio
 
 if __name__ == "__main__":
     main()
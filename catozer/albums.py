@@ -0,0 +1,63 @@
+import asyncio
+import logging
+
+Logger = logging.getLogger(__name__)
+
+# Telegram albums have at most this many items
+MAX_ALBUM_SIZE = 10
+
+
+class MediaGroupCollector:
+    """
+    Gathers the photos of a Telegram album before they are processed.
+
+    Telegram delivers every item of an album as a separate update that only
+    shares the `media_group_id`. Messages are buffered per chat and group and
+    handed to `on_album` together once no new item arrived for `delay`
+    seconds, or right away when the album is full. Must be used from the
+    event loop the bot runs on.
+
+    Args:
+        on_album (coroutine function): Called with the messages of an album, in order.
+        delay (float): Quiet period after the last item before the album is processed.
+    """
+
+    def __init__(self, on_album, delay=1.5, max_size=MAX_ALBUM_SIZE):
+        self.on_album = on_album
+        self.delay = delay
+        self.max_size = max_size
+
+        self._groups = {}
+        self._tasks = set()
+
+    def add(self, message):
+        key = (message.chat_id, message.media_group_id)
+        group = self._groups.setdefault(key, {'messages': [], 'timer': None})
+        group['messages'].append(message)
+
+        if group['timer'] is not None:
+            group['timer'].cancel()
+
+        if len(group['messages']) >= self.max_size:
+            self._flush(key)
+        else:
+            group['timer'] = asyncio.get_running_loop().call_later(self.delay, self._flush, key)
+
+    def _flush(self, key):
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        if group['timer'] is not None:
+            group['timer'].cancel()
+
+        messages = sorted(group['messages'], key=lambda m: m.message_id)
+        task = asyncio.get_running_loop().create_task(self._process(messages))
+        # Keep a reference so the task is not garbage collected mid-way
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, messages):
+        try:
+            await self.on_album(messages)
+        except Exception as e:
+            Logger.error(f'Could not process album of {len(messages)} photos: {e}', exc_info=True)
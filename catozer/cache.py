@@ -0,0 +1,179 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+Logger = logging.getLogger(__name__)
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS caption_cache (
+    phash BIGINT PRIMARY KEY,
+    caption TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS post_text_cache (
+    caption_hash TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    text TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (caption_hash, prompt_version)
+);
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS phash BIGINT;
+"""
+
+# Number of differing bits between two 64 bit hashes, computed in SQL
+HAMMING_SQL = "length(replace(((phash # %s)::bit(64))::text, '0', ''))"
+
+
+def image_phash(path, hash_size=8):
+    """
+    Difference hash (dHash) of an image as a signed 64 bit integer.
+
+    Re-encoded, resized or slightly recompressed copies of a photo hash to the
+    same or a very close value, which makes it a good cache key for resent photos.
+    """
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+        pixels = list(image.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+
+    # Fit into a Postgres BIGINT
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def hamming(a, b):
+    return bin((a ^ b) & ((1 << 64) - 1)).count('1')
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """
+    Small thread-safe LRU cache whose entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize=1024, ttl=24 * 60 * 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+class ContentCache:
+    """
+    Caches model output so resent photos do not trigger paid model calls.
+
+    Captions are keyed by the perceptual hash of the image (near matches
+    within `caption_distance` bits count as hits) and generated post texts by
+    the caption plus the prompt version. Postgres is the source of truth with
+    an in-memory LRU in front of it.
+
+    Args:
+        pool (ConnectionPool): Pool used for the cache tables.
+        caption_distance (int): Max Hamming distance for a caption cache hit.
+    """
+
+    def __init__(self, pool, caption_distance=4, maxsize=1024, ttl=24 * 60 * 60):
+        self.pool = pool
+        self.caption_distance = caption_distance
+        self._captions = LRUCache(maxsize, ttl)
+        self._texts = LRUCache(maxsize, ttl)
+
+    def get_caption(self, phash):
+        caption = self._captions.get(phash)
+        if caption is not None:
+            return caption
+
+        with self.pool.cursor() as cur:
+            cur.execute(f"""
+            SELECT caption FROM caption_cache
+            WHERE {HAMMING_SQL} <= %s
+            ORDER BY {HAMMING_SQL}
+            LIMIT 1
+            """, (phash, self.caption_distance, phash))
+            row = cur.fetchone()
+
+        if row is None:
+            return None
+        self._captions.put(phash, row[0])
+        return row[0]
+
+    def put_caption(self, phash, caption):
+        self._captions.put(phash, caption)
+        with self.pool.cursor() as cur:
+            cur.execute("""
+            INSERT INTO caption_cache (phash, caption) VALUES (%s, %s)
+            ON CONFLICT (phash) DO UPDATE SET caption = EXCLUDED.caption, created_at = NOW()
+            """, (phash, caption))
+
+    def get_text(self, caption, prompt_version):
+        key = (text_hash(caption), prompt_version)
+        text = self._texts.get(key)
+        if text is not None:
+            return text
+
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT text FROM post_text_cache WHERE caption_hash = %s AND prompt_version = %s", key)
+            row = cur.fetchone()
+
+        if row is None:
+            return None
+        self._texts.put(key, row[0])
+        return row[0]
+
+    def put_text(self, caption, prompt_version, text):
+        key = (text_hash(caption), prompt_version)
+        self._texts.put(key, text)
+        with self.pool.cursor() as cur:
+            cur.execute("""
+            INSERT INTO post_text_cache (caption_hash, prompt_version, text) VALUES (%s, %s, %s)
+            ON CONFLICT (caption_hash, prompt_version) DO UPDATE SET text = EXCLUDED.text, created_at = NOW()
+            """, key + (text, ))
+
+    def find_near_duplicates(self, phash, max_distance=8, limit=3):
+        """
+        Posts whose image is perceptually close to `phash`.
+
+        Returns:
+            list: Dicts with id, schedule_time, image_name and distance.
+        """
+        with self.pool.cursor(dict_rows=True) as cur:
+            cur.execute(f"""
+            SELECT id, schedule_time, image_name, {HAMMING_SQL} AS distance FROM posts
+            WHERE phash IS NOT NULL AND {HAMMING_SQL} <= %s
+            ORDER BY distance
+            LIMIT %s
+            """, (phash, phash, max_distance, limit))
+            return cur.fetchall()
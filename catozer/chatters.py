@@ -0,0 +1,134 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from catozer.ratelimit import TokenBucket
+
+Logger = logging.getLogger(__name__)
+
+CHATTERS_NOTIFY_CHANNEL = 'catozer_chat_users'
+
+CHATTERS_NOTIFY_SCHEMA = f"""
+CREATE OR REPLACE FUNCTION catozer_notify_chat_users() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{CHATTERS_NOTIFY_CHANNEL}', OLD.chat_name::text);
+    ELSE
+        PERFORM pg_notify('{CHATTERS_NOTIFY_CHANNEL}', NEW.chat_name::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS catozer_chat_users_notify ON chat_users;
+CREATE TRIGGER catozer_chat_users_notify
+    AFTER INSERT OR DELETE OR UPDATE ON chat_users
+    FOR EACH ROW EXECUTE PROCEDURE catozer_notify_chat_users();
+"""
+
+
+class ChatterCache:
+    """
+    In-memory copy of the chat_users table for the Telegram handlers.
+
+    The table is small, so it is loaded completely and reloaded whenever it
+    changes (writes of this process call `put`, other writers are picked up
+    through LISTEN/NOTIFY, see `invalidate`). Lookups never wait on the DB
+    once the first load happened (`main` loads before the bot starts); a
+    reload replaces the snapshot when it is done. Chats that are unknown or not
+    verified get a token bucket each, so a spamming chat is dropped without
+    touching the DB.
+
+    Args:
+        load_all (callable): Returns all chatters as dicts with chat_name,
+            name, subscribed and verified.
+        flood_burst (int): Messages an unverified chat may send at once.
+        flood_per_minute (float): Rate at which an unverified chat regains messages.
+        max_tracked (int): Flood buckets kept at most (least recently used are dropped).
+        retry_seconds (float): Delay before a failed reload is tried again.
+    """
+
+    def __init__(self, load_all, flood_burst=3, flood_per_minute=1, max_tracked=10000, retry_seconds=30):
+        self.load_all = load_all
+        self.flood_burst = flood_burst
+        self.flood_rate = flood_per_minute / 60
+        self.max_tracked = max_tracked
+        self.retry_seconds = retry_seconds
+
+        self._lock = threading.Lock()
+        self._chatters = None
+        self._buckets = OrderedDict()
+        self._retry = None
+
+    def load(self):
+        chatters = {str(c['chat_name']): dict(c) for c in self.load_all()}
+        with self._lock:
+            self._chatters = chatters
+        Logger.info(f'Loaded {len(chatters)} chatters')
+
+    def _ensure_loaded(self):
+        if self._chatters is None:
+            self.load()
+
+    def get(self, chat_id):
+        """
+        The chatter of a chat, or None if it is not known.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return self._chatters.get(str(chat_id))
+
+    def exists(self, chat_id):
+        return self.get(chat_id) is not None
+
+    def is_verified(self, chat_id):
+        chatter = self.get(chat_id)
+        return chatter is not None and bool(chatter['verified'])
+
+    def put(self, chat_id, **fields):
+        """
+        Updates the cached chatter after this process wrote it to the DB.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            chatter = self._chatters.setdefault(str(chat_id), {'chat_name': str(chat_id), 'name': None,
+                                                              'subscribed': False, 'verified': False})
+            chatter.update(fields)
+
+    def invalidate(self, payload=None):
+        """
+        Reloads the table. Used as LISTEN callback, so the reload happens on the
+        listener thread instead of in a handler. If it fails, lookups keep the
+        previous snapshot and the reload is retried on a timer thread.
+        """
+        try:
+            self.load()
+        except Exception as e:
+            Logger.warning(f'Could not reload chatters, retrying in {self.retry_seconds}s: {e}')
+            with self._lock:
+                if self._retry is None:
+                    self._retry = threading.Timer(self.retry_seconds, self._retry_load)
+                    self._retry.daemon = True
+                    self._retry.start()
+
+    def _retry_load(self):
+        with self._lock:
+            self._retry = None
+        self.invalidate()
+
+    def allow_unverified(self, chat_id):
+        """
+        Whether a message of an unknown or unverified chat should still be handled.
+        """
+        key = str(chat_id)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.flood_burst, self.flood_rate)
+                while len(self._buckets) > self.max_tracked:
+                    self._buckets.popitem(last=False)
+            self._buckets.move_to_end(key)
+            allowed = bucket.try_acquire()
+
+        if not allowed:
+            Logger.debug(f'Dropping message of flooding chat {chat_id}')
+        return allowed
@@ -0,0 +1,84 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+Logger = logging.getLogger(__name__)
+
+
+def pooled_session(pool_maxsize=10):
+    """
+    A keep-alive `requests.Session` that can be shared between threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class ClientRegistry:
+    """
+    Keeps one long-lived client per outbound service.
+
+    Each client is built lazily from the config keys it depends on and is
+    rebuilt only when one of those values changes, so TLS connections and
+    client setup are reused across publishes and captions.
+
+    Args:
+        config_getter (callable): Returns the current value of a config key.
+    """
+
+    def __init__(self, config_getter):
+        self.config_getter = config_getter
+        self._factories = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, keys, factory):
+        """
+        Args:
+            name (str): Service name used with `get`.
+            keys (tuple): Config keys the client is built from.
+            factory (callable): Called with the values of `keys` to build the client.
+        """
+        self._factories[name] = (tuple(keys), factory)
+
+    def get(self, name):
+        keys, factory = self._factories[name]
+        values = tuple(self.config_getter(key) for key in keys)
+
+        with self._lock:
+            cached = self._clients.get(name)
+            if cached is not None and cached[0] == values:
+                return cached[1]
+
+            if cached is not None:
+                Logger.info(f'Config for {name} changed, rebuilding client')
+                self._close(cached[1])
+
+            client = factory(*values)
+            self._clients[name] = (values, client)
+            return client
+
+    def invalidate(self, key=None):
+        """
+        Drops every client depending on `key` (all clients when `key` is None).
+        """
+        with self._lock:
+            for name, (keys, _) in self._factories.items():
+                if key is not None and key not in keys:
+                    continue
+                cached = self._clients.pop(name, None)
+                if cached is not None:
+                    self._close(cached[1])
+
+    @staticmethod
+    def _close(client):
+        close = getattr(client, 'close', None)
+        if callable(close):
+            try:
+                close()
+            except Exception:
+                pass
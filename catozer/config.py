@@ -0,0 +1,149 @@
+import logging
+import threading
+from collections.abc import MutableMapping
+
+Logger = logging.getLogger(__name__)
+
+CONFIG_NOTIFY_CHANNEL = 'catozer_config'
+
+# One notification per statement; notifications with the same payload are merged per transaction
+CONFIG_NOTIFY_SCHEMA = f"""
+CREATE OR REPLACE FUNCTION catozer_notify_config() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{CONFIG_NOTIFY_CHANNEL}', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS catozer_config_notify ON config;
+CREATE TRIGGER catozer_config_notify
+    AFTER INSERT OR UPDATE OR DELETE ON config
+    FOR EACH STATEMENT EXECUTE PROCEDURE catozer_notify_config();
+"""
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+class ConfigStore(MutableMapping):
+    """
+    In-memory config backed by the config table.
+
+    Values are loaded on first access and served from memory afterwards.
+    Writes are batched into one transaction (`update`), and every change
+    bumps `version`. Other processes pick changes up through LISTEN/NOTIFY
+    (`reload` is the listener callback). Subscribers are called with the
+    changed keys they are interested in, so e.g. an API client is only
+    rebuilt when one of its own keys changes.
+
+    Args:
+        loader (callable): Returns the whole config as a dict.
+        writer (callable): Persists a dict of changed values in one transaction.
+    """
+
+    def __init__(self, loader, writer):
+        self.loader = loader
+        self.writer = writer
+        self.version = 0
+
+        self._data = None
+        self._lock = threading.RLock()
+        self._subscribers = []
+
+    @property
+    def data(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = dict(self.loader())
+                    self.version += 1
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __delitem__(self, key):
+        raise TypeError('Config values can not be deleted')
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f'<ConfigStore version={self.version} keys={len(self._data or ())}>'
+
+    def get_str(self, key, default=None):
+        value = self.get(key)
+        return default if value in (None, '') else str(value)
+
+    def get_int(self, key, default=None):
+        value = self.get_str(key)
+        return default if value is None else int(value)
+
+    def get_float(self, key, default=None):
+        value = self.get_str(key)
+        return default if value is None else float(value)
+
+    def get_bool(self, key, default=False):
+        value = self.get_str(key)
+        return default if value is None else value.strip().lower() in TRUE_VALUES
+
+    def subscribe(self, keys, callback):
+        """
+        Calls `callback(changes)` with the changed values of `keys` (all keys if None)
+        whenever some of them change, in this or another process.
+        """
+        self._subscribers.append((None if keys is None else frozenset(keys), callback))
+
+    def update(self, changes=(), **kwargs):
+        """
+        Writes several values in one transaction and applies them.
+        """
+        changes = dict(changes, **kwargs)
+        with self._lock:
+            changes = {key: value for key, value in changes.items() if self.data.get(key) != value}
+            if not changes:
+                return
+            self.writer(changes)
+            self._apply(changes)
+        self._notify(changes)
+
+    def reload(self, payload=None):
+        """
+        Re-reads the config and applies what changed. Used as LISTEN callback.
+        """
+        try:
+            fresh = dict(self.loader())
+        except Exception as e:
+            Logger.warning(f'Could not reload the config: {e}')
+            return
+
+        with self._lock:
+            if self._data is None:
+                self._data = fresh
+                self.version += 1
+                return
+            changes = {key: value for key, value in fresh.items() if self._data.get(key) != value}
+            if not changes:
+                return
+            self._apply(changes)
+        self._notify(changes)
+
+    def _apply(self, changes):
+        self._data.update(changes)
+        self.version += 1
+        Logger.info(f"Config changed to version {self.version}: {', '.join(sorted(changes))}")
+
+    def _notify(self, changes):
+        # Called without the lock held, so subscribers may read the config
+        for keys, callback in self._subscribers:
+            relevant = changes if keys is None else {k: v for k, v in changes.items() if k in keys}
+            if not relevant:
+                continue
+            try:
+                callback(relevant)
+            except Exception as e:
+                Logger.error(f'Config subscriber failed: {e}', exc_info=True)
@@ -0,0 +1,314 @@
+import logging
+import queue
+import select
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+Logger = logging.getLogger(__name__)
+
+# Errors after which a connection can not be trusted anymore and has to be replaced
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+
+    Every caller checks out its own connection for the duration of one unit
+    of work so the Flask threads, the scheduler and the Telegram handlers
+    never share a connection. Broken connections are dropped and replaced
+    transparently.
+
+    Args:
+        minconn (int): Connections opened eagerly on the first checkout.
+        maxconn (int): Upper bound of open connections.
+        timeout (float): Seconds to wait for a free connection before giving up.
+        prepare (bool): Whether to use server side prepared statements for
+            the queries registered through `register_prepared`.
+        **dsn: Keyword arguments passed to `psycopg2.connect`.
+    """
+
+    # Connections idle for longer than this are checked with a round-trip before use
+    PING_AFTER_IDLE_SECONDS = 30
+
+    def __init__(self, minconn, maxconn, timeout=30, prepare=False, **dsn):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.prepare = prepare
+        self.dsn = dsn
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._warmed_up = False
+
+        # name -> SQL with $n placeholders
+        self._statements = {}
+        # id(connection) -> set of statement names prepared on it
+        self._prepared_on = {}
+        # id(connection) -> monotonic time of the last checkin
+        self._last_used = {}
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.dsn)
+        self._prepared_on[id(conn)] = set()
+        return conn
+
+    def _discard(self, conn):
+        self._prepared_on.pop(id(conn), None)
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _warm_up(self):
+        with self._lock:
+            if self._warmed_up:
+                return
+            self._warmed_up = True
+
+        for _ in range(self.minconn):
+            try:
+                self._idle.put(self._connect())
+            except CONNECTION_ERRORS as e:
+                Logger.warning(f'Could not open DB connection while warming up the pool: {e}')
+                break
+
+    def _checkout(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'No DB connection available after {self.timeout}s')
+
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        try:
+            if conn is None or conn.closed:
+                if conn is not None:
+                    self._discard(conn)
+                conn = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        return conn
+
+    def _checkin(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for one transaction.
+
+        The transaction is committed when the block exits cleanly and rolled
+        back otherwise. A connection that failed with a connection level error
+        is not returned to the pool.
+        """
+        self._warm_up()
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+            except CONNECTION_ERRORS:
+                broken = True
+            raise
+        finally:
+            self._checkin(conn, broken=broken)
+
+    @contextmanager
+    def cursor(self, dict_rows=False, retries=1):
+        """
+        Yields a cursor on a pooled connection.
+
+        If the connection turns out to be dead before anything was executed on
+        it (e.g. after a DB restart), the pool reconnects and retries up to
+        `retries` times.
+
+        Args:
+            dict_rows (bool): Return rows as dicts (`RealDictCursor`).
+            retries (int): How many times to reconnect on a dead connection.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.connection() as conn:
+                    factory = RealDictCursor if dict_rows else None
+                    with conn.cursor(cursor_factory=factory) as cur:
+                        self._ping(conn, cur)
+                        yield cur
+                return
+            except _StaleConnection:
+                attempt += 1
+                if attempt > retries:
+                    raise psycopg2.OperationalError('Could not reconnect to the database')
+                Logger.warning('DB connection was lost, reconnecting...')
+
+    def _ping(self, conn, cur):
+        # Idle connections may have been dropped by the server; detect it before
+        # the caller runs its statements so the unit of work can be retried.
+        last_used = self._last_used.get(id(conn))
+        if last_used is None or time.monotonic() - last_used < self.PING_AFTER_IDLE_SECONDS:
+            return
+        try:
+            cur.execute("SELECT 1")
+        except CONNECTION_ERRORS as e:
+            self._discard(conn)
+            raise _StaleConnection() from e
+
+    def register_prepared(self, name, sql):
+        """
+        Registers a statement that can be executed with `execute`.
+
+        Args:
+            name (str): Name of the prepared statement.
+            sql (str): SQL with `$1`, `$2`... placeholders.
+        """
+        self._statements[name] = sql
+
+    def execute(self, cur, name, args=()):
+        """
+        Executes a registered statement on a cursor obtained from this pool.
+
+        With prepared statements enabled the statement is prepared once per
+        connection and then reused; otherwise it is sent as a plain query.
+        """
+        sql = self._statements[name]
+        if not self.prepare:
+            plain = sql
+            for i in range(len(args), 0, -1):
+                plain = plain.replace(f'${i}', '%s')
+            cur.execute(plain, args)
+            return
+
+        prepared = self._prepared_on.setdefault(id(cur.connection), set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {sql}")
+            prepared.add(name)
+
+        if args:
+            placeholders = ', '.join(['%s'] * len(args))
+            cur.execute(f"EXECUTE {name} ({placeholders})", args)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class _StaleConnection(Exception):
+    pass
+
+
+class Listener:
+    """
+    Background LISTEN loop on a dedicated connection.
+
+    Callbacks registered with `on` are called with the notification payload
+    from the listener thread. After a (re)connect every callback is called
+    once with `None` because notifications sent while disconnected are lost
+    and listeners have to resynchronise.
+
+    Args:
+        dsn (dict): Keyword arguments passed to `psycopg2.connect`.
+        reconnect_seconds (float): Delay between reconnect attempts.
+    """
+
+    def __init__(self, dsn, reconnect_seconds=5):
+        self.dsn = dsn
+        self.reconnect_seconds = reconnect_seconds
+
+        self._callbacks = {}
+        self._lock = threading.Lock()
+        self._listening = set()
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def on(self, channel, callback):
+        with self._lock:
+            self._callbacks.setdefault(channel, []).append(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='catozer-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _dispatch(self, channel, payload):
+        with self._lock:
+            callbacks = list(self._callbacks.get(channel, []))
+        for callback in callbacks:
+            try:
+                callback(payload)
+            except Exception as e:
+                Logger.error(f'Listener callback for {channel} failed: {e}', exc_info=True)
+
+    def _listen_new_channels(self, conn):
+        with self._lock:
+            channels = [c for c in self._callbacks.keys() if c not in self._listening]
+        if not channels:
+            return
+        with conn.cursor() as cur:
+            for channel in channels:
+                cur.execute(f"LISTEN {channel}")
+                self._listening.add(channel)
+        for channel in channels:
+            self._dispatch(channel, None)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.dsn)
+                conn.autocommit = True
+                self._listening = set()
+
+                while not self._stopping.is_set():
+                    self._listen_new_channels(conn)
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch(notify.channel, notify.payload)
+            except CONNECTION_ERRORS as e:
+                Logger.warning(f'DB listener connection lost: {e}')
+                self._stopping.wait(self.reconnect_seconds)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
@@ -0,0 +1,111 @@
+import heapq
+import logging
+import threading
+import time
+
+Logger = logging.getLogger(__name__)
+
+POSTS_NOTIFY_CHANNEL = 'catozer_posts'
+
+POSTS_NOTIFY_SCHEMA = f"""
+CREATE OR REPLACE FUNCTION catozer_notify_posts() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{POSTS_NOTIFY_CHANNEL}', OLD.id::text);
+    ELSE
+        PERFORM pg_notify('{POSTS_NOTIFY_CHANNEL}', NEW.id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS catozer_posts_notify ON posts;
+CREATE TRIGGER catozer_posts_notify
+    AFTER INSERT OR DELETE OR UPDATE OF schedule_time, posted_on_fb, posted_on_ig ON posts
+    FOR EACH ROW EXECUTE PROCEDURE catozer_notify_posts();
+"""
+
+
+class DueDispatcher:
+    """
+    Calls `on_due` when the next scheduled post becomes due.
+
+    Keeps a min-heap of the upcoming schedule times of unpublished posts and
+    sleeps exactly until the earliest one. The heap is reloaded whenever the
+    posts table changes (via LISTEN/NOTIFY, see `wake`) so no polling queries
+    are sent while nothing is due.
+
+    Args:
+        load_pending (callable): Returns `(post_id, seconds_until_due)` pairs
+            of all unpublished posts; the delay is computed by the DB so the
+            session timezone does not matter.
+        on_due (callable): Publishes everything that is due.
+        retry_seconds (float): When posts are still due after `on_due` ran
+            (e.g. a platform failed), how long to wait before trying again.
+        resync_seconds (float): Upper bound of sleeping without reloading, a
+            safety net for missed notifications.
+    """
+
+    def __init__(self, load_pending, on_due, retry_seconds=30, resync_seconds=600):
+        self.load_pending = load_pending
+        self.on_due = on_due
+        self.retry_seconds = retry_seconds
+        self.resync_seconds = resync_seconds
+
+        self._heap = []
+        self._retry_at = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def wake(self, payload=None):
+        """
+        Asks the dispatcher to reload the schedule; used as the NOTIFY callback.
+        """
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='catozer-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+
+    def _reload(self):
+        now = time.monotonic()
+        self._heap = [(now + max(0, float(seconds)), post_id) for post_id, seconds in self.load_pending()]
+        heapq.heapify(self._heap)
+
+    def _next_wakeup(self):
+        now = time.monotonic()
+        if not self._heap:
+            return now + self.resync_seconds
+
+        due_at = self._heap[0][0]
+        if due_at <= now:
+            # Everything due was already attempted; wait for the retry slot
+            due_at = self._retry_at if self._retry_at is not None else now
+        return min(due_at, now + self.resync_seconds)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self._wakeup.clear()
+                self._reload()
+
+                if self._heap and self._heap[0][0] <= time.monotonic():
+                    if self._retry_at is None or self._retry_at <= time.monotonic():
+                        self.on_due()
+                        self._reload()
+                        self._retry_at = time.monotonic() + self.retry_seconds
+                else:
+                    self._retry_at = None
+
+                timeout = self._next_wakeup() - time.monotonic()
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
+            except Exception as e:
+                Logger.error(f'Post dispatcher failed: {e}', exc_info=True)
+                self._stopping.wait(self.retry_seconds)
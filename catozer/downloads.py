@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+Logger = logging.getLogger(__name__)
+
+DOWNLOADS_SCHEMA = """
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS file_unique_id TEXT;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS content_hash TEXT;
+CREATE INDEX IF NOT EXISTS posts_file_unique_id_idx ON posts (file_unique_id) WHERE file_unique_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS posts_content_hash_idx ON posts (content_hash) WHERE content_hash IS NOT NULL;
+"""
+
+
+class HashingWriter:
+    """
+    File-like wrapper that hashes everything written through it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManager:
+    """
+    Downloads Telegram photos into `directory`.
+
+    Files are named after their `file_unique_id`, which stays the same when a
+    photo is forwarded again, so a file that is already on disk or recorded
+    for a post is not downloaded twice. Downloads are written to a temporary
+    file that is renamed into place once complete, so other readers never see
+    a half-written image, and the content hash is computed while writing.
+
+    Args:
+        directory (str): Where the images are stored.
+        lookup (coroutine function): Returns the stored content hash for a
+            `file_unique_id` (or None if it is not known).
+        max_concurrency (int): Maximum number of downloads at the same time.
+    """
+
+    def __init__(self, directory, lookup=None, max_concurrency=4):
+        self.directory = directory
+        self.lookup = lookup
+        self.max_concurrency = max_concurrency
+
+        self._semaphore = None
+        self._inflight = {}
+
+    async def fetch(self, photo):
+        """
+        Makes sure a photo is on disk.
+
+        Args:
+            photo (PhotoSize): The photo to download.
+
+        Returns:
+            dict: image_name, file_path, file_unique_id, content_hash and
+                `reused` (True when nothing had to be downloaded).
+        """
+        key = photo.file_unique_id
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # The same photo is already being downloaded for another message
+            result = await asyncio.shield(inflight)
+            return dict(result, reused=True)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._fetch(photo)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody might wait on it; avoid "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _fetch(self, photo):
+        image_name = f'{photo.file_unique_id}.jpg'
+        file_path = os.path.join(self.directory, image_name)
+        result = {
+            'image_name': image_name,
+            'file_path': file_path,
+            'file_unique_id': photo.file_unique_id,
+        }
+
+        if os.path.exists(file_path):
+            content_hash = await self.lookup(photo.file_unique_id) if self.lookup else None
+            if content_hash is None:
+                content_hash = await asyncio.to_thread(hash_file, file_path)
+            Logger.info(f'Photo {image_name} is already downloaded, skipping')
+            return dict(result, content_hash=content_hash, reused=True)
+
+        if self._semaphore is None:
+            # Created lazily so it binds to the bot's event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async with self._semaphore:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f'{file_path}.part'
+            try:
+                telegram_file = await photo.get_file()
+                with open(tmp_path, 'wb') as f:
+                    writer = HashingWriter(f)
+                    await telegram_file.download_to_memory(writer)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, file_path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+
+        Logger.info(f'Photo from telegram downloaded to {file_path} ({writer.size} bytes)')
+        return dict(result, content_hash=writer.hexdigest(), reused=False)
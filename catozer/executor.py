@@ -0,0 +1,67 @@
+import asyncio
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+Logger = logging.getLogger(__name__)
+
+
+class BlockingExecutor:
+    """
+    Bounded thread pool for running blocking calls from the asyncio event loop.
+
+    Args:
+        name (str): Name used for the worker threads and in the timing logs.
+        max_workers (int): Upper bound of calls running at the same time.
+    """
+
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'catozer-{name}')
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Runs `fn(*args, **kwargs)` on the pool and awaits its result without
+        blocking the event loop. Time spent waiting for a free worker and time
+        spent running are logged separately. The call sees the caller's context
+        variables (e.g. the log context).
+        """
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        started = None
+
+        def call():
+            nonlocal started
+            started = time.perf_counter()
+            return fn(*args, **kwargs)
+
+        try:
+            return await loop.run_in_executor(self._pool, contextvars.copy_context().run, call)
+        finally:
+            finished = time.perf_counter()
+            if started is not None:
+                Logger.debug(f'[{self.name}] {getattr(fn, "__name__", fn)}: '
+                             f'waited {(started - submitted) * 1000:.0f}ms, '
+                             f'ran {(finished - started) * 1000:.0f}ms')
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+@contextmanager
+def timed_stage(timings, stage):
+    """
+    Records how long the wrapped block took into `timings[stage]` (in ms).
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = (time.perf_counter() - start) * 1000
+
+
+def format_timings(timings):
+    return ', '.join(f'{stage}={ms:.0f}ms' for stage, ms in timings.items())
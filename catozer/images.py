@@ -0,0 +1,163 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+Logger = logging.getLogger(__name__)
+
+# Moondream does not benefit from more pixels than this; smaller inputs upload and run faster
+CAPTION_MAX_SIDE = 768
+
+# Instagram accepts aspect ratios between 4:5 and 1.91:1 and does not display more than 1440px width
+PUBLISH_MIN_ASPECT = 4 / 5
+PUBLISH_MAX_ASPECT = 1.91
+PUBLISH_MAX_WIDTH = 1440
+PUBLISH_QUALITY = 85
+
+THUMBNAIL_WIDTHS = (320, 640)
+THUMBNAIL_QUALITY = 80
+
+VARIANTS = ('caption', 'publish') + tuple(f'thumb{w}' for w in THUMBNAIL_WIDTHS)
+
+
+def variant_name(image_name, variant):
+    """
+    Name of a derived image, e.g. 'abc.jpg' -> 'abc.publish.jpg'.
+    """
+    stem, _ = os.path.splitext(image_name)
+    return f'{stem}.{variant}.jpg'
+
+
+def _load(path):
+    from PIL import Image, ImageOps
+
+    image = Image.open(path)
+    # Apply the EXIF orientation before the metadata is dropped
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def _crop_to_aspect(image, min_aspect, max_aspect):
+    width, height = image.size
+    aspect = width / height
+    if aspect < min_aspect:
+        new_height = int(width / min_aspect)
+        top = (height - new_height) // 2
+        return image.crop((0, top, width, top + new_height))
+    if aspect > max_aspect:
+        new_width = int(height * max_aspect)
+        left = (width - new_width) // 2
+        return image.crop((left, 0, left + new_width, height))
+    return image
+
+
+def _resize_to_width(image, width):
+    from PIL import Image
+
+    if image.width <= width:
+        return image
+    height = round(image.height * width / image.width)
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def _save(image, path, quality):
+    # Write next to the target and rename so readers never see half written files;
+    # no exif= argument means all metadata is stripped. The temporary name is per
+    # thread, as e.g. both publishers may render the same missing variant at once
+    tmp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    image.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+    os.replace(tmp_path, path)
+
+
+def render_variant(image, variant):
+    from PIL import Image
+
+    if variant == 'caption':
+        image = image.copy()
+        image.thumbnail((CAPTION_MAX_SIDE, CAPTION_MAX_SIDE), Image.LANCZOS)
+        return image, 90
+
+    if variant == 'publish':
+        image = _crop_to_aspect(image, PUBLISH_MIN_ASPECT, PUBLISH_MAX_ASPECT)
+        return _resize_to_width(image, PUBLISH_MAX_WIDTH), PUBLISH_QUALITY
+
+    if variant.startswith('thumb'):
+        return _resize_to_width(image, int(variant[len('thumb'):])), THUMBNAIL_QUALITY
+
+    raise ValueError(f'Unknown image variant: {variant}')
+
+
+def preprocess_image(path, variants=VARIANTS):
+    """
+    Decodes an original once and writes all derived variants next to it.
+
+    Args:
+        path (str): Path of the original image.
+        variants (tuple): Which variants to write.
+
+    Returns:
+        dict: variant -> path of the written file.
+    """
+    directory, image_name = os.path.split(path)
+    image = _load(path)
+
+    outputs = {}
+    for variant in variants:
+        rendered, quality = render_variant(image, variant)
+        out_path = os.path.join(directory, variant_name(image_name, variant))
+        _save(rendered, out_path, quality)
+        outputs[variant] = out_path
+
+    return outputs
+
+
+def ensure_variant(directory, image_name, variant):
+    """
+    Returns the path of a variant, creating it first if it is missing.
+    Falls back to the original when the variant can not be produced.
+    """
+    path = os.path.join(directory, variant_name(image_name, variant))
+    if os.path.exists(path):
+        return path
+
+    original = os.path.join(directory, image_name)
+    try:
+        return preprocess_image(original, (variant, ))[variant]
+    except Exception as e:
+        Logger.warning(f'Could not create {variant} variant of {image_name}: {e}')
+        return original
+
+
+_etags = OrderedDict()
+_etags_lock = threading.Lock()
+ETAG_CACHE_SIZE = 4096
+
+
+def file_etag(path):
+    """
+    Strong ETag (content hash) of a file, cached by path, size and mtime so
+    each file is only hashed once.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+
+    with _etags_lock:
+        etag = _etags.get(key)
+        if etag is not None:
+            _etags.move_to_end(key)
+            return etag
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    etag = digest.hexdigest()[:32]
+
+    with _etags_lock:
+        _etags[key] = etag
+        while len(_etags) > ETAG_CACHE_SIZE:
+            _etags.popitem(last=False)
+    return etag
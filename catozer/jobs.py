@@ -0,0 +1,207 @@
+import logging
+import threading
+
+from catozer.logs import log_context
+
+Logger = logging.getLogger(__name__)
+
+JOBS_NOTIFY_CHANNEL = 'catozer_jobs'
+
+JOBS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id SERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    post_id INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    lease_until TIMESTAMPTZ
+);
+ALTER TABLE jobs ADD COLUMN IF NOT EXISTS run_after TIMESTAMPTZ NOT NULL DEFAULT NOW();
+CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_unique ON jobs (kind, post_id) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (id) WHERE status IN ('queued', 'running');
+"""
+
+JOB_FIELDS = "id, kind, post_id, status, attempts, error, created_at, started_at, finished_at"
+
+
+class JobQueue:
+    """
+    Persistent queue of background jobs about a post, e.g. regenerating its text.
+
+    Enqueuing a job for a post that already has one of the same kind queued or
+    running returns the existing job instead of adding a duplicate. Jobs are
+    executed by a pool of worker threads; several processes can share the
+    queue because jobs are claimed with SKIP LOCKED and a lease. A failed job
+    is retried after an exponential backoff, starting at `retry_seconds`.
+
+    Args:
+        pool (ConnectionPool): Pool used for the jobs table.
+        handlers (dict): kind -> callable taking the post id.
+        workers (int): Number of worker threads.
+        poll_seconds (float): Idle poll interval (workers are also woken on enqueue).
+        lease_seconds (int): After this long a running job of a dead worker is retried.
+        max_attempts (int): Attempts after which a job is marked as failed.
+        retry_seconds (int): Delay before the first retry of a failed job.
+    """
+
+    MAX_BACKOFF_SECONDS = 60 * 60
+
+    def __init__(self, pool, handlers, workers=2, poll_seconds=30, lease_seconds=10 * 60, max_attempts=3,
+                 retry_seconds=30):
+        self.pool = pool
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+
+        self._wakeup = threading.Condition()
+        self._pending_wakeups = 0
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def enqueue(self, kind, post_id):
+        return self.enqueue_many(kind, [post_id])[0]
+
+    def enqueue_many(self, kind, post_ids):
+        """
+        Queues one job per post, merging with already active jobs.
+
+        Returns:
+            list: One job dict per post id (with `merged` set for existing jobs).
+        """
+        if kind not in self.handlers:
+            raise ValueError(f'Unknown job kind: {kind}')
+
+        jobs = []
+        with self.pool.cursor(dict_rows=True) as cur:
+            for post_id in post_ids:
+                job = None
+                # The active job may finish between the two statements; then insert again
+                while job is None:
+                    cur.execute(f"""
+                    INSERT INTO jobs (kind, post_id) VALUES (%s, %s)
+                    ON CONFLICT (kind, post_id) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING {JOB_FIELDS}
+                    """, (kind, post_id))
+                    job = cur.fetchone()
+                    merged = job is None
+                    if merged:
+                        cur.execute(f"""
+                        SELECT {JOB_FIELDS} FROM jobs
+                        WHERE kind = %s AND post_id = %s AND status IN ('queued', 'running')
+                        """, (kind, post_id))
+                        job = cur.fetchone()
+                job = dict(job)
+                job['merged'] = merged
+                jobs.append(job)
+
+            if any(not job['merged'] for job in jobs):
+                cur.execute("SELECT pg_notify(%s, '')", (JOBS_NOTIFY_CHANNEL, ))
+
+        self.wake()
+        return jobs
+
+    def get(self, job_id):
+        with self.pool.cursor(dict_rows=True) as cur:
+            cur.execute(f"SELECT {JOB_FIELDS} FROM jobs WHERE id = %s", (job_id, ))
+            return cur.fetchone()
+
+    def latest_for_posts(self, kind, post_ids):
+        """
+        The most recent job of `kind` for each of the given posts.
+        """
+        with self.pool.cursor(dict_rows=True) as cur:
+            cur.execute(f"""
+            SELECT DISTINCT ON (post_id) {JOB_FIELDS} FROM jobs
+            WHERE kind = %s AND post_id = ANY(%s)
+            ORDER BY post_id, id DESC
+            """, (kind, list(post_ids)))
+            return cur.fetchall()
+
+    def wake(self, payload=None):
+        with self._wakeup:
+            self._pending_wakeups += self.workers
+            self._wakeup.notify_all()
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'catozer-jobs-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        self.wake()
+
+    def _claim(self):
+        with self.pool.cursor(dict_rows=True) as cur:
+            cur.execute(f"""
+            UPDATE jobs SET status = 'running', started_at = NOW(), attempts = attempts + 1,
+                            lease_until = NOW() + %s * INTERVAL '1 second'
+            WHERE id = (
+                SELECT id FROM jobs
+                WHERE (status = 'queued' AND run_after <= NOW()) OR (status = 'running' AND lease_until < NOW())
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING {JOB_FIELDS}
+            """, (self.lease_seconds, ))
+            return cur.fetchone()
+
+    def _finish(self, job, error=None):
+        if error is None:
+            status = 'done'
+        elif job['attempts'] < self.max_attempts:
+            status = 'queued'
+        else:
+            status = 'failed'
+
+        backoff = min(self.retry_seconds * 2 ** (job['attempts'] - 1), self.MAX_BACKOFF_SECONDS)
+        with self.pool.cursor() as cur:
+            cur.execute("""
+            UPDATE jobs SET status = %s, error = %s, lease_until = NULL,
+                            finished_at = CASE WHEN %s IN ('done', 'failed') THEN NOW() END,
+                            run_after = NOW() + %s * INTERVAL '1 second'
+            WHERE id = %s
+            """, (status, error, status, backoff, job['id']))
+
+    def run_once(self):
+        """
+        Runs one queued job if there is one. Returns whether a job was run.
+        """
+        job = self._claim()
+        if job is None:
+            return False
+
+        with log_context(job_id=job['id'], post_id=job['post_id']):
+            Logger.info(f"Running {job['kind']} job {job['id']} for post {job['post_id']}")
+            try:
+                self.handlers[job['kind']](job['post_id'])
+            except Exception as e:
+                Logger.error(f"Job {job['id']} failed: {e}", exc_info=True)
+                self._finish(job, str(e) or e.__class__.__name__)
+            else:
+                self._finish(job)
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                Logger.error(f'Job worker failed: {e}', exc_info=True)
+
+            with self._wakeup:
+                if self._pending_wakeups == 0:
+                    self._wakeup.wait(self.poll_seconds)
+                self._pending_wakeups = max(0, self._pending_wakeups - 1)
@@ -0,0 +1,193 @@
+import atexit
+import contextvars
+import copy
+import functools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+Logger = logging.getLogger(__name__)
+
+TEXT_FORMAT = '[%(asctime)s] %(levelname)s in %(name)s:%(lineno)d -- %(message)s'
+TEXT_DATEFMT = '%Y-%m-%d %H:%M:%S'
+
+# Correlation fields (post_id, update_id, ...) of the code that is running; asyncio
+# tasks inherit them, and BlockingExecutor carries them over to its worker threads
+LogContext = contextvars.ContextVar('catozer_log_context', default={})
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Adds `fields` to every log record emitted inside the block.
+    """
+    token = LogContext.set({**LogContext.get(), **fields})
+    try:
+        yield
+    finally:
+        LogContext.reset(token)
+
+
+def update_context(handler):
+    """
+    Decorator for Telegram handlers that tags their log records with the update and chat.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        chat = update.effective_chat
+        with log_context(update_id=update.update_id, chat_id=chat.id if chat is not None else None):
+            return await handler(update, context)
+    return wrapper
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue without formatting them: the message is merged
+    with its arguments and the log context is attached in the emitting thread,
+    everything else happens on the listener thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.context = LogContext.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line with the log context as top level fields.
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName,
+        }
+        entry.update(getattr(record, 'context', None) or {})
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The classic one line format, followed by the log context.
+    """
+
+    def format(self, record):
+        text = super().format(record)
+        context = getattr(record, 'context', None)
+        if context:
+            head, sep, tail = text.partition('\n')
+            text = head + ' {' + ', '.join(f'{k}={v}' for k, v in context.items()) + '}' + sep + tail
+        return text
+
+
+def parse_levels(spec):
+    """
+    Parses per-logger levels like "catozer.api=DEBUG,telegram=WARNING".
+    """
+    levels = {}
+    for item in (spec or '').replace(';', ',').split(','):
+        if not item.strip():
+            continue
+        try:
+            name, level = item.split('=')
+        except ValueError as e:
+            raise ValueError(f'Invalid log level {item!r}, expected logger=LEVEL') from e
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f'Unknown log level {level!r} for {name.strip()}')
+        levels[name.strip()] = level
+    return levels
+
+
+class LogPipeline:
+    """
+    Queue based logging: every thread (asyncio loop, Flask, scheduler, workers)
+    only puts records on an in-memory queue, and a listener thread formats
+    them and writes them to the rotating log file (JSON lines) and stderr.
+
+    Args:
+        path (str): Log file; rotated when it reaches `max_bytes`, keeping `backups` old files.
+        level (str): Level of the root logger.
+        file_format (str): 'json' or 'text' for the file; stderr always gets text.
+    """
+
+    def __init__(self, path='app.log', level='INFO', max_bytes=10 << 20, backups=5, file_format='json'):
+        self.path = path
+        self.level = level
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file_format = file_format
+
+        self._queue = queue.SimpleQueue()
+        self._listener = None
+        self._overrides = {}
+        self._defaults = {}
+
+    def start(self):
+        """
+        Installs the queue handler on the root logger, unless logging was already
+        configured (like logging.basicConfig).
+        """
+        root = logging.getLogger()
+        if self._listener is not None or root.handlers:
+            return
+
+        file_handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                            backupCount=self.backups, encoding='utf-8')
+        file_handler.setFormatter(JsonFormatter() if self.file_format == 'json'
+                                  else TextFormatter(TEXT_FORMAT, TEXT_DATEFMT))
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(TextFormatter(TEXT_FORMAT, TEXT_DATEFMT))
+
+        self._listener = logging.handlers.QueueListener(self._queue, file_handler, stream_handler)
+        self._listener.start()
+        root.addHandler(ContextQueueHandler(self._queue))
+        root.setLevel(self.level)
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Writes out the queued records and stops the listener.
+        """
+        listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+    def set_levels(self, levels):
+        """
+        Sets the level of loggers at runtime; loggers that were changed before but
+        are not in `levels` go back to the level they had before.
+
+        Args:
+            levels (dict): Logger name -> level name.
+        """
+        for name in set(self._overrides) - set(levels):
+            logging.getLogger(name).setLevel(self._defaults.pop(name))
+        for name, level in levels.items():
+            logger = logging.getLogger(name)
+            self._defaults.setdefault(name, logger.level)
+            logger.setLevel(level)
+        if levels or self._overrides:
+            Logger.info(f"Log levels: {', '.join(f'{k}={v}' for k, v in levels.items()) or 'defaults'}")
+        self._overrides = dict(levels)
+
+    def levels(self):
+        return dict(self._overrides)
@@ -1,47 +1,55 @@
+from __future__ import annotations
+
 import os
-import traceback
+import hashlib
 import json
 import sys
 import logging
 from datetime import datetime, timedelta, time, timezone
 import threading
-import urllib.parse
-from pathlib import Path
+import base64
+import signal
 import asyncio
-import requests
-import time as unix_time
-
-from PIL import Image
-
-from telegram import Update, Bot
-from telegram.ext import ApplicationBuilder, MessageHandler, filters, ContextTypes, CommandHandler
-
-import moondream
-
-import facebook
+import socket
+from concurrent.futures import ThreadPoolExecutor
 
-from google import genai
-from google.genai import types
+from typing import TYPE_CHECKING
 
 from dotenv import load_dotenv
 
-from imgurpython import ImgurClient
-
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-from flask import Flask, render_template, send_from_directory, request, jsonify
-import flask
-import waitress
-
-from apscheduler.schedulers.background import BackgroundScheduler
+from catozer.db import ConnectionPool, Listener
+from catozer.dispatch import DueDispatcher, POSTS_NOTIFY_CHANNEL, POSTS_NOTIFY_SCHEMA
+from catozer.executor import BlockingExecutor, timed_stage, format_timings
+from catozer.notifier import Notifier
+from catozer.outbox import Outbox, OUTBOX_SCHEMA
+from catozer.ratelimit import RateLimiter, RateLimited, RATE_LIMIT_SCHEMA
+from catozer.clients import ClientRegistry, pooled_session
+from catozer.images import preprocess_image, VARIANTS
+from catozer.cache import ContentCache, image_phash, CACHE_SCHEMA
+from catozer.jobs import JobQueue, JOBS_SCHEMA, JOBS_NOTIFY_CHANNEL
+from catozer.slots import SlotAllocator, SlotTaken, parse_slot_times, SLOTS_SCHEMA
+from catozer.albums import MediaGroupCollector
+from catozer.downloads import DownloadManager, DOWNLOADS_SCHEMA
+from catozer.storage import Storage, LocalBackend, S3Backend, STORAGE_SCHEMA
+from catozer.chatters import ChatterCache, CHATTERS_NOTIFY_CHANNEL, CHATTERS_NOTIFY_SCHEMA
+from catozer.startup import startup_report
+from catozer.config import ConfigStore, CONFIG_NOTIFY_CHANNEL, CONFIG_NOTIFY_SCHEMA
+from catozer.metrics import MetricsRegistry, Sampler, timed
+from catozer.logs import LogPipeline, log_context, parse_levels, update_context
+
+from psycopg2.errors import UniqueViolation
+from psycopg2.extras import execute_values
+
+# The Telegram, Flask, model and scheduler libraries are heavy; they are imported where they
+# are used so that one-shot runs (e.g. post_pending from cron) only load what they need
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 load_dotenv()
 
-AVAILABLE_DAY_TIMES = [
-    10,
-    18
-]
+# Posting times, optionally per weekday, e.g. "10,18;sat=11,15:30;sun=" (see parse_slot_times)
+SLOT_TIMES = os.getenv("SLOT_TIMES", "10,18")
 
 MOONDREAM_TOKEN=os.getenv("MOONDREAM_TOKEN")
 
@@ -60,21 +68,128 @@ IG_ID = os.getenv("IG_ID")
 IG_CLIENT_SECRET = os.getenv("IG_CLIENT_SECRET")
 IG_CLIENT_ID = os.getenv("IG_CLIENT_ID")
 
+# Base URLs of the external APIs; only set to point the clients at stand-ins (see bench/)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+INSTAGRAM_GRAPH_URL = os.getenv("INSTAGRAM_GRAPH_URL", "https://graph.instagram.com")
+MOONDREAM_ENDPOINT = os.getenv("MOONDREAM_ENDPOINT")
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL")
+
 DB_HOST = os.getenv("DB_HOST")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 DB_PORT = os.getenv("DB_PORT")
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_PREPARED = os.getenv("DB_PREPARED") == "1"
+DB_TIMEZONE = 'Europe/Berlin'
+
+# #(Metrics)
+# Served in the Prometheus text format on /metrics of the dashboard
+Metrics = MetricsRegistry()
+DBLatency = Metrics.histogram('catozer_db_seconds', 'Duration of the DB helpers', ('fn', ))
+ExternalLatency = Metrics.histogram('catozer_external_call_seconds',
+                                    'Duration of model and publishing calls (single HTTP steps and whole posts)',
+                                    ('call', ))
+
+# Samples the stacks of all threads while switched on (here or on /metrics/profile)
+Profiler = Sampler(interval=float(os.getenv("CATOZER_PROFILER_INTERVAL", "0.01")))
+PROFILER_ENABLED = os.getenv("CATOZER_PROFILER") == "1"
+PROFILER_OUTPUT = os.getenv("CATOZER_PROFILER_OUTPUT", "profile.collapsed")
+
 # #(Database)
-DBConn = psycopg2.connect(
+DBPool = ConnectionPool(
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    prepare=DB_PREPARED,
     dbname=DB_NAME,
     user=DB_USER,
     password=DB_PASS,
     host=DB_HOST,
-    port=DB_PORT
+    port=DB_PORT,
+    options=f'-c timezone={DB_TIMEZONE}',
 )
 
+DBPool.register_prepared('chatter_exists',
+                         "SELECT COUNT(*) FROM chat_users WHERE chat_name = $1")
+DBPool.register_prepared('chatter_verified',
+                         "SELECT COUNT(*) FROM chat_users WHERE chat_name = $1 AND verified = 'true'")
+DBPool.register_prepared('chat_subscribes',
+                         "SELECT * FROM chat_users WHERE subscribed = 'true' AND verified = 'true'")
+DBPool.register_prepared('schedules',
+                         "SELECT schedule_time FROM posts WHERE schedule_time > NOW() - INTERVAL '1 day'")
+DBPool.register_prepared('not_posted_but_scheduled',
+                         "SELECT id, text, image_name, posted_on_fb, posted_on_ig FROM posts WHERE (posted_on_fb = false OR posted_on_ig = false) AND schedule_time <= NOW()")
+DBPool.register_prepared('pending_schedule', """
+SELECT id, EXTRACT(EPOCH FROM LEAST(
+    CASE WHEN NOT posted_on_fb THEN GREATEST(schedule_time::timestamptz, COALESCE(fb_lease_until, '-infinity')) END,
+    CASE WHEN NOT posted_on_ig THEN GREATEST(schedule_time::timestamptz, COALESCE(ig_lease_until, '-infinity')) END
+) - NOW())
+FROM posts WHERE posted_on_fb = false OR posted_on_ig = false
+""")
+DBPool.register_prepared('posts_in_queue',
+                         "SELECT COUNT(*) FROM posts WHERE (posted_on_fb = false OR posted_on_ig = false) AND schedule_time > NOW()")
+# Queued posts, due posts not published everywhere and how overdue the oldest is, for the metrics scrape
+DBPool.register_prepared('queue_stats', """
+WITH pending AS (
+    SELECT schedule_time, EXTRACT(EPOCH FROM NOW() - LEAST(
+        CASE WHEN NOT posted_on_fb THEN GREATEST(schedule_time::timestamptz, COALESCE(fb_lease_until, '-infinity')) END,
+        CASE WHEN NOT posted_on_ig THEN GREATEST(schedule_time::timestamptz, COALESCE(ig_lease_until, '-infinity')) END
+    )) AS overdue
+    FROM posts WHERE posted_on_fb = false OR posted_on_ig = false
+)
+SELECT COUNT(*) FILTER (WHERE schedule_time > NOW()),
+       COUNT(*) FILTER (WHERE overdue >= 0),
+       COALESCE(MAX(overdue) FILTER (WHERE overdue >= 0), 0)
+FROM pending
+""")
+
+POSTS_LEASE_SCHEMA = """
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS fb_lease_owner TEXT;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS fb_lease_until TIMESTAMPTZ;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS ig_lease_owner TEXT;
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS ig_lease_until TIMESTAMPTZ;
+"""
+
+POSTS_INDEX_SCHEMA = """
+CREATE INDEX IF NOT EXISTS posts_schedule_time_id_idx ON posts (schedule_time DESC, id DESC);
+CREATE INDEX IF NOT EXISTS posts_pending_idx ON posts (schedule_time) WHERE posted_on_fb = false OR posted_on_ig = false;
+"""
+
+SCHEMA = [
+    OUTBOX_SCHEMA,
+    POSTS_NOTIFY_SCHEMA,
+    POSTS_LEASE_SCHEMA,
+    RATE_LIMIT_SCHEMA,
+    CACHE_SCHEMA,
+    JOBS_SCHEMA,
+    POSTS_INDEX_SCHEMA,
+    SLOTS_SCHEMA,
+    DOWNLOADS_SCHEMA,
+    STORAGE_SCHEMA,
+    CHATTERS_NOTIFY_SCHEMA,
+    CONFIG_NOTIFY_SCHEMA,
+]
+
+def ensure_schema():
+    """
+    Applies SCHEMA unless this exact version of it was applied before, so
+    restarts and one-shot runs do not re-run the DDL (and take its locks).
+    """
+    digest = hashlib.sha1('\n'.join(SCHEMA).encode('utf-8')).hexdigest()
+    with DBPool.cursor() as cur:
+        cur.execute("""CREATE TABLE IF NOT EXISTS schema_versions (
+                           digest TEXT PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW())""")
+        cur.execute("SELECT 1 FROM schema_versions WHERE digest = %s", (digest, ))
+        if cur.fetchone() is not None:
+            return
+
+        Logger.info('Applying DB schema')
+        for statement in SCHEMA:
+            cur.execute(statement)
+        cur.execute("INSERT INTO schema_versions (digest) VALUES (%s) ON CONFLICT DO NOTHING", (digest, ))
+
 def default_config():
     config = {}
 
@@ -92,14 +207,15 @@ def default_config():
     config['IG_ID'] = os.getenv('IG_ID')
     config['IG_CLIENT_ID'] = os.getenv('IG_CLIENT_ID')
     config['IG_CLIENT_SECRET'] = os.getenv('IG_CLIENT_SECRET')
+    config['LOG_LEVELS'] = os.getenv('LOG_LEVELS', '')
 
     return config
 
+@timed(DBLatency)
 def db_config_fields():
-    with DBConn.cursor(cursor_factory=RealDictCursor) as cur:
+    with DBPool.cursor(dict_rows=True) as cur:
         cur.execute("SELECT * FROM config")
         confs = cur.fetchall()
-        DBConn.commit()
 
     conf_dict = {}
     for conf in confs:
@@ -107,20 +223,32 @@ def db_config_fields():
 
     return conf_dict
 
+@timed(DBLatency)
 def add_db_config_fields(name, value):
-    cur = DBConn.cursor()
-    cur.execute("""INSERT INTO config (name, value) VALUES (%s, %s)""", (name, value))
-    DBConn.commit()
-    cur.close()
+    with DBPool.cursor() as cur:
+        cur.execute("""INSERT INTO config (name, value) VALUES (%s, %s)""", (name, value))
 
-def update_config_field(name, value):
-    global CONFIG
-    CONFIG[name] = value
+@timed(DBLatency)
+def write_config_fields(changes):
+    """
+    Writes changed config values in one transaction.
+    """
+    rows = list(changes.items())
+    with DBPool.cursor() as cur:
+        execute_values(cur, """
+        UPDATE config SET value = v.value FROM (VALUES %s) AS v (name, value) WHERE config.name = v.name
+        """, rows)
+        execute_values(cur, """
+        INSERT INTO config (name, value)
+        SELECT v.name, v.value FROM (VALUES %s) AS v (name, value)
+        WHERE NOT EXISTS (SELECT 1 FROM config c WHERE c.name = v.name)
+        """, rows)
+
+def update_config_fields(changes):
+    CONFIG.update(changes)
 
-    cur = DBConn.cursor()
-    cur.execute("""UPDATE config SET value = %s WHERE name = %s""", (value, name))
-    DBConn.commit()
-    cur.close()
+def update_config_field(name, value):
+    update_config_fields({name: value})
 
 def load_config():
     config = {}
@@ -136,262 +264,743 @@ def load_config():
 
     return config
 
+@timed(DBLatency)
 def does_chatter_exists_in_db(chat_id):
-    cur = DBConn.cursor()
-    cur.execute("SELECT COUNT(*) FROM chat_users WHERE chat_name = %s", (chat_id, ))
-    count = cur.fetchall()
-    DBConn.commit()
-    cur.close()
+    with DBPool.cursor() as cur:
+        DBPool.execute(cur, 'chatter_exists', (chat_id, ))
+        count = cur.fetchall()
     return count[0][0] != 0
 
+@timed(DBLatency)
 def is_chatter_verified_in_db(chat_id):
-    cur = DBConn.cursor()
-    cur.execute("SELECT COUNT(*) FROM chat_users WHERE chat_name = %s AND verified = 'true'", (chat_id, ))
-    count = cur.fetchall()
-    DBConn.commit()
-    cur.close()
+    with DBPool.cursor() as cur:
+        DBPool.execute(cur, 'chatter_verified', (chat_id, ))
+        count = cur.fetchall()
     return count[0][0] != 0
 
+@timed(DBLatency)
 def new_chatter_in_db(chat_id, name, subscribed):
-    cur = DBConn.cursor()
-    print((chat_id, name, subscribed, ))
-    cur.execute("INSERT INTO chat_users (chat_name, name, subscribed) VALUES(%s, %s, %s)",
-                (chat_id, name, subscribed, ))
-    DBConn.commit()
-    cur.close()
-
+    Logger.info(f'New chatter {chat_id} ({name}), subscribed: {subscribed}')
+    with DBPool.cursor() as cur:
+        cur.execute("INSERT INTO chat_users (chat_name, name, subscribed) VALUES(%s, %s, %s)",
+                    (chat_id, name, subscribed, ))
+    Chatters.put(chat_id, name=name, subscribed=subscribed)
+    BotNotifier.invalidate_subscribers()
+
+@timed(DBLatency)
 def subscribe_chatter_in_db(chat_id, subbed):
-    cur = DBConn.cursor()
-    cur.execute("UPDATE chat_users SET subscribed = %s WHERE chat_name = %s", (subbed, chat_id))
-    DBConn.commit()
-    cur.close()
-
+    with DBPool.cursor() as cur:
+        cur.execute("UPDATE chat_users SET subscribed = %s WHERE chat_name = %s", (subbed, chat_id))
+    Chatters.put(chat_id, subscribed=subbed)
+    BotNotifier.invalidate_subscribers()
+
+@timed(DBLatency)
+def get_chat_users():
+    with DBPool.cursor(dict_rows=True) as cur:
+        cur.execute("""SELECT chat_name, name, subscribed::text = 'true' AS subscribed,
+                              verified::text = 'true' AS verified FROM chat_users""")
+        return cur.fetchall()
+
+@timed(DBLatency)
 def get_chat_subscribes():
-    with DBConn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM chat_users WHERE subscribed = 'true' AND verified = 'true'")
+    with DBPool.cursor(dict_rows=True) as cur:
+        DBPool.execute(cur, 'chat_subscribes')
         users = cur.fetchall()
-        DBConn.commit()
     return users
 
-CONFIG = load_config()
+# #(Config)
+# Loaded on first access and kept in memory; changes of other processes arrive through LISTEN/NOTIFY
+CONFIG = ConfigStore(load_config, write_config_fields)
+
+# #(Clients)
+def make_imgur_client(client_id, client_secret, access_token=None, refresh_token=None):
+    from imgurpython import ImgurClient
+    client = ImgurClient(client_id, client_secret)
+    if access_token is not None:
+        client.set_user_auth(access_token, refresh_token)
+    return client
+
+def make_facebook_client(token):
+    import facebook
+    return facebook.GraphAPI(access_token=token, version="3.1", session=pooled_session())
+
+def make_moondream_client(token):
+    import moondream
+    if MOONDREAM_ENDPOINT:
+        return moondream.vl(api_key=token, endpoint=MOONDREAM_ENDPOINT)
+    return moondream.vl(api_key=token)
+
+def make_gemini_client(token):
+    from google import genai
+    if GEMINI_BASE_URL:
+        return genai.Client(api_key=token, http_options={'base_url': GEMINI_BASE_URL})
+    return genai.Client(api_key=token)
+
+Clients = ClientRegistry(lambda key: CONFIG.get(key))
+Clients.register('instagram', (), pooled_session)
+Clients.register('facebook', ('FACEBOOK_TOKEN', ), make_facebook_client)
+Clients.register('imgur', ('IMGUR_CLIENT_ID', 'IMGUR_CLIENT_SECRET', 'IMGUR_ACCESS_TOKEN', 'IMGUR_REFRESH_TOKEN'),
+                 make_imgur_client)
+Clients.register('imgur_app', ('IMGUR_CLIENT_ID', 'IMGUR_CLIENT_SECRET'), make_imgur_client)
+Clients.register('moondream', ('MOONDREAM_TOKEN', ), make_moondream_client)
+Clients.register('gemini', ('GEMINI_TOKEN', ), make_gemini_client)
+
+def rebuild_clients(changes):
+    # Only the clients built from one of the changed keys are dropped
+    for key in changes:
+        Clients.invalidate(key)
+
+CONFIG.subscribe(None, rebuild_clients)
+CONFIG.subscribe(('LOG_LEVELS', ), lambda changes: apply_log_levels(changes))
+
+# #(Model output cache)
+Cache = ContentCache(DBPool, caption_distance=int(os.getenv("CAPTION_CACHE_DISTANCE", "4")))
+
+# What to do with photos that look like an already scheduled one: off, warn or skip
+DUPLICATE_CHECK = os.getenv("DUPLICATE_CHECK", "off")
+DUPLICATE_DISTANCE = int(os.getenv("DUPLICATE_DISTANCE", "8"))
+
+# #(Rate limits)
+Limiter = RateLimiter(DBPool, RateLimiter.parse_limits(os.environ))
 
 CATOZER_DEBUG = os.getenv("CATOZER_DEBUG") == "1"
 
 DOWNLOAD_DIR = "downloads"
 
+# Where originals and variants are kept: local, or s3 (any S3-compatible service) with DOWNLOAD_DIR as cache
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")
+# Published originals are removed once they are older than this or take more space; variants are kept
+STORAGE_MAX_MB = os.getenv("STORAGE_MAX_MB")
+STORAGE_MAX_AGE_DAYS = os.getenv("STORAGE_MAX_AGE_DAYS")
+STORAGE_RETENTION_HOURS = int(os.getenv("STORAGE_RETENTION_HOURS", "6"))
+
+def make_storage_backend():
+    if STORAGE_BACKEND == 's3':
+        return S3Backend(DOWNLOAD_DIR, os.getenv("STORAGE_S3_BUCKET"),
+                         prefix=os.getenv("STORAGE_S3_PREFIX", ""),
+                         endpoint_url=os.getenv("STORAGE_S3_ENDPOINT"))
+    return LocalBackend(DOWNLOAD_DIR)
+
+# #(Storage)
+ImageStore = Storage(
+    DBPool,
+    make_storage_backend(),
+    max_bytes=int(STORAGE_MAX_MB) * (1 << 20) if STORAGE_MAX_MB else None,
+    max_age_days=float(STORAGE_MAX_AGE_DAYS) if STORAGE_MAX_AGE_DAYS else None,
+)
 
+# #(Downloads)
+Downloads = DownloadManager(
+    ImageStore.directory,
+    lookup=lambda file_unique_id: DBExecutor.run(get_content_hash_by_file_id, file_unique_id),
+    max_concurrency=int(os.getenv("DOWNLOAD_CONCURRENCY", "4")),
+)
 
-# #(Server)
-ServerApp = Flask(__name__, static_url_path='', static_folder='../web/static', template_folder='../web/templates')
+# How many Telegram updates are processed at the same time
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "16"))
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "4"))
+
+# #(Executors)
+# Blocking DB calls and model calls from the Telegram handlers run here so the event loop stays free
+DBExecutor = BlockingExecutor('db', DB_POOL_MAX)
+ModelExecutor = BlockingExecutor('model', MODEL_WORKERS)
+ImageExecutor = BlockingExecutor('image', int(os.getenv("IMAGE_WORKERS", "2")))
+
+# #(Notifier)
+BotNotifier = Notifier(
+    token_getter=lambda: CONFIG['TELEGRAM_BOT_TOKEN'],
+    subscribers_loader=lambda: [sub['chat_name'] for sub in get_chat_subscribes()],
+    max_concurrency=int(os.getenv("NOTIFIER_CONCURRENCY", "8")),
+    limiter=Limiter,
+    base_url=TELEGRAM_API_URL,
+)
 
-# #(logger)
-logging.basicConfig(
-    level=logging.INFO,
+DBListener = Listener(DBPool.dsn)
 
-    format='[%(asctime)s] %(levelname)s in %(name)s:%(lineno)d -- %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
+# #(Chatters)
+# Authorization of Telegram chats is answered from memory; unverified chats are flood limited
+Chatters = ChatterCache(
+    get_chat_users,
+    flood_burst=int(os.getenv("CHAT_FLOOD_BURST", "3")),
+    flood_per_minute=float(os.getenv("CHAT_FLOOD_PER_MINUTE", "1")),
+)
 
-    handlers=[
-        logging.FileHandler("app.log"),
-        logging.StreamHandler()
-    ]
+# #(Jobs)
+Jobs = JobQueue(DBPool, {'regen': lambda post_id: regen_post(post_id)},
+                workers=int(os.getenv("JOB_WORKERS", "2")))
+
+# Alerts go through a durable outbox so posting never waits on Telegram
+AlertOutbox = Outbox(
+    DBPool,
+    sender=lambda msg: BotNotifier.send(msg).result(timeout=120),
+    coalesce_seconds=int(os.getenv("ALERT_COALESCE_SECONDS", "600")),
+    retention_seconds=int(os.getenv("ALERT_RETENTION_DAYS", "7")) * 24 * 60 * 60,
+)
+
+
+
+# #(logger)
+# Threads only queue their records; a listener thread writes app.log (JSON lines) and stderr.
+# Started by main(), importing the module does not touch the filesystem
+Logs = LogPipeline(
+    path=os.getenv("LOG_FILE", "app.log"),
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    max_bytes=int(os.getenv("LOG_MAX_MB", "10")) << 20,
+    backups=int(os.getenv("LOG_BACKUPS", "5")),
+    file_format=os.getenv("LOG_FORMAT", "json"),
 )
 logging.getLogger('telegram').setLevel(logging.WARNING)
 logging.getLogger('telegram.bot').setLevel(logging.WARNING)
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
 Logger = logging.getLogger(__name__)
+# Full API responses; off unless LOG_LEVELS turns it on, e.g. "catozer.api=DEBUG"
+ApiLogger = logging.getLogger('catozer.api')
+
+def apply_log_levels(changes):
+    try:
+        Logs.set_levels(parse_levels(changes.get('LOG_LEVELS')))
+    except ValueError as e:
+        Logger.error(f'Ignoring LOG_LEVELS: {e}')
 
 
-def put_post_in_db(caption, text, schedule_time, image_name):
-    cur = DBConn.cursor()
-    cur.execute("""
-    INSERT INTO public.posts (caption, text, schedule_time, image_name)
-    VALUES (%s, %s, %s, %s)
-""", (caption, text, schedule_time, image_name))
-    DBConn.commit()
-    cur.close()
+@timed(DBLatency)
+def put_post_in_db(caption, text, schedule_time, image_name, phash=None, file_unique_id=None, content_hash=None):
+    """
+    Inserts a post unless its slot is already taken.
 
+    Returns:
+        bool: Whether the post was inserted.
+    """
+    with DBPool.cursor() as cur:
+        cur.execute("""
+        INSERT INTO public.posts (caption, text, schedule_time, image_name, phash, file_unique_id, content_hash)
+        SELECT %s, %s, %s, %s, %s, %s, %s
+        WHERE NOT EXISTS (SELECT 1 FROM public.posts WHERE schedule_time = %s)
+    """, (caption, text, schedule_time, image_name, phash, file_unique_id, content_hash, schedule_time))
+        return cur.rowcount == 1
+
+@timed(DBLatency)
+def put_posts_in_db(posts):
+    """
+    Inserts several posts in one transaction; either all of them land in their
+    slots or none does.
+
+    Args:
+        posts (list): (caption, text, schedule_time, image_name, phash, file_unique_id, content_hash) tuples.
+
+    Raises:
+        SlotTaken: If one of the slots is already held by another post.
+    """
+    with DBPool.cursor() as cur:
+        inserted = execute_values(cur, """
+        INSERT INTO public.posts (caption, text, schedule_time, image_name, phash, file_unique_id, content_hash)
+        SELECT * FROM (VALUES %s) AS v (caption, text, schedule_time, image_name, phash, file_unique_id, content_hash)
+        WHERE NOT EXISTS (SELECT 1 FROM public.posts p WHERE p.schedule_time = v.schedule_time)
+        RETURNING id
+        """, posts, template="(%s, %s, %s::timestamp, %s, %s::bigint, %s, %s)", fetch=True)
+        if len(inserted) != len(posts):
+            # Leaving the block with an exception rolls back the rows that were inserted
+            raise SlotTaken(f'{len(posts) - len(inserted)} of {len(posts)} slots are taken')
+        return [row[0] for row in inserted]
+
+@timed(DBLatency)
+def get_content_hash_by_file_id(file_unique_id):
+    with DBPool.cursor() as cur:
+        cur.execute("""SELECT content_hash FROM posts WHERE file_unique_id = %s AND content_hash IS NOT NULL
+                       LIMIT 1""", (file_unique_id, ))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+@timed(DBLatency)
+def find_posts_by_content_hash(content_hash, limit=3):
+    with DBPool.cursor(dict_rows=True) as cur:
+        cur.execute("""SELECT id, schedule_time, image_name, 0 AS distance FROM posts
+                       WHERE content_hash = %s ORDER BY id LIMIT %s""", (content_hash, limit))
+        return cur.fetchall()
+
+@timed(DBLatency)
 def get_schedules():
-    cur = DBConn.cursor()
-    cur.execute("SELECT schedule_time FROM posts WHERE schedule_time > NOW() - INTERVAL '1 day'")
-    posts = cur.fetchall()
+    with DBPool.cursor() as cur:
+        DBPool.execute(cur, 'schedules')
+        posts = cur.fetchall()
     posts = [p[0] for p in posts]
-    DBConn.commit()
-    cur.close()
 
     return posts
 
-def get_all_posts():
-    with DBConn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM posts ORDER BY schedule_time DESC")
+POST_STATUS_FILTERS = {
+    'pending': "(posted_on_fb = false OR posted_on_ig = false)",
+    'published': "(posted_on_fb = true AND posted_on_ig = true)",
+}
+
+def encode_posts_cursor(post):
+    raw = f"{post['schedule_time'].isoformat()}|{post['id']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_posts_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    schedule_time, post_id = raw.rsplit('|', 1)
+    return datetime.fromisoformat(schedule_time), int(post_id)
+
+@timed(DBLatency)
+def get_posts_page(cursor=None, limit=30, start=None, end=None, status=None):
+    """
+    One page of posts, newest first, using keyset pagination on (schedule_time, id).
+
+    Args:
+        cursor (str): Opaque cursor returned with the previous page.
+        limit (int): Page size.
+        start (datetime): Only posts scheduled at or after this time.
+        end (datetime): Only posts scheduled before this time.
+        status (str): 'pending' or 'published'.
+
+    Returns:
+        tuple: (posts, cursor of the next page or None)
+    """
+    conditions = []
+    args = []
+
+    if cursor:
+        conditions.append("(schedule_time, id) < (%s, %s)")
+        args.extend(decode_posts_cursor(cursor))
+    if start is not None:
+        conditions.append("schedule_time >= %s")
+        args.append(start)
+    if end is not None:
+        conditions.append("schedule_time < %s")
+        args.append(end)
+    if status is not None:
+        conditions.append(POST_STATUS_FILTERS[status])
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    with DBPool.cursor(dict_rows=True) as cur:
+        cur.execute(f"""
+        SELECT id, caption, text, schedule_time, image_name, posted_on_fb, posted_on_ig FROM posts
+        {where}
+        ORDER BY schedule_time DESC, id DESC
+        LIMIT %s
+        """, args + [limit + 1])
         posts = cur.fetchall()
-        DBConn.commit()
 
-    return posts
+    next_cursor = None
+    if len(posts) > limit:
+        posts = posts[:limit]
+        next_cursor = encode_posts_cursor(posts[-1])
 
+    return posts, next_cursor
+
+@timed(DBLatency)
 def get_post(post_id):
-    with DBConn.cursor(cursor_factory=RealDictCursor) as cur:
+    with DBPool.cursor(dict_rows=True) as cur:
         cur.execute("SELECT * FROM posts WHERE id = %s", (post_id, ))
         posts = cur.fetchone()
-        DBConn.commit()
 
     return posts
 
+@timed(DBLatency)
+def get_unpublished_post_ids():
+    with DBPool.cursor() as cur:
+        cur.execute("SELECT id FROM posts WHERE posted_on_fb = false OR posted_on_ig = false ORDER BY schedule_time")
+        return [row[0] for row in cur.fetchall()]
+
+@timed(DBLatency)
 def update_post(post_id, caption, text):
-    cur = DBConn.cursor()
-    cur.execute("UPDATE posts SET caption = %s, text = %sWHERE id = %s", (caption, text, post_id, ))
-    DBConn.commit()
-    cur.close()
+    with DBPool.cursor() as cur:
+        cur.execute("UPDATE posts SET caption = %s, text = %s WHERE id = %s", (caption, text, post_id, ))
 
 
+@timed(DBLatency)
 def get_not_posted_but_scheduled():
-    with DBConn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SET TIMEZONE='Europe/Berlin'; SELECT id, text, image_name, posted_on_fb, posted_on_ig FROM posts WHERE (posted_on_fb = false OR posted_on_ig = false) AND schedule_time <= NOW();")
+    with DBPool.cursor(dict_rows=True) as cur:
+        DBPool.execute(cur, 'not_posted_but_scheduled')
         posts = cur.fetchall()
-        DBConn.commit()
 
     return posts
 
+@timed(DBLatency)
+def get_pending_schedule():
+    """
+    Returns (post_id, seconds until due) for every post that is not fully published yet.
+    """
+    with DBPool.cursor() as cur:
+        DBPool.execute(cur, 'pending_schedule')
+        return cur.fetchall()
+
+@timed(DBLatency)
 def count_posts_in_queue():
-    with DBConn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SET TIMEZONE='Europe/Berlin'; SELECT COUNT(*) FROM posts WHERE (posted_on_fb = false OR posted_on_ig = false) AND schedule_time > NOW();")
+    with DBPool.cursor(dict_rows=True) as cur:
+        DBPool.execute(cur, 'posts_in_queue')
         count = cur.fetchall()
-        DBConn.commit()
 
     return count[0]['count']
 
+@timed(DBLatency)
 def mark_as_fb_posted(post_id):
-    with DBConn.cursor() as cur:
-        cur.execute("UPDATE posts SET posted_on_fb = true WHERE id = %s", (post_id, ))
-        DBConn.commit()
+    with DBPool.cursor() as cur:
+        cur.execute("""UPDATE posts SET posted_on_fb = true, fb_lease_owner = NULL, fb_lease_until = NULL
+                       WHERE id = %s""", (post_id, ))
 
+@timed(DBLatency)
 def mark_as_ig_posted(post_id):
-    with DBConn.cursor() as cur:
-        cur.execute("UPDATE posts SET posted_on_ig = true WHERE id = %s", (post_id, ))
-        DBConn.commit()
+    with DBPool.cursor() as cur:
+        cur.execute("""UPDATE posts SET posted_on_ig = true, ig_lease_owner = NULL, ig_lease_until = NULL
+                       WHERE id = %s""", (post_id, ))
+
+# Identifies this process in the post leases
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
 
-def has_free_slot_in_day(now, now_str, schedules_map):
+# A publisher that crashed mid-post loses its claim after this long
+POST_LEASE_SECONDS = 10 * 60
+
+PLATFORMS = ('fb', 'ig')
+
+@timed(DBLatency)
+def claim_due_posts(platform, limit=50):
     """
-    Checks whether there is a free posting slot on a given day.
+    Atomically claims due posts that are not yet published on a platform.
+
+    The claim is a lease: other publisher processes skip the claimed rows until
+    the lease expires, so several replicas can publish without posting twice and
+    posts of a crashed replica are picked up again.
 
     Args:
-        now (datetime): Current datetime.
-        now_str (str): Date string in 'dd-mm-YYYY' format representing the day to check.
-        schedules_map (dict): A map from date strings to a list of scheduled datetimes.
+        platform (str): 'fb' or 'ig'.
+        limit (int): Maximum number of posts to claim.
 
     Returns:
-        bool: True if there is at least one free and valid (i.e., future) slot on the day.
+        list: Claimed posts with id, text and image_name.
     """
+    assert platform in PLATFORMS
+
+    with DBPool.cursor(dict_rows=True) as cur:
+        cur.execute(f"""
+        UPDATE posts SET {platform}_lease_owner = %s, {platform}_lease_until = NOW() + %s * INTERVAL '1 second'
+        WHERE id IN (
+            SELECT id FROM posts
+            WHERE posted_on_{platform} = false AND schedule_time <= NOW()
+              AND ({platform}_lease_until IS NULL OR {platform}_lease_until < NOW())
+            ORDER BY schedule_time
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, text, image_name
+        """, (WORKER_ID, POST_LEASE_SECONDS, limit))
+        return cur.fetchall()
+
+@timed(DBLatency)
+def defer_post(platform, post_id, seconds):
+    """
+    Keeps a post that failed to publish leased for `seconds` so it is retried later.
+    """
+    assert platform in PLATFORMS
+
+    with DBPool.cursor() as cur:
+        cur.execute(f"""
+        UPDATE posts SET {platform}_lease_owner = NULL, {platform}_lease_until = NOW() + %s * INTERVAL '1 second'
+        WHERE id = %s AND {platform}_lease_owner = %s
+        """, (seconds, post_id, WORKER_ID))
+
+PostsQueued = Metrics.gauge('catozer_posts_queued', 'Scheduled posts that are not due yet')
+PublishBacklog = Metrics.gauge('catozer_publish_backlog', 'Due posts that are not published everywhere yet')
+PublishBacklogAge = Metrics.gauge('catozer_publish_backlog_age_seconds',
+                                  'How long the oldest unpublished due post is overdue')
+
+@Metrics.collector
+def collect_queue_metrics():
+    # One query per scrape for all three gauges; not timed, so scrapes stay out of catozer_db_seconds
+    with DBPool.cursor() as cur:
+        DBPool.execute(cur, 'queue_stats')
+        queued, backlog, backlog_age = cur.fetchone()
+
+    PostsQueued.set(queued)
+    PublishBacklog.set(backlog)
+    PublishBacklogAge.set(float(backlog_age))
+SchedulerLag = Metrics.gauge('catozer_scheduler_job_lag_seconds',
+                             'How late the last run of a periodic job was submitted', ('job', ))
+SchedulerMissed = Metrics.counter('catozer_scheduler_jobs_missed_total', 'Runs of periodic jobs that were missed',
+                                  ('job', ))
+
+def observe_scheduler_event(event):
+    from apscheduler.events import EVENT_JOB_MISSED
+
+    if event.code == EVENT_JOB_MISSED:
+        SchedulerMissed.inc(job=event.job_id)
+        return
+    lag = datetime.now(timezone.utc) - max(event.scheduled_run_times)
+    SchedulerLag.set(max(lag.total_seconds(), 0), job=event.job_id)
 
-    if now_str not in schedules_map:
-        return True
-
-    # If scheduled posts exceed available slots, there is no room.
-    if len(schedules_map[now_str]) >= len(AVAILABLE_DAY_TIMES):
-        return False
-
-    # Get the list of taken slot hours for the day.
-    taken_slots = schedules_map[now_str]
-    taken_slots_hours = [int(slot.strftime("%H")) for slot in taken_slots]
+# #(Slots)
+Slots = SlotAllocator(parse_slot_times(SLOT_TIMES), get_schedules)
 
-    # Check each available hour for a free slot that's also in the future.
-    for available_slot_time in AVAILABLE_DAY_TIMES:
-        candidate_time = datetime.combine(now.date(), time(hour=available_slot_time))
-        if candidate_time < datetime.now():
-            continue  # Skip past times
-        if available_slot_time not in taken_slots_hours:
-            return True  # Found a free slot
+def find_scheduling_time():
+    """
+    Finds the next available datetime to schedule a post.
 
-    return False  # No free future slots found
+    Returns:
+        datetime: A datetime object representing when the next post can be scheduled.
+    """
+    return Slots.peek()
 
-def get_free_slot(now, now_str, schedules_map):
+def schedule_post(caption, text, image_name, phash=None, file_unique_id=None, content_hash=None):
     """
-    Finds the next free time slot on a given day.
+    Reserves the next free slot and stores the post in it.
 
-    Args:
-        now (datetime): Base datetime (used for date).
-        now_str (str): Date string in 'dd-mm-YYYY' format representing the day to check.
-        schedules_map (dict): A map from date strings to a list of scheduled datetimes.
+    The insert only succeeds if no other post holds the slot (backed by a unique
+    index), so concurrent photos and other processes never share a slot; on a
+    collision the next free slot is tried.
 
     Returns:
-        datetime: The next available datetime slot for posting.
+        datetime: The time the post was scheduled for.
     """
-    # If no posts are scheduled on that day, return the first available slot.
-    if now_str not in schedules_map:
-        return datetime.combine(now.date(), time(hour=AVAILABLE_DAY_TIMES[0]))
-
-    # Extract already taken hours on that day.
-    taken_slots = [int(slot.strftime("%H")) for slot in schedules_map[now_str]]
+    for _ in range(10):
+        post_time = Slots.reserve()
+        try:
+            if put_post_in_db(caption, text, post_time, image_name, phash, file_unique_id, content_hash):
+                return post_time
+        except UniqueViolation:
+            pass
+        except Exception:
+            Slots.release(post_time)
+            raise
 
-    # Find the first available hour not already taken.
-    for available_slot_time in AVAILABLE_DAY_TIMES:
-        if available_slot_time not in taken_slots:
-            return datetime.combine(now.date(), time(hour=available_slot_time))
+        Logger.info(f'Slot {post_time} was taken by another process')
+        Slots.invalidate()
 
-    # In practice, this should not happen if used after has_free_slot_in_day
-    return None
+    raise ValueError('Could not find a free slot for the post')
 
-def find_scheduling_time():
+def schedule_posts(posts):
     """
-    Finds the next available datetime to schedule a post.
+    Reserves consecutive free slots for several posts and stores them in one transaction.
+
+    Args:
+        posts (list): Dicts with caption, text, image_name, phash, file_unique_id and content_hash.
 
     Returns:
-        datetime: A datetime object representing when the next post can be scheduled.
+        list: The times the posts were scheduled for, in order.
     """
-    now = datetime.now()
-
-    # Get all existing scheduled post times.
-    schedules = get_schedules()
-
-    # Organize schedules by date string (e.g., '31-05-2025' -> [times])
-    schedules_map = {}
-    for sched in schedules:
-        day = sched.strftime("%d-%m-%Y")
-        schedules_map.setdefault(day, []).append(sched)
+    for _ in range(10):
+        post_times = Slots.reserve_many(len(posts))
+        try:
+            put_posts_in_db([(post['caption'], post['text'], post_time, post['image_name'], post['phash'],
+                              post['file_unique_id'], post['content_hash'])
+                             for post, post_time in zip(posts, post_times)])
+            return post_times
+        except (SlotTaken, UniqueViolation):
+            pass
+        except Exception:
+            for post_time in post_times:
+                Slots.release(post_time)
+            raise
 
-    now_str = now.strftime("%d-%m-%Y")
+        Logger.info('Some of the slots were taken by another process')
+        Slots.invalidate()
 
-    # Advance day by day until we find a day with a free slot.
-    while not has_free_slot_in_day(now, now_str, schedules_map):
-        now += timedelta(days=1)
-        now_str = now.strftime("%d-%m-%Y")
+    raise ValueError('Could not find free slots for the posts')
 
-    # Return the actual datetime slot available.
-    return get_free_slot(now, now_str, schedules_map)
+# How long model calls wait for their rate limit before giving up
+MODEL_RATE_LIMIT_WAIT = 60
+# How long publishing waits for the tokens of all Graph calls of a post
+PUBLISH_RATE_LIMIT_WAIT = int(os.getenv("PUBLISH_RATE_LIMIT_WAIT", "60"))
 
 def generate_photo_caption(image_path):
 
-    MoondreamModel = moondream.vl(api_key=CONFIG['MOONDREAM_TOKEN'])
+    Limiter.acquire('moondream', timeout=MODEL_RATE_LIMIT_WAIT)
+    from PIL import Image
+
+    MoondreamModel = Clients.get('moondream')
     image = Image.open(image_path)
-    caption_response = MoondreamModel.caption(image, length="normal")
+    try:
+        with ExternalLatency.time(call='moondream_caption'):
+            caption_response = MoondreamModel.caption(image, length="normal")
+    except Exception as e:
+        Limiter.observe_exception('moondream', e)
+        raise
     return caption_response["caption"]
 
+POST_CONTENT_MODEL = "gemini-2.0-flash"
+
+POST_CONTENT_INSTRUCTION = "Това ще е в пост в инстаграм. Страницата за която става въпрос е Cattos. В нея публикувам снимки и историики за премеждията на котарака Марципан. Ще трябва да ми помогнеш с правенеот на съдаржание за тази страница. Аз ще ти давам описание на картинката, ти ще ми даваш забавен пост за Марципан,  който ще е за facebook и instagram. Марципан е раг-дол котка, а не сиамка, имай го предвид. Давай ми само текста на поста. Прави постовете малко по-къси - 2-3 изречения и вкарвай кратка измислена историйка от живота на Марципан, която да е подходяща за описанието на снимкат. Отговряй на Български език и не прави правописни грешки. Съдържанието трябва да е от името на Марципан."
+
 def generate_post_content(caption):
+    from google.genai import types
 
-    GeminiClient = genai.Client(api_key=CONFIG['GEMINI_TOKEN'])
-    response = GeminiClient.models.generate_content(
-        model="gemini-2.0-flash",
-        config=types.GenerateContentConfig(
-            system_instruction="Това ще е в пост в инстаграм. Страницата за която става въпрос е Cattos. В нея публикувам снимки и историики за премеждията на котарака Марципан. Ще трябва да ми помогнеш с правенеот на съдаржание за тази страница. Аз ще ти давам описание на картинката, ти ще ми даваш забавен пост за Марципан,  който ще е за facebook и instagram. Марципан е раг-дол котка, а не сиамка, имай го предвид. Давай ми само текста на поста. Прави постовете малко по-къси - 2-3 изречения и вкарвай кратка измислена историйка от живота на Марципан, която да е подходяща за описанието на снимкат. Отговряй на Български език и не прави правописни грешки. Съдържанието трябва да е от името на Марципан."),
-        contents=[caption]
-    )
+    Limiter.acquire('gemini', timeout=MODEL_RATE_LIMIT_WAIT)
+    GeminiClient = Clients.get('gemini')
+    try:
+        with ExternalLatency.time(call='gemini_post'):
+            response = GeminiClient.models.generate_content(
+                model=POST_CONTENT_MODEL,
+                config=types.GenerateContentConfig(system_instruction=POST_CONTENT_INSTRUCTION),
+                contents=[caption]
+            )
+    except Exception as e:
+        Limiter.observe_exception('gemini', e)
+        raise
 
     text = response.text
     return text
 
+# Cached post texts are only reused for the same model and prompt
+PROMPT_VERSION = hashlib.sha1(f'{POST_CONTENT_MODEL}\n{POST_CONTENT_INSTRUCTION}'.encode('utf-8')).hexdigest()[:12]
+
+def cache_call(fn, *args):
+    # The cache is an optimization; never fail the pipeline because of it
+    try:
+        return fn(*args)
+    except Exception as e:
+        Logger.warning(f'Model cache unavailable: {e}')
+        return None
+
+def caption_for_image(image_path, phash=None):
+    """
+    Caption of an image, reusing the caption of a (near) identical image if there is one.
+    """
+    if phash is None:
+        phash = image_phash(image_path)
+
+    caption = cache_call(Cache.get_caption, phash)
+    if caption is not None:
+        Logger.info('Caption cache hit')
+        return caption
+
+    caption = generate_photo_caption(image_path)
+    cache_call(Cache.put_caption, phash, caption)
+    return caption
+
+def post_content_for_caption(caption, refresh=False):
+    """
+    Post text for a caption, reusing earlier output for the same caption and prompt
+    unless `refresh` asks for a new one.
+    """
+    if not refresh:
+        text = cache_call(Cache.get_text, caption, PROMPT_VERSION)
+        if text is not None:
+            Logger.info('Post text cache hit')
+            return text
+
+    text = generate_post_content(caption)
+    cache_call(Cache.put_text, caption, PROMPT_VERSION, text)
+    return text
+
+async def caption_for_image_async(image_path, phash=None):
+    return await ModelExecutor.run(caption_for_image, image_path, phash)
+
+async def post_content_for_caption_async(caption):
+    text = await DBExecutor.run(cache_call, Cache.get_text, caption, PROMPT_VERSION)
+    if text is not None:
+        Logger.info('Post text cache hit')
+        return text
+
+    text = await generate_post_content_async(caption)
+    await DBExecutor.run(cache_call, Cache.put_text, caption, PROMPT_VERSION, text)
+    return text
+
+async def generate_photo_caption_async(image_path):
+    # Moondream has no async client; run the blocking call on the model pool
+    return await ModelExecutor.run(generate_photo_caption, image_path)
+
+# Appended to the post instruction when several captions are sent in one request
+BATCH_CONTENT_INSTRUCTION = "Ще получиш няколко номерирани описания на снимки. Напиши отделен пост за всяко от тях и върни JSON списък с текстовете на постовете в същия ред."
+
+async def generate_post_contents_async(captions):
+    """
+    Post texts for several captions with a single Gemini request.
+
+    Returns:
+        list: One text per caption, in order.
+    """
+    if len(captions) == 1:
+        return [await generate_post_content_async(captions[0])]
+
+    from google.genai import types
+
+    await Limiter.acquire_async('gemini', timeout=MODEL_RATE_LIMIT_WAIT)
+    GeminiClient = Clients.get('gemini')
+    try:
+        with ExternalLatency.time(call='gemini_post_batch'):
+            response = await GeminiClient.aio.models.generate_content(
+                model=POST_CONTENT_MODEL,
+                config=types.GenerateContentConfig(
+                    system_instruction=f'{POST_CONTENT_INSTRUCTION} {BATCH_CONTENT_INSTRUCTION}',
+                    response_mime_type='application/json',
+                    response_schema=list[str],
+                ),
+                contents=['\n'.join(f'{i + 1}. {caption}' for i, caption in enumerate(captions))]
+            )
+    except Exception as e:
+        Limiter.observe_exception('gemini', e)
+        raise
+
+    texts = json.loads(response.text)
+    if not isinstance(texts, list) or len(texts) != len(captions):
+        raise ValueError(f'Expected {len(captions)} post texts from Gemini, got: {response.text[:200]}')
+    return texts
+
+async def post_contents_for_captions_async(captions):
+    """
+    Post texts for several captions. Cached texts are reused, the rest is generated
+    in one batched request, falling back to one request per caption if the batch fails.
+
+    Returns:
+        list: One text per caption, None where no text could be generated.
+    """
+    texts = [await DBExecutor.run(cache_call, Cache.get_text, caption, PROMPT_VERSION) for caption in captions]
+    missing = [i for i, text in enumerate(texts) if text is None]
+    Logger.info(f'Post text cache hits: {len(captions) - len(missing)}/{len(captions)}')
+    if not missing:
+        return texts
+
+    try:
+        generated = await generate_post_contents_async([captions[i] for i in missing])
+    except Exception as e:
+        Logger.warning(f'Batched post generation failed, generating one by one: {e}')
+        generated = await asyncio.gather(*(generate_post_content_async(captions[i]) for i in missing),
+                                         return_exceptions=True)
+
+    for i, text in zip(missing, generated):
+        if isinstance(text, Exception):
+            Logger.error(f'Could generate post content with Gemini: {text}')
+            continue
+        texts[i] = text
+        await DBExecutor.run(cache_call, Cache.put_text, captions[i], PROMPT_VERSION, text)
+
+    return texts
+
+async def generate_post_content_async(caption):
+    from google.genai import types
+
+    await Limiter.acquire_async('gemini', timeout=MODEL_RATE_LIMIT_WAIT)
+    GeminiClient = Clients.get('gemini')
+    try:
+        with ExternalLatency.time(call='gemini_post'):
+            response = await GeminiClient.aio.models.generate_content(
+                model=POST_CONTENT_MODEL,
+                config=types.GenerateContentConfig(system_instruction=POST_CONTENT_INSTRUCTION),
+                contents=[caption]
+            )
+    except Exception as e:
+        Limiter.observe_exception('gemini', e)
+        raise
+
+    return response.text
+
+@timed(ExternalLatency, call='post_on_fb')
 def post_on_fb(image_url, content):
-    FacebookGraph = facebook.GraphAPI(access_token=CONFIG['FACEBOOK_TOKEN'], version="3.1")
+    FacebookGraph = Clients.get('facebook')
 
+    # Uploading the photo and creating the post are two Graph calls; both tokens are taken
+    # up front, so a rate limit never strikes between them and orphans the uploaded photo
+    Limiter.acquire('facebook', timeout=PUBLISH_RATE_LIMIT_WAIT, n=2)
     try:
-        with open(image_url, 'rb') as image:
+        with open(image_url, 'rb') as image, ExternalLatency.time(call='facebook_photo_upload'):
             photo = FacebookGraph.put_photo(
                 image = image,
                 album_path = 'me/photos',
                 published = False,
             )
 
-        Logger.info(f'Facebook response: {photo}')
+        ApiLogger.debug(f'Facebook response: {photo}')
         if 'error' in photo.keys():
             raise Exception(f"There is an error from FB: {photo['error']}")
 
@@ -401,6 +1010,8 @@ def post_on_fb(image_url, content):
         media_fbid = photo['id']
         Logger.info(f'Uploaded photo to Facebook - id: {media_fbid}')
     except Exception as e:
+        Limiter.release('facebook')
+        Limiter.observe_exception('facebook', e)
         raise ValueError('Could not upload photo to Facebook') from e
 
     try:
@@ -414,28 +1025,46 @@ def post_on_fb(image_url, content):
             'scheduled_publish_time': scheduled_time.isoformat(),
             'attached_media': str([{'media_fbid': media_fbid}]),
         }
-        response = FacebookGraph.put_object(parent_object=PAGE_ID, connection_name='feed', **post_data)
-        Logger.info(f'Facebook response: {response}')
+        with ExternalLatency.time(call='facebook_feed_post'):
+            response = FacebookGraph.put_object(parent_object=PAGE_ID, connection_name='feed', **post_data)
+        ApiLogger.debug(f'Facebook response: {response}')
         if 'error' in response.keys():
             raise Exception(f"There is an error from FB: {response['error']}")
     except Exception as e:
+        Limiter.observe_exception('facebook', e)
         raise ValueError('Could not publish post to Facebook') from e
 
     send_chat_subs_message('✉️ Posted on Facebook ✅')
 
 
+@timed(ExternalLatency, call='post_on_ig')
 def post_on_ig(image_url, content):
-    Imgur = ImgurClient(CONFIG['IMGUR_CLIENT_ID'], CONFIG['IMGUR_CLIENT_SECRET'])
-    Imgur.set_user_auth(CONFIG['IMGUR_ACCESS_TOKEN'], CONFIG['IMGUR_REFRESH_TOKEN'])
+    Imgur = Clients.get('imgur')
+    InstagramHttp = Clients.get('instagram')
+
+    # Creating and publishing the media are two Graph calls; all tokens are taken up front, so
+    # a rate limit never strikes halfway and leaves an orphaned upload. Instagram is the scarcer
+    # budget and goes first; its tokens are given back if Imgur is limited
+    Limiter.acquire('instagram', timeout=PUBLISH_RATE_LIMIT_WAIT, n=2)
+    try:
+        Limiter.acquire('imgur', timeout=PUBLISH_RATE_LIMIT_WAIT)
+    except RateLimited:
+        Limiter.release('instagram', n=2)
+        raise
 
     try:
-        result = Imgur.upload_from_path(image_url, config=None, anon=False)
+        with ExternalLatency.time(call='imgur_upload'):
+            result = Imgur.upload_from_path(image_url, config=None, anon=False)
         link = result['link']
         img_id = result['id']
         Logger.info(f'Uploaded image with link {link}')
 
     except Exception as e:
-        raise ValueError(f'Could not upload image to Imgur') from e
+        Limiter.release('instagram', n=2)
+        Limiter.observe_exception('imgur', e)
+        raise ValueError('Could not upload image to Imgur') from e
+    finally:
+        Limiter.observe_imgur_credits(Imgur.credits)
 
     try:
         try:
@@ -444,8 +1073,10 @@ def post_on_ig(image_url, content):
                 'caption': content,
                 'access_token': CONFIG['IG_TOKEN'],
             }
-            response = requests.post(f'https://graph.instagram.com/me/media', data=payload)
-            response = response.json()
+            with ExternalLatency.time(call='instagram_media'):
+                http_response = InstagramHttp.post(f'{INSTAGRAM_GRAPH_URL}/me/media', data=payload)
+            response = http_response.json()
+            Limiter.observe_response('instagram', http_response.status_code, http_response.headers, response)
 
             if 'error' in response.keys():
                 error = response['error']
@@ -455,9 +1086,11 @@ def post_on_ig(image_url, content):
             if 'id' not in response.keys():
                 raise ValueError(f'The response from IG was not the expected one: {response}')
 
-            Logger.info(f'Created IG creation...: {response}')
+            ApiLogger.debug(f'Instagram media response: {response}')
+            Logger.info(f"Created Instagram media {response['id']}")
         except Exception as e:
-            raise ValueError(f'Could not upload media to Instagram') from e
+            Limiter.release('instagram')
+            raise ValueError('Could not upload media to Instagram') from e
 
         try:
             creation_id = response['id']
@@ -467,20 +1100,22 @@ def post_on_ig(image_url, content):
                 'creation_id': creation_id,
                 'access_token': CONFIG['IG_TOKEN']
             }
-            response = requests.post(f'https://graph.instagram.com/me/media_publish', data=payload)
-            response = response.json()
+            with ExternalLatency.time(call='instagram_media_publish'):
+                http_response = InstagramHttp.post(f'{INSTAGRAM_GRAPH_URL}/me/media_publish', data=payload)
+            response = http_response.json()
+            Limiter.observe_response('instagram', http_response.status_code, http_response.headers, response)
             if 'error' in response.keys():
                 raise Exception(f"There is an error from IG: {response['error']}")
 
         except Exception as e:
-            raise ValueError(f'Could not publish media to Instagram.') from e
+            raise ValueError('Could not publish media to Instagram.') from e
 
     except Exception as e:
         try:
             if img_id is not None:
                 Logger.info(f'Deleting imgur image: {img_id}')
                 Imgur.delete_image(img_id)
-        except _:
+        except Exception:
             pass
 
         raise e
@@ -488,43 +1123,125 @@ def post_on_ig(image_url, content):
     send_chat_subs_message('✉️ Posted on Instagram ✅')
 
 def send_chat_subs_message(msg):
-    async def send_chat_message(msg):
-        Logger.info(f'Sending bot message: {msg}')
-        TelegramApp = ApplicationBuilder().token(CONFIG['TELEGRAM_BOT_TOKEN']).build()
-        subs = get_chat_subscribes()
-        for sub in subs:
-            await TelegramApp.bot.send_message(chat_id=sub['chat_name'], text=msg)
+    """
+    Queues a message for all subscribed chats without waiting for it to be sent.
 
-    asyncio.run(send_chat_message(msg))
+    Returns:
+        concurrent.futures.Future: Resolves to the number of chats reached.
+    """
+    return BotNotifier.send(msg)
+
+def queue_alert(kind, msg, label=None):
+    """
+    Stores an alert in the outbox; alerts of the same kind are coalesced into digests.
+    """
+    try:
+        AlertOutbox.enqueue(kind, msg, label)
+    except Exception as e:
+        Logger.error(f'Could not queue alert, sending directly: {e}')
+        send_chat_subs_message(msg)
 
 def get_photo_caption_and_text():
     pass
 
 
+async def download_photo(message):
+    """
+    Makes sure the largest size of a photo message is on disk (see DownloadManager).
+
+    Returns:
+        dict: image_name, file_path, file_unique_id, content_hash and reused.
+    """
+    download = await Downloads.fetch(message.photo[-1])
+    if not download['reused']:
+        await DBExecutor.run(ImageStore.add, download['image_name'], download['file_path'],
+                             'original', None, download['content_hash'])
+    return download
+
+def existing_variants(file_path):
+    image_name = os.path.basename(file_path)
+    return {variant: ImageStore.variant(image_name, variant) for variant in VARIANTS}
+
+def store_variants(file_path):
+    variants = preprocess_image(file_path)
+    ImageStore.add_variants(os.path.basename(file_path), variants)
+    return variants
+
+async def prepare_photo(file_path, reused=False):
+    """
+    Decodes a photo once, writes the caption, publish and thumbnail variants next
+    to the original and computes its perceptual hash. Variants of an already
+    downloaded photo are reused.
+
+    Returns:
+        tuple: (variants, phash); empty/None if the image could not be processed.
+    """
+    try:
+        if reused:
+            variants = await ImageExecutor.run(existing_variants, file_path)
+        else:
+            variants = await ImageExecutor.run(store_variants, file_path)
+        phash = await ImageExecutor.run(image_phash, variants['caption'])
+        return variants, phash
+    except Exception as e:
+        Logger.error(f'Could not preprocess {file_path}: {e}')
+        return {}, None
+
+async def find_duplicate(phash, content_hash=None):
+    if DUPLICATE_CHECK == 'off':
+        return None
+    if content_hash is not None:
+        # Byte-identical copies are found by the hash computed during the download
+        duplicates = await DBExecutor.run(cache_call, find_posts_by_content_hash, content_hash) or []
+        if duplicates:
+            return duplicates[0]
+    if phash is None:
+        return None
+    duplicates = await DBExecutor.run(cache_call, Cache.find_near_duplicates, phash, DUPLICATE_DISTANCE) or []
+    return duplicates[0] if duplicates else None
+
+@update_context
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # If the chatter does not exist or is not verified, simply ignore; Still log their chat_id in the DB
     # but leave them unverified
     chat_id = update.effective_chat.id
-    if not is_chatter_verified_in_db(chat_id):
-        if not does_chatter_exists_in_db(chat_id):
+    if not Chatters.is_verified(chat_id):
+        if Chatters.allow_unverified(chat_id) and not Chatters.exists(chat_id):
             name = update.message.chat.first_name + '_' + update.message.chat.last_name
-            new_chatter_in_db(chat_id, name, False)
+            await DBExecutor.run(new_chatter_in_db, chat_id, name, False)
         return
 
+    # Photos of an album are processed together once the whole album arrived
+    if update.message.media_group_id is not None:
+        Albums.add(update.message)
+        return
+
+    timings = {}
+
     await update.message.reply_text("🖼️ Image received. Processing started...")
 
-    photo_file = await update.message.photo[-1].get_file()
-    image_name = f"{photo_file.file_id}.jpg"
-    file_path = os.path.join(DOWNLOAD_DIR, f"{image_name}")
-    await photo_file.download_to_drive(file_path)
-    Logger.info(f"Photo from telegram downloaded to {file_path}")
+    with timed_stage(timings, 'download'):
+        download = await download_photo(update.message)
+    image_name, file_path = download['image_name'], download['file_path']
+
+    with timed_stage(timings, 'preprocess'):
+        variants, phash = await prepare_photo(file_path, download['reused'])
+
+    dup = await find_duplicate(phash, download['content_hash'])
+    if dup is not None:
+        await update.message.reply_text(f"⚠️ Looks like a near-duplicate of post #{dup['id']} "
+                                        f"scheduled for {dup['schedule_time']}")
+        if DUPLICATE_CHECK == 'skip':
+            Logger.info(f"Skipping near-duplicate of post {dup['id']}")
+            return
 
     post_text = None
     caption = None
 
     try:
-        caption = generate_photo_caption(file_path)
+        with timed_stage(timings, 'caption'):
+            caption = await caption_for_image_async(variants.get('caption', file_path), phash)
         Logger.info(f"Caption for photo: {caption}")
         await update.message.reply_text(f"🧠 Caption: {caption}")
     except:
@@ -532,128 +1249,346 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         if caption is not None:
-            post_text = generate_post_content(caption)
-            Logger.info(f"Generated content for post!")
+            with timed_stage(timings, 'generate'):
+                post_text = await post_content_for_caption_async(caption)
+            Logger.info("Generated content for post!")
             await update.message.reply_text(f"👍 Post: {post_text}")
     except:
         Logger.error('Could generate post content with Gemini')
 
-    post_time = find_scheduling_time()
-    schedule_time = post_time.timestamp()
-    Logger.info(f"Scheduling Post for '{str(post_time)}'")
-
+    post_time = None
     try:
-        put_post_in_db(caption, post_text, post_time, image_name)
+        with timed_stage(timings, 'schedule'):
+            post_time = await DBExecutor.run(schedule_post, caption, post_text, image_name, phash,
+                                             download['file_unique_id'], download['content_hash'])
+        Logger.info(f"Scheduling Post for '{str(post_time)}'")
     except:
         Logger.error('Could save post to DB')
 
-    if post_text is not None and caption is not None:
+    Logger.info(f'Photo pipeline timings: {format_timings(timings)}')
+
+    if post_time is None:
+        await update.message.reply_text("❌ Could not save the post, please send the photo again.")
+    elif post_text is not None and caption is not None:
         Logger.info(f'FB/IG Post Scheduled for: {post_time}')
         await update.message.reply_text(f"✅ Done! FB/IG Post Scheduled for: {post_time}")
     else:
-        Logger.info(f'Something went wrong but the post should be in the DB')
-        await update.message.reply_text(f"❌ Something went wrong but will retry in some while.")
+        Logger.info('Something went wrong but the post should be in the DB')
+        await update.message.reply_text("❌ Something went wrong but will retry in some while.")
 
+
+def short(text, length=60):
+    text = ' '.join((text or '').split())
+    return text if len(text) <= length else text[:length - 1] + '…'
+
+async def handle_album(messages):
+    """
+    Processes all photos of an album together: concurrent downloads, batched
+    model calls, one slot reservation and one insert, and a single summary reply.
+    """
+    timings = {}
+    reply_to = messages[0]
+    lines = []
+
+    with timed_stage(timings, 'download'):
+        downloads = await asyncio.gather(*(download_photo(m) for m in messages), return_exceptions=True)
+    photos = []
+    for i, download in enumerate(downloads):
+        if isinstance(download, Exception):
+            Logger.error(f'Could not download album photo {i + 1}: {download}')
+            lines.append(f"❌ Photo {i + 1}: download failed")
+        else:
+            photos.append(dict(download, index=i + 1))
+
+    with timed_stage(timings, 'preprocess'):
+        prepared = await asyncio.gather(*(prepare_photo(photo['file_path'], photo['reused']) for photo in photos))
+    for photo, (variants, phash) in zip(photos, prepared):
+        photo['variants'], photo['phash'] = variants, phash
+
+    for photo in list(photos):
+        dup = await find_duplicate(photo['phash'], photo['content_hash'])
+        if dup is None:
+            continue
+        lines.append(f"⚠️ Photo {photo['index']}: near-duplicate of post #{dup['id']} scheduled for {dup['schedule_time']}")
+        if DUPLICATE_CHECK == 'skip':
+            Logger.info(f"Skipping near-duplicate of post {dup['id']}")
+            photos.remove(photo)
+
+    with timed_stage(timings, 'caption'):
+        captions = await asyncio.gather(*(caption_for_image_async(photo['variants'].get('caption', photo['file_path']),
+                                                                  photo['phash'])
+                                          for photo in photos), return_exceptions=True)
+    for photo, caption in zip(photos, captions):
+        if isinstance(caption, Exception):
+            Logger.error(f'Could generate post caption with Moondream: {caption}')
+            caption = None
+        photo['caption'] = caption
+        photo['text'] = None
+
+    captioned = [photo for photo in photos if photo['caption'] is not None]
+    if captioned:
+        with timed_stage(timings, 'generate'):
+            texts = await post_contents_for_captions_async([photo['caption'] for photo in captioned])
+        for photo, text in zip(captioned, texts):
+            photo['text'] = text
+
+    post_times = []
+    if photos:
+        try:
+            with timed_stage(timings, 'schedule'):
+                post_times = await DBExecutor.run(schedule_posts, photos)
+        except Exception as e:
+            Logger.error(f'Could save album posts to DB: {e}')
+
+    Logger.info(f'Album pipeline timings ({len(messages)} photos): {format_timings(timings)}')
+
+    if photos and not post_times:
+        lines.append("❌ Could not save the posts, please send the album again.")
+    for photo, post_time in zip(photos, post_times):
+        if photo['text'] is None:
+            lines.append(f"❌ Photo {photo['index']}: scheduled for {post_time}, but the text will be retried")
+        else:
+            lines.append(f"✅ Photo {photo['index']}: {post_time} — {short(photo['text'])}")
+
+    summary = f"🖼️ Album of {len(messages)} photos: {len(post_times)} scheduled"
+    await reply_to.reply_text('\n'.join([summary] + sorted(lines, key=lambda line: line[:1] != '✅')))
+
+# #(Albums)
+Albums = MediaGroupCollector(handle_album, delay=float(os.getenv("ALBUM_WAIT_SECONDS", "1.5")))
+
+@update_context
 async def handle_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     name = update.message.chat.first_name + '_' + update.message.chat.last_name
 
-    if not does_chatter_exists_in_db(chat_id):
+    if not Chatters.is_verified(chat_id) and not Chatters.allow_unverified(chat_id):
+        return
+
+    if not Chatters.exists(chat_id):
         Logger.info(f'New chatter wants to subscribe: {name}')
-        new_chatter_in_db(chat_id, name, True)
+        await DBExecutor.run(new_chatter_in_db, chat_id, name, True)
         await update.message.reply_text("🙋‍♂️ New user in db! Hello 👋!")
         await update.message.reply_text("You are now subscribed 👍")
     else:
         Logger.info(f'Chatter wants to subscribe: {name}')
-        subscribe_chatter_in_db(chat_id, True)
+        await DBExecutor.run(subscribe_chatter_in_db, chat_id, True)
         await update.message.reply_text("You are now subscribed 👍")
 
 
+@update_context
 async def handle_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     name = update.message.chat.first_name + '_' + update.message.chat.last_name
 
-    if not does_chatter_exists_in_db(chat_id):
+    if not Chatters.is_verified(chat_id) and not Chatters.allow_unverified(chat_id):
+        return
+
+    if not Chatters.exists(chat_id):
         Logger.info(f'New chatter wants to unsubscribe: {name}')
-        new_chatter_in_db(chat_id, name, False)
+        await DBExecutor.run(new_chatter_in_db, chat_id, name, False)
         await update.message.reply_text("🙋‍♂️ New user in db! Hello 👋!")
         await update.message.reply_text("You are now unsubscribed 👍")
     else:
         Logger.info(f'Chatter wants to unsubscribe: {name}')
-        subscribe_chatter_in_db(chat_id, False)
+        await DBExecutor.run(subscribe_chatter_in_db, chat_id, False)
         await update.message.reply_text("You are now unsubscribed 👍")
 
+@update_context
 async def handle_health_check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("😼 It's all gud boss!✔️")
 
+TelegramApp = None
+TelegramLoop = None
+TelegramRestart = threading.Event()
+
+async def on_telegram_started(app):
+    global TelegramLoop
+    TelegramLoop = asyncio.get_running_loop()
+
+def restart_telegram(changes):
+    """
+    Stops the polling bot so run_telegram starts it again with the new token.
+    """
+    if TelegramApp is None or TelegramLoop is None:
+        return
+    Logger.info('Telegram bot token changed, restarting the bot...')
+    TelegramRestart.set()
+    TelegramLoop.call_soon_threadsafe(TelegramApp.stop_running)
+
+CONFIG.subscribe(('TELEGRAM_BOT_TOKEN', ), restart_telegram)
+
 def run_telegram():
+    from telegram.ext import ApplicationBuilder, MessageHandler, filters, CommandHandler
+
+    global TelegramApp
+
     try:
         os.makedirs(DOWNLOAD_DIR)
     except OSError:
         pass
 
-    TelegramApp = ApplicationBuilder().token(CONFIG['TELEGRAM_BOT_TOKEN']).build()
-    TelegramApp.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    TelegramApp.add_handler(CommandHandler("subscribe", handle_subscribe))
-    TelegramApp.add_handler(CommandHandler("unsubscribe", handle_unsubscribe))
-    TelegramApp.add_handler(CommandHandler("health", handle_health_check))
+    while True:
+        TelegramRestart.clear()
+        builder = (ApplicationBuilder()
+                   .token(CONFIG['TELEGRAM_BOT_TOKEN'])
+                   .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+                   .post_init(on_telegram_started))
+        if TELEGRAM_API_URL:
+            builder = builder.base_url(TELEGRAM_API_URL)
+        TelegramApp = builder.build()
+        TelegramApp.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+        TelegramApp.add_handler(CommandHandler("subscribe", handle_subscribe))
+        TelegramApp.add_handler(CommandHandler("unsubscribe", handle_unsubscribe))
+        TelegramApp.add_handler(CommandHandler("health", handle_health_check))
+
+        Logger.info('Starting Telegram Bot...')
+        # The loop is kept open so the bot can be started again on it after a token change
+        TelegramApp.run_polling(close_loop=False)
+
+        if not TelegramRestart.is_set():
+            break
+
+    TelegramApp = None
+
+
+# A post that failed to publish is retried on that platform after this long
+POST_RETRY_SECONDS = int(os.getenv("POST_RETRY_SECONDS", str(15 * 60)))
+
+# The limiter buckets each publisher depends on; a paused bucket pauses only that platform
+PLATFORM_SERVICES = {
+    'fb': ('facebook', ),
+    'ig': ('imgur', 'instagram'),
+}
+
+def rate_limit_cause(e):
+    while e is not None:
+        if isinstance(e, RateLimited):
+            return e
+        e = e.__cause__
+    return None
 
-    Logger.info('Starting Telegram Bot...')
-    TelegramApp.run_polling()
+# How many posts are published at the same time on each platform
+PUBLISH_CONCURRENCY = {
+    'fb': int(os.getenv("FB_CONCURRENCY", "2")),
+    'ig': int(os.getenv("IG_CONCURRENCY", "2")),
+}
 
+PublishPools = {
+    platform: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'catozer-publish-{platform}')
+    for platform, workers in PUBLISH_CONCURRENCY.items()
+}
 
-last_posting_event_time = 0
-try_posting_interval_time = 60 * 60  # in seconds
+def publish_post_on_fb(post, send_tg_message):
+    text = post['text']
+    image_url = ImageStore.variant(post['image_name'], 'publish')
+    post_id = post['id']
 
-def post_pending(send_tg_message = True):
-    Logger.info('Polling..')
+    try:
+        post_on_fb(image_url, text)
+        Logger.info(f'Marking as posted on fb: {post_id}')
+        mark_as_fb_posted(post_id)
+        return True
+    except Exception as e:
+        limited = rate_limit_cause(e)
+        if limited is not None:
+            Logger.info(f'Facebook post {post_id} postponed: {limited}')
+            defer_post('fb', post_id, max(limited.retry_in, 60))
+            return False
+
+        Logger.error(f'Could not update fb post in DB: {e}', exc_info=True)
+        defer_post('fb', post_id, POST_RETRY_SECONDS)
+        if send_tg_message:
+            queue_alert('fb_failure', f'⛔ Problem! Could not update Facebook post in DB; Error: {e}',
+                        'Facebook failures')
+        return False
 
-    posts = get_not_posted_but_scheduled()
+def publish_post_on_ig(post, send_tg_message):
+    text = post['text']
+    image_url = ImageStore.variant(post['image_name'], 'publish')
+    post_id = post['id']
 
-    if not posts:
-        return
+    try:
+        post_on_ig(image_url, text)
+        Logger.info(f'Marking as posted on ig: {post_id}')
+        mark_as_ig_posted(post_id)
+        return True
+    except Exception as e:
+        limited = rate_limit_cause(e)
+        if limited is not None:
+            Logger.info(f'Instagram post {post_id} postponed: {limited}')
+            defer_post('ig', post_id, max(limited.retry_in, 60))
+            return False
+
+        Logger.error(f'Could not update ig post in DB: {e}', exc_info=True)
+        defer_post('ig', post_id, POST_RETRY_SECONDS)
+        if send_tg_message:
+            queue_alert('ig_failure', f'⛔ Problem! Could not update Instagram post in DB; Error: {e}',
+                        'Instagram failures')
+        return False
 
-    Logger.info(f"Pending posts: {len(posts)}")
+PUBLISHERS = {
+    'fb': publish_post_on_fb,
+    'ig': publish_post_on_ig,
+}
 
-    # Run the post logic only so often
-    now = datetime.now().timestamp()
-    global last_posting_event_time
-    if now - last_posting_event_time < try_posting_interval_time:
-        Logger.info(f"Rate limit: Skipping the special work this time")
-        return
-    last_posting_event_time = now
+def drain_platform(platform, send_tg_message):
+    """
+    Claims and publishes due posts on one platform one at a time until none are left.
 
-    for post in posts:
-        text = post['text']
-        image_url = os.path.join(DOWNLOAD_DIR, post['image_name'])
-        post_id = post['id']
+    Returns:
+        tuple: (published, failed) counts.
+    """
+    published = 0
+    failed = 0
+    while True:
+        paused = [service for service in PLATFORM_SERVICES[platform] if Limiter.is_paused(service)]
+        if paused:
+            Logger.info(f'Not publishing on {platform} while {", ".join(paused)} is rate limited')
+            return published, failed
+
+        posts = claim_due_posts(platform, limit=1)
+        if not posts:
+            return published, failed
+
+        with log_context(post_id=posts[0]['id'], platform=platform):
+            ok = PUBLISHERS[platform](posts[0], send_tg_message)
+        if ok:
+            published += 1
+        else:
+            failed += 1
 
-        if not post['posted_on_fb']:
-            try:
-                Logger.info(f'Marking as posted on fb:{post_id}')
-                # post_on_fb(image_url, text)
-                mark_as_fb_posted(post_id)
-            except Exception as e:
-                Logger.error(f'Could not update fb post in DB: {e}', exc_info=True)
-                if send_tg_message:
-                    send_chat_subs_message(f'⛔ Problem! Could not update Facebook post in DB; Error: {e}')
+def post_pending(send_tg_message = True):
+    Logger.info('Polling..')
+
+    # Every platform drains its due posts on its own pool, with PUBLISH_CONCURRENCY workers
+    # each; posts are claimed per platform so a slow, failing or rate limited platform does
+    # not hold up the other one. A failing post is deferred for POST_RETRY_SECONDS.
+    futures = {
+        platform: [PublishPools[platform].submit(drain_platform, platform, send_tg_message)
+                   for _ in range(workers)]
+        for platform, workers in PUBLISH_CONCURRENCY.items()
+    }
 
-        if not post['posted_on_ig']:
+    for platform, platform_futures in futures.items():
+        published = 0
+        failed = 0
+        for future in platform_futures:
             try:
-                post_on_ig(image_url, text)
-                Logger.info(f'Marking as posted on ig: {post_id}')
-                mark_as_ig_posted(post_id)
+                done, errors = future.result()
+                published += done
+                failed += errors
             except Exception as e:
-                Logger.error(f'Could not update ig post in DB: {e}', exc_info=True)
-                traceback.print_exc()
-                if send_tg_message:
-                    send_chat_subs_message(f'⛔ Problem! Could not update Instagram post in DB; Error: {e}')
+                Logger.error(f'Publishing on {platform} failed: {e}', exc_info=True)
+                failed += 1
+
+        if published or failed:
+            Logger.info(f'Publishing on {platform}: {published} posted, {failed} failed')
 
 def check_post_queue():
     Logger.info('Checking queue...')
     now = datetime.now().time()
     if not (time(9, 0) <= now <= time(23, 0)):
-        Logger.info(f'It\'s too eraly/late to notify chatters!')
+        Logger.info('It\'s too eraly/late to notify chatters!')
         return
 
     posts_in_queue = count_posts_in_queue()
@@ -664,152 +1599,104 @@ def check_post_queue():
     if not posts_in_queue < min_days_with_posts * posts_per_day:
         return
 
-    send_chat_subs_message(f'🚨 Post queue is getting low! Posts in queue left: {posts_in_queue}')
+    queue_alert('queue_low', f'🚨 Post queue is getting low! Posts in queue left: {posts_in_queue}',
+                'low queue warnings')
 
 def health_update():
-    send_chat_subs_message(f"😼 It's all gud boss!✔️")
-
-def run_server():
-    ServerApp.config['TEMPLATES_AUTO_RELOAD'] = True
-
-    ServerApp.run(ssl_context=('cert.pem', 'key.pem'), host='0.0.0.0', port=1313)
-
-@ServerApp.route("/")
-def index():
-    posts = get_all_posts()
-    days = {}
-    for post in posts:
-        day = post['schedule_time'].strftime("%d-%m-%Y")
-        if day not in days.keys():
-            days[day] = {}
-            days[day]['posts'] = []
-        days[day]['posts'].append(post)
-
-    return render_template('index.html', days=days)
-
-@ServerApp.route("/config")
-def config():
-    db_config = db_config_fields()
-
-    Imgur = ImgurClient(CONFIG['IMGUR_CLIENT_ID'], CONFIG['IMGUR_CLIENT_SECRET'])
-    imgur_link = Imgur.get_auth_url('pin')
-
-    return render_template('config.html', tokens=db_config,
-                           messages=[],
-                           imgur_link=imgur_link)
-
-@ServerApp.route("/api/ig_token")
-def api_ig_token():
-    app_id = "1038808407801073"
-    redirect = "https://localhost:1313/api/ig_token/callback"
-    perms = "instagram_business_basic,instagram_business_manage_messages,instagram_business_manage_comments,instagram_business_content_publish"
-    params = {
-        'client_id': app_id,
-        'redirect_uri': redirect,
-        'scope': perms,
-        'response_type': 'code',
-    }
-
-    auth_link = "https://www.instagram.com/oauth/authorize"
-    url = f"{auth_link}?client_id={app_id}&redirect_uri={redirect}&response_type=code&scope={perms}&code=1234"
-    url = f"{auth_link}?{urllib.parse.urlencode(params)}"
-
-    return flask.redirect(url, code=302)
+    send_chat_subs_message("😼 It's all gud boss!✔️")
 
-@ServerApp.route("/api/ig_token/callback")
-def api_ig_token_callback():
-    code = request.args.get('code')
-
-    redirect = "https://localhost:1313/api/ig_token/callback"
-    payload = {
-        'client_id': IG_CLIENT_ID,
-        'client_secret': IG_CLIENT_SECRET,
-        'grant_type': 'authorization_code',
-        'redirect_uri': redirect,
-        'code': code,
-    }
-    response = requests.post('https://api.instagram.com/oauth/access_token', data=payload)
-    response = response.json()
-    short_access_token = response['access_token']
-
-    redirect = "https://localhost:1313/api/ig_token/callback"
-    payload = {
-        'client_secret': IG_CLIENT_SECRET,
-        'grant_type': 'ig_exchange_token',
-        'access_token' : short_access_token
-    }
-
-    auth_link = 'https://graph.instagram.com/access_token'
-    url = f"{auth_link}?{urllib.parse.urlencode(payload)}"
-    response = requests.get(url)
-    response = response.json()
-    short_access_token = response['access_token']
-
-    update_config_field('IG_TOKEN', short_access_token)
-
-    return flask.redirect("/config", code=302)
-
-@ServerApp.route("/api/imgur_pin", methods=['POST'])
-def api_imgur_pin():
-    pin = request.form.get('pin')
-    print(pin)
-
-    Imgur = ImgurClient(CONFIG['IMGUR_CLIENT_ID'], CONFIG['IMGUR_CLIENT_SECRET'])
-
-    credentials = Imgur.authorize(pin, 'pin')
-    update_config_field('IMGUR_ACCESS_TOKEN', credentials['access_token'])
-    update_config_field('IMGUR_REFRESH_TOKEN', credentials['refresh_token'])
-    print(credentials)
-
-    return flask.redirect("/config", code=302)
+def shutdown():
+    """
+    Stops the background services in reverse order of their start and flushes pending messages.
+    """
+    Logger.info('Shutting down...')
+    for service in reversed(BackgroundServices):
+        try:
+            service.stop()
+        except Exception as e:
+            Logger.warning(f'Could not stop {service}: {e}')
 
-@ServerApp.route("/api/set_config/<key>", methods=['POST'])
-def api_set_config(key):
-    value = request.form.get('value')
-    update_config_field(key, value)
+    BotNotifier.stop()
+    Limiter.flush()
+    DBPool.close()
 
-    return flask.redirect("/config", code=302)
+    if PROFILER_ENABLED and Profiler.running:
+        with open(PROFILER_OUTPUT, 'w') as f:
+            f.write(Profiler.stop())
+        Logger.info(f'Wrote the profile to {PROFILER_OUTPUT}')
 
-@ServerApp.route("/api/regen/<post_id>", methods=['GET'])
-def api_regen_post(post_id):
+def regen_post(post_id):
+    """
+    Regenerates the caption and text of a post; runs on the job queue workers.
+    """
     post = get_post(post_id)
+    if post is None:
+        raise ValueError(f'Post {post_id} does not exist')
 
-    file_path = ServerApp.root_path + '/../downloads/' + post['image_name']
+    file_path = ImageStore.variant(post['image_name'], 'caption')
+    if file_path is None:
+        raise ValueError(f"Image {post['image_name']} of post {post_id} is gone")
     post_text = None
     caption = None
 
+    # The caption of the same image is reused from the cache; the post text is what
+    # regenerating is for, so a new one is always requested
     try:
-        caption = generate_photo_caption(file_path)
+        caption = caption_for_image(file_path)
         Logger.info(f"Caption for photo: {caption}")
     except:
         Logger.error('Could generate post caption with Moondream')
 
     try:
         if caption is not None:
-            post_text = generate_post_content(caption)
-            Logger.info(f"Generated content for post!")
+            post_text = post_content_for_caption(caption, refresh=True)
+            Logger.info("Generated content for post!")
     except Exception as e:
         Logger.error('Could generate post content with Gemini')
         Logger.error(e)
 
-    if caption is not None and post_text is not None:
-        update_post(post_id, caption, post_text)
+    if caption is None or post_text is None:
+        raise ValueError(f'Could not regenerate post {post_id}')
+
+    update_post(post_id, caption, post_text)
 
-    return flask.redirect("/", code=302)
+# Services started by main(), stopped by shutdown() in reverse order
+BackgroundServices = []
 
-@ServerApp.route("/images/<path:filename>")
-def images(filename):
-    return send_from_directory(ServerApp.root_path + '/../downloads/', filename)
+class SchedulerService:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def stop(self):
+        self.scheduler.shutdown(wait=False)
+
+# Logs how long startup took, which modules were slow to import and the peak memory
+# (run through catozer.py so the imports are measured too)
+STARTUP_REPORT = os.getenv("CATOZER_STARTUP_REPORT") == "1"
 
 def main():
+    """
+    Starts the roles selected on the command line:
+
+        post_pending    publish the due posts once and exit (for cron)
+        -no-telegram    do not run the bot
+        -no-web         do not serve the dashboard
+        -no-scheduler   do not publish posts or run the periodic jobs
+
+    Subsystems (and their libraries) of disabled roles are never loaded.
+    """
+    Logs.start()
+    ImageStore.prepare()
+    timings = {}
 
     noScheduler = False
     noTelegram = False
+    noWeb = False
+    postPending = False
 
     for arg in sys.argv[1:]:
         if arg == "post_pending":
-            post_pending()
-            return
+            postPending = True
 
         if arg == "-no-scheduler":
             noScheduler = True
@@ -817,18 +1704,93 @@ def main():
         if arg == "-no-telegram":
             noTelegram = True
 
-    threading.Thread(target=run_server, daemon=True).start()
+        if arg == "-no-web":
+            noWeb = True
 
-    poll_interval_seconds = 30
+    if PROFILER_ENABLED:
+        Profiler.start()
+
+    with timed_stage(timings, 'config'):
+        # The first DB connection is opened here
+        ensure_schema()
+        CONFIG.data
+        apply_log_levels(CONFIG)
+        Limiter.load()
+
+    if postPending:
+        with timed_stage(timings, 'post_pending'):
+            post_pending()
+            AlertOutbox.dispatch_once()
+            BotNotifier.flush()
+            Limiter.flush()
+        if STARTUP_REPORT:
+            Logger.info(startup_report(timings))
+        return
+
+    with timed_stage(timings, 'services'):
+        AlertOutbox.start()
+        BackgroundServices.append(AlertOutbox)
+
+        DBListener.on(JOBS_NOTIFY_CHANNEL, Jobs.wake)
+        DBListener.on(CHATTERS_NOTIFY_CHANNEL, Chatters.invalidate)
+        DBListener.on(CHATTERS_NOTIFY_CHANNEL, BotNotifier.invalidate_subscribers)
+        DBListener.on(CONFIG_NOTIFY_CHANNEL, CONFIG.reload)
+        DBListener.start()
+        BackgroundServices.append(DBListener)
+        Jobs.start()
+        BackgroundServices.append(Jobs)
+
+    retry_interval_seconds = 30
     if CATOZER_DEBUG:
-        poll_interval_seconds = 1
-    logging.getLogger('apscheduler').setLevel(logging.ERROR)
+        retry_interval_seconds = 1
 
     if not noScheduler:
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(post_pending, 'interval', seconds=poll_interval_seconds)
-        scheduler.add_job(check_post_queue, 'interval', hours=4)
-        scheduler.add_job(health_update, 'interval', hours=12)
-        scheduler.start()
+        with timed_stage(timings, 'scheduler'):
+            from apscheduler.schedulers.background import BackgroundScheduler
+            logging.getLogger('apscheduler').setLevel(logging.ERROR)
+
+            # Posts are published when they become due instead of polling every few seconds;
+            # changes to the posts table wake the dispatcher up through LISTEN/NOTIFY
+            dispatcher = DueDispatcher(get_pending_schedule, post_pending, retry_seconds=retry_interval_seconds)
+            DBListener.on(POSTS_NOTIFY_CHANNEL, dispatcher.wake)
+            DBListener.start()
+            dispatcher.start()
+            BackgroundServices.append(dispatcher)
+
+            from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_MISSED
+
+            scheduler = BackgroundScheduler()
+            scheduler.add_listener(observe_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED)
+            scheduler.add_job(check_post_queue, 'interval', hours=4)
+            scheduler.add_job(health_update, 'interval', hours=12)
+            scheduler.add_job(ImageStore.reindex)
+            scheduler.add_job(ImageStore.enforce_retention, 'interval', hours=STORAGE_RETENTION_HOURS)
+            scheduler.start()
+            BackgroundServices.append(SchedulerService(scheduler))
+
+    if not noWeb:
+        # Started last so it is the first service to stop
+        with timed_stage(timings, 'web'):
+            from catozer.web import WebService
+            web = WebService()
+            web.start()
+            BackgroundServices.append(web)
+
+    if not noTelegram:
+        with timed_stage(timings, 'telegram'):
+            Chatters.load()
+
+    if STARTUP_REPORT:
+        Logger.info(startup_report(timings))
+
+    if noTelegram:
+        # Without the bot (which handles SIGINT/SIGTERM itself) wait for a stop signal here
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        signal.signal(signal.SIGINT, lambda *_: stop.set())
+        stop.wait()
+    else:
+        run_telegram()
 
-    run_telegram()
+    # run_polling returns after SIGINT/SIGTERM
+    shutdown()
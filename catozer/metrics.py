@@ -0,0 +1,283 @@
+import asyncio
+import functools
+import logging
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+Logger = logging.getLogger(__name__)
+
+# Seconds; covers fast DB queries up to slow model and publishing calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for name, key, extra, value in self.samples():
+            lines.append(f'{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. With `fn` the value is computed when the
+    metrics are scraped; `fn` returns a number, or a dict of label tuple -> number.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        try:
+            value = self.fn()
+        except Exception as e:
+            Logger.warning(f'Could not compute {self.name}: {e}')
+            return []
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [(self.name, key, (), v) for key, v in value.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((f'{self.name}_bucket', key, (('le', _format_value(bound)), ), cumulative))
+                samples.append((f'{self.name}_sum', key, (), total))
+                samples.append((f'{self.name}_count', key, (), count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Collects metrics and renders them in the Prometheus text format.
+
+    Collectors run once at the start of every render and set gauges whose
+    values come from one shared query.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), fn=None):
+        return self._add(Gauge(name, help, labelnames, fn))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                Logger.warning(f'Could not collect {collect.__name__}: {e}')
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def timed(histogram, **labels):
+    """
+    Decorator recording the duration of every call (also of coroutines) into
+    `histogram`. A `fn` label, if the histogram has one, is the function name.
+    """
+    def decorator(fn):
+        call_labels = dict(labels)
+        if 'fn' in histogram.labelnames:
+            call_labels.setdefault('fn', fn.__name__)
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**call_labels):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**call_labels):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class Sampler:
+    """
+    Sampling profiler: a background thread records the stacks of all other
+    threads every `interval` seconds. `stop` returns them in the collapsed
+    format ("frame;frame;frame count") that flame graph tools read.
+
+    Sampling costs a few percent of CPU at the default interval, which is why
+    it only runs while switched on.
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._stacks = StackCounter()
+        self._thread = None
+        self._deadline = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    @property
+    def remaining(self):
+        """
+        Seconds until a timed run stops by itself; None if it is not running or not timed.
+        """
+        deadline = self._deadline
+        if self._thread is None or deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
+
+    def start(self, seconds=None):
+        """
+        Starts sampling; with `seconds` the sampler stops by itself after that long.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stacks = StackCounter()
+            self._deadline = None if seconds is None else time.monotonic() + seconds
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='catozer-sampler', daemon=True)
+            self._thread.start()
+        Logger.info(f'Sampling profiler started ({self.interval * 1000:.0f}ms interval)')
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stopping.set()
+            thread.join()
+            Logger.info('Sampling profiler stopped')
+        return self.collapsed()
+
+    def collapsed(self):
+        return '\n'.join(f'{stack} {count}' for stack, count in self._stacks.most_common()) + '\n'
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stopping.wait(self.interval):
+            if self._deadline is not None and time.monotonic() >= self._deadline:
+                break
+            names.update({thread.ident: thread.name for thread in threading.enumerate()})
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+
+        with self._lock:
+            if self._thread is threading.current_thread():
+                self._thread = None
+                Logger.info('Sampling profiler finished')
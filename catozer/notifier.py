@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import threading
+import time
+
+Logger = logging.getLogger(__name__)
+
+
+class Notifier:
+    """
+    Long-lived service that sends messages to the subscribed Telegram chats.
+
+    It owns one `Bot` (and with it one HTTP session) living on a dedicated
+    event loop thread. Messages are queued with `send` without blocking the
+    caller and are fanned out to all subscribers concurrently while keeping
+    below Telegram's global rate limit: every message takes a token of the
+    'telegram' bucket of the limiter, which also holds flood waits
+    (RetryAfter) across restarts.
+
+    Args:
+        token_getter (callable): Returns the current bot token; the bot is
+            rebuilt when the token changes.
+        subscribers_loader (callable): Blocking function returning the list
+            of subscriber chat ids.
+        max_concurrency (int): Upper bound of requests in flight at once.
+        limiter (RateLimiter): Shared limiter pacing the sends; a private one with
+            the default Telegram limit if not given.
+        base_url (str): Bot API URL the token is appended to (default: Telegram's).
+        max_wait (float): How long a message waits for the rate limit (e.g. a
+            flood wait) before it is given up for a chat.
+    """
+
+    def __init__(self, token_getter, subscribers_loader, max_concurrency=8, limiter=None, base_url=None,
+                 max_wait=15 * 60):
+        if limiter is None:
+            from catozer.ratelimit import RateLimiter, DEFAULT_LIMITS
+            limiter = RateLimiter(None, {'telegram': DEFAULT_LIMITS['telegram']})
+        self.limiter = limiter
+        self.base_url = base_url
+        self.token_getter = token_getter
+        self.subscribers_loader = subscribers_loader
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+
+        self._loop = None
+        self._thread = None
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+
+        self._bot = None
+        self._bot_token = None
+        self._semaphore = None
+
+        self._subscribers = None
+        self._subscribers_lock = threading.Lock()
+
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run_loop, name='catozer-notifier', daemon=True)
+            self._thread.start()
+        self._started.wait()
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._started.set()
+        self._loop.run_forever()
+
+    def send(self, msg):
+        """
+        Queues `msg` for all subscribers and returns immediately.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the number of chats the
+            message was delivered to.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self._broadcast(msg), self._loop)
+
+        with self._pending_lock:
+            self._pending.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+        if not future.cancelled() and future.exception() is not None:
+            Logger.error(f'Could not send bot message: {future.exception()}')
+
+    def flush(self, timeout=30):
+        """
+        Waits until all queued messages are sent (used before the process exits).
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._pending_lock:
+                pending = list(self._pending)
+            if not pending:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                pending[0].result(timeout=remaining)
+            except Exception:
+                pass
+
+    def invalidate_subscribers(self, payload=None):
+        """
+        Drops the cached subscriber list; called whenever a chat (un)subscribes, also
+        as LISTEN callback for chats edited directly in the DB.
+        """
+        with self._subscribers_lock:
+            self._subscribers = None
+
+    def _get_subscribers(self):
+        with self._subscribers_lock:
+            if self._subscribers is None:
+                self._subscribers = list(self.subscribers_loader())
+            return self._subscribers
+
+    async def _get_bot(self):
+        from telegram import Bot
+
+        token = self.token_getter()
+        if self._bot is None or token != self._bot_token:
+            if self._bot is not None:
+                await self._bot.shutdown()
+            bot = Bot(token) if self.base_url is None else Bot(token, base_url=self.base_url)
+            await bot.initialize()
+            self._bot = bot
+            self._bot_token = token
+        return self._bot
+
+    async def _send_one(self, bot, chat_id, msg):
+        from telegram.error import RetryAfter, TelegramError
+        from catozer.ratelimit import RateLimited
+
+        async with self._semaphore:
+            for _ in range(3):
+                try:
+                    await self.limiter.acquire_async('telegram', timeout=self.max_wait)
+                except RateLimited as e:
+                    Logger.error(f'Could not send bot message to {chat_id}: {e}')
+                    return False
+                try:
+                    await bot.send_message(chat_id=chat_id, text=msg)
+                    return True
+                except RetryAfter as e:
+                    retry_after = e.retry_after
+                    if not isinstance(retry_after, (int, float)):
+                        retry_after = retry_after.total_seconds()
+                    Logger.warning(f'Telegram asked to slow down for {retry_after}s')
+                    # The next acquire waits until the pause is over
+                    self.limiter.pause('telegram', retry_after, '(RetryAfter)')
+                except TelegramError as e:
+                    Logger.error(f'Could not send bot message to {chat_id}: {e}')
+                    return False
+        return False
+
+    async def _broadcast(self, msg):
+        Logger.info(f'Sending bot message: {msg}')
+        bot = await self._get_bot()
+        subs = await self._loop.run_in_executor(None, self._get_subscribers)
+        results = await asyncio.gather(*[self._send_one(bot, chat_id, msg) for chat_id in subs])
+        delivered = sum(1 for sent in results if sent)
+        if subs and not delivered:
+            raise RuntimeError(f'Message could not be delivered to any of the {len(subs)} subscribers')
+        return delivered
+
+    def stop(self, timeout=10):
+        if self._loop is None:
+            return
+        self.flush(timeout)
+
+        async def shutdown():
+            if self._bot is not None:
+                await self._bot.shutdown()
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
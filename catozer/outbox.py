@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+Logger = logging.getLogger(__name__)
+
+OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id SERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    label TEXT,
+    message TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMPTZ,
+    gave_up BOOLEAN NOT NULL DEFAULT false,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS notification_outbox_pending_idx
+    ON notification_outbox (next_attempt_at) WHERE sent_at IS NULL AND NOT gave_up;
+CREATE INDEX IF NOT EXISTS notification_outbox_sent_idx
+    ON notification_outbox (kind, sent_at) WHERE sent_at IS NOT NULL;
+"""
+
+
+class Outbox:
+    """
+    Postgres backed queue of subscriber notifications.
+
+    Producers only insert a row, so they never wait on Telegram. A background
+    dispatcher sends the rows, coalescing alerts of the same kind that pile up
+    within `coalesce_seconds` into a single digest, and retries failed sends
+    with exponential backoff. The window starts at the last delivery recorded
+    in the table, so it holds across restarts and one-shot runs. Sent and
+    given up rows are deleted after `retention_seconds`.
+
+    Args:
+        pool (ConnectionPool): Pool used for all outbox queries.
+        sender (callable): Blocking function delivering one message; raises on failure.
+        coalesce_seconds (int): Window in which alerts of one kind are merged.
+        poll_seconds (int): How often the dispatcher looks for work when idle.
+        max_attempts (int): Attempts after which a message is given up.
+        retention_seconds (int): How long sent and given up rows are kept; at least one window.
+    """
+
+    CLAIM_SECONDS = 300
+    MAX_BACKOFF_SECONDS = 60 * 60
+    PURGE_INTERVAL_SECONDS = 60 * 60
+
+    def __init__(self, pool, sender, coalesce_seconds=600, poll_seconds=10, max_attempts=8,
+                 retention_seconds=7 * 24 * 60 * 60):
+        self.pool = pool
+        self.sender = sender
+        self.coalesce_seconds = coalesce_seconds
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        # The coalescing window is read from sent rows, so they must outlive it
+        self.retention_seconds = max(retention_seconds, coalesce_seconds)
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._next_purge = 0
+
+    def enqueue(self, kind, message, label=None):
+        """
+        Stores a notification for later delivery.
+
+        Args:
+            kind (str): Alerts with the same kind are coalesced together.
+            message (str): Text sent when the alert goes out alone.
+            label (str): Plural description used in digests, e.g. "Instagram failures".
+        """
+        with self.pool.cursor() as cur:
+            cur.execute("INSERT INTO notification_outbox (kind, label, message) VALUES (%s, %s, %s)",
+                        (kind, label, message))
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='catozer-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.dispatch_once()
+            except Exception as e:
+                Logger.error(f'Outbox dispatch failed: {e}', exc_info=True)
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+
+    def _is_due(self, rows, last_sent, now):
+        if last_sent is None or (now - last_sent).total_seconds() >= self.coalesce_seconds:
+            return True
+        # Do not hold an alert back for longer than one window
+        oldest = min(row['created_at'] for row in rows)
+        return (now - oldest).total_seconds() >= self.coalesce_seconds
+
+    def _claim(self):
+        now = datetime.now(timezone.utc)
+        with self.pool.cursor(dict_rows=True) as cur:
+            cur.execute("""
+            SELECT id, kind, label, message, created_at, attempts FROM notification_outbox
+            WHERE sent_at IS NULL AND NOT gave_up AND next_attempt_at <= NOW()
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            """)
+            rows = cur.fetchall()
+
+            groups = OrderedDict()
+            for row in rows:
+                groups.setdefault(row['kind'], []).append(row)
+
+            last_sent = {}
+            if groups:
+                cur.execute("""
+                SELECT kind, MAX(sent_at) AS sent_at FROM notification_outbox
+                WHERE sent_at IS NOT NULL AND kind = ANY(%s)
+                GROUP BY kind
+                """, (list(groups), ))
+                last_sent = {row['kind']: row['sent_at'] for row in cur.fetchall()}
+
+            groups = OrderedDict((kind, group) for kind, group in groups.items()
+                                 if self._is_due(group, last_sent.get(kind), now))
+            ids = [row['id'] for group in groups.values() for row in group]
+            if ids:
+                cur.execute("""
+                UPDATE notification_outbox
+                SET attempts = attempts + 1, next_attempt_at = NOW() + %s * INTERVAL '1 second'
+                WHERE id = ANY(%s)
+                """, (self.CLAIM_SECONDS, ids))
+
+        return groups
+
+    def _digest(self, rows):
+        if len(rows) == 1:
+            return rows[0]['message']
+
+        label = rows[-1]['label'] or f"'{rows[-1]['kind']}' alerts"
+        span = (rows[-1]['created_at'] - rows[0]['created_at']).total_seconds()
+        minutes = max(1, round(max(span, self.coalesce_seconds) / 60))
+        return f"⛔ {len(rows)} {label} in the last {minutes} min. Latest: {rows[-1]['message']}"
+
+    def dispatch_once(self):
+        """
+        Sends everything that is due. Returns the number of messages delivered.
+        """
+        if time.monotonic() >= self._next_purge:
+            self.purge()
+            self._next_purge = time.monotonic() + self.PURGE_INTERVAL_SECONDS
+
+        delivered = 0
+        for kind, rows in self._claim().items():
+            ids = [row['id'] for row in rows]
+            try:
+                self.sender(self._digest(rows))
+            except Exception as e:
+                Logger.warning(f'Could not deliver {len(ids)} {kind} notification(s): {e}')
+                self._reschedule(rows, e)
+                continue
+
+            with self.pool.cursor() as cur:
+                cur.execute("UPDATE notification_outbox SET sent_at = NOW(), last_error = NULL WHERE id = ANY(%s)",
+                            (ids, ))
+            delivered += 1
+
+        return delivered
+
+    def purge(self):
+        """
+        Deletes sent and given up rows older than `retention_seconds`. Returns how many.
+        """
+        with self.pool.cursor() as cur:
+            cur.execute("""
+            DELETE FROM notification_outbox
+            WHERE sent_at < NOW() - %(retention)s * INTERVAL '1 second'
+               OR (gave_up AND created_at < NOW() - %(retention)s * INTERVAL '1 second')
+            """, {'retention': self.retention_seconds})
+            deleted = cur.rowcount
+        if deleted:
+            Logger.info(f'Deleted {deleted} old outbox rows')
+        return deleted
+
+    def _reschedule(self, rows, error):
+        with self.pool.cursor() as cur:
+            for row in rows:
+                attempts = row['attempts'] + 1
+                backoff = min(30 * 2 ** (attempts - 1), self.MAX_BACKOFF_SECONDS)
+                cur.execute("""
+                UPDATE notification_outbox
+                SET next_attempt_at = NOW() + %s * INTERVAL '1 second', last_error = %s, gave_up = %s
+                WHERE id = %s
+                """, (backoff, str(error), attempts >= self.max_attempts, row['id']))
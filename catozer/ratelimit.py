@@ -0,0 +1,343 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+Logger = logging.getLogger(__name__)
+
+RATE_LIMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    platform TEXT PRIMARY KEY,
+    tokens DOUBLE PRECISION NOT NULL,
+    paused_until DOUBLE PRECISION NOT NULL DEFAULT 0,
+    updated_at DOUBLE PRECISION NOT NULL
+);
+"""
+
+# platform -> (requests, per seconds); the bucket holds at most `requests` tokens
+DEFAULT_LIMITS = {
+    'facebook': (200, 60 * 60),
+    'instagram': (200, 60 * 60),
+    'imgur': (50, 60 * 60),
+    # Telegram allows about 30 messages per second over all chats
+    'telegram': (25, 1),
+    'gemini': (15, 60),
+    'moondream': (60, 60),
+}
+
+# Graph API error codes that mean "slow down"
+GRAPH_THROTTLE_CODES = {4, 17, 32, 613} | set(range(80001, 80015))
+
+# Pause used when a platform throttles us without saying for how long
+DEFAULT_PAUSE_SECONDS = 15 * 60
+
+
+class RateLimited(Exception):
+    def __init__(self, platform, retry_in):
+        super().__init__(f'{platform} is rate limited for another {retry_in:.0f}s')
+        self.platform = platform
+        self.retry_in = retry_in
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `capacity` tokens, refilled at `rate` tokens per second.
+    The bucket can additionally be paused until a wall clock time.
+    """
+
+    def __init__(self, capacity, rate, tokens=None, updated_at=None, paused_until=0):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity if tokens is None else min(tokens, capacity)
+        self.updated_at = time.time() if updated_at is None else updated_at
+        self.paused_until = paused_until
+
+    def _refill(self, now):
+        elapsed = max(0, now - self.updated_at)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, n=1):
+        """
+        Seconds until `n` tokens are available (0 if they are available now).
+        """
+        now = time.time()
+        self._refill(now)
+        if self.paused_until > now:
+            return self.paused_until - now
+        if self.tokens >= n:
+            return 0
+        return (n - self.tokens) / self.rate
+
+    def try_acquire(self, n=1):
+        if self.wait_time(n) > 0:
+            return False
+        self.tokens -= n
+        return True
+
+    def release(self, n=1):
+        self.tokens = min(self.capacity, self.tokens + n)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def drain(self, fraction):
+        self._refill(time.time())
+        self.tokens *= (1 - fraction)
+
+
+class RateLimiter:
+    """
+    Per platform token buckets shared by all outbound integrations.
+
+    Besides the configured budget, the limiter learns from responses: rate
+    limit headers, HTTP 429 and throttling error payloads pause only the
+    platform they came from. State is persisted so restarts keep budgets;
+    the writes happen on a background thread, so acquiring a token never
+    waits on the DB, even on an event loop.
+
+    Args:
+        pool (ConnectionPool): Used to persist the buckets; may be None.
+        limits (dict): platform -> (requests, per seconds).
+        persist_seconds (float): Minimum time between persisting token counts.
+    """
+
+    def __init__(self, pool, limits=None, persist_seconds=30):
+        self.pool = pool
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.persist_seconds = persist_seconds
+
+        self._lock = threading.Lock()
+        self._buckets = {name: TokenBucket(count, count / seconds) for name, (count, seconds) in self.limits.items()}
+        self._persisted_at = 0
+        self._dirty = threading.Event()
+        self._writer = None
+
+    @staticmethod
+    def parse_limits(env):
+        """
+        Reads overrides like `RATE_LIMIT_INSTAGRAM=25/86400` from a mapping.
+        """
+        limits = dict(DEFAULT_LIMITS)
+        for name in list(limits.keys()):
+            value = env.get(f'RATE_LIMIT_{name.upper()}')
+            if not value:
+                continue
+            try:
+                count, seconds = value.split('/')
+                limits[name] = (float(count), float(seconds))
+            except ValueError:
+                Logger.error(f'Invalid rate limit for {name}: {value}')
+        return limits
+
+    def bucket(self, platform):
+        return self._buckets[platform]
+
+    def load(self):
+        if self.pool is None:
+            return
+        with self.pool.cursor(dict_rows=True) as cur:
+            cur.execute("SELECT platform, tokens, paused_until, updated_at FROM rate_limits")
+            rows = cur.fetchall()
+
+        with self._lock:
+            for row in rows:
+                bucket = self._buckets.get(row['platform'])
+                if bucket is None:
+                    continue
+                self._buckets[row['platform']] = TokenBucket(bucket.capacity, bucket.rate,
+                                                             tokens=row['tokens'],
+                                                             updated_at=row['updated_at'],
+                                                             paused_until=row['paused_until'])
+
+    def persist(self, force=False):
+        """
+        Has the writer thread save the buckets, at most every `persist_seconds` unless `force`d.
+        """
+        if self.pool is None:
+            return
+        now = time.time()
+        if not force and now - self._persisted_at < self.persist_seconds:
+            return
+        self._persisted_at = now
+
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='catozer-ratelimit', daemon=True)
+                self._writer.start()
+        self._dirty.set()
+
+    def _write_loop(self):
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Saves the buckets now; blocks on the DB.
+        """
+        if self.pool is None:
+            return
+        with self._lock:
+            rows = [(name, b.tokens, b.paused_until, b.updated_at) for name, b in self._buckets.items()]
+
+        try:
+            with self.pool.cursor() as cur:
+                for row in rows:
+                    cur.execute("""
+                    INSERT INTO rate_limits (platform, tokens, paused_until, updated_at) VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (platform) DO UPDATE
+                    SET tokens = EXCLUDED.tokens, paused_until = EXCLUDED.paused_until, updated_at = EXCLUDED.updated_at
+                    """, row)
+        except Exception as e:
+            Logger.warning(f'Could not persist rate limits: {e}')
+
+    def wait_time(self, platform):
+        with self._lock:
+            return self._buckets[platform].wait_time()
+
+    def is_paused(self, platform):
+        with self._lock:
+            return self._buckets[platform].paused_until > time.time()
+
+    def acquire(self, platform, timeout=0, n=1):
+        """
+        Takes `n` tokens for `platform` (e.g. all calls of one operation at once),
+        waiting up to `timeout` seconds. `n` is capped at the bucket's capacity.
+
+        Raises:
+            RateLimited: No token became available in time.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                bucket = self._buckets[platform]
+                if bucket.try_acquire(min(n, bucket.capacity)):
+                    break
+                wait = bucket.wait_time(min(n, bucket.capacity))
+
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(platform, wait)
+            time.sleep(wait)
+
+        self.persist()
+
+    async def acquire_async(self, platform, timeout=0, n=1):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                bucket = self._buckets[platform]
+                if bucket.try_acquire(min(n, bucket.capacity)):
+                    break
+                wait = bucket.wait_time(min(n, bucket.capacity))
+
+            if time.monotonic() + wait > deadline:
+                raise RateLimited(platform, wait)
+            await asyncio.sleep(wait)
+
+        self.persist()
+
+    def release(self, platform, n=1):
+        """
+        Gives back tokens that were acquired for calls that were not made.
+        """
+        with self._lock:
+            self._buckets[platform].release(n)
+
+    def pause(self, platform, seconds, reason=''):
+        Logger.warning(f'Pausing {platform} for {seconds:.0f}s {reason}'.strip())
+        with self._lock:
+            self._buckets[platform].pause(seconds)
+        self.persist(force=True)
+
+    def observe_headers(self, platform, headers):
+        """
+        Learns from the rate limit headers of a Facebook/Instagram Graph response.
+        """
+        usage = 0
+        regain_minutes = 0
+        for header in ('x-app-usage', 'x-business-use-case-usage', 'x-ad-account-usage'):
+            value = headers.get(header) if headers else None
+            if not value:
+                continue
+            try:
+                data = json.loads(value)
+            except ValueError:
+                continue
+
+            # x-business-use-case-usage maps business ids to lists of usage dicts
+            entries = [data]
+            if header == 'x-business-use-case-usage':
+                entries = [entry for values in data.values() for entry in values]
+
+            for entry in entries:
+                for key, percent in entry.items():
+                    if key == 'estimated_time_to_regain_access':
+                        regain_minutes = max(regain_minutes, percent or 0)
+                    elif isinstance(percent, (int, float)):
+                        usage = max(usage, percent)
+
+        if regain_minutes:
+            self.pause(platform, regain_minutes * 60, '(estimated_time_to_regain_access)')
+        elif usage >= 95:
+            self.pause(platform, DEFAULT_PAUSE_SECONDS, f'(usage at {usage}%)')
+        elif usage >= 75:
+            with self._lock:
+                self._buckets[platform].drain(0.5)
+
+    def observe_response(self, platform, status_code, headers=None, payload=None):
+        """
+        Learns from an HTTP response: Retry-After, 429, usage headers and
+        Graph API throttling error codes.
+        """
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        self.observe_headers(platform, headers)
+
+        retry_after = headers.get('retry-after')
+        if status_code == 429 or retry_after:
+            try:
+                seconds = float(retry_after)
+            except (TypeError, ValueError):
+                seconds = DEFAULT_PAUSE_SECONDS
+            self.pause(platform, seconds, f'(HTTP {status_code})')
+            return
+
+        if isinstance(payload, dict) and isinstance(payload.get('error'), dict):
+            self.observe_error_code(platform, payload['error'].get('code'))
+
+    def observe_error_code(self, platform, code):
+        if code in GRAPH_THROTTLE_CODES:
+            self.pause(platform, DEFAULT_PAUSE_SECONDS, f'(error code {code})')
+
+    def observe_exception(self, platform, e):
+        """
+        Pauses a platform when a client library surfaced throttling as an exception.
+        """
+        code = getattr(e, 'code', None)
+        if code == 429 or 'RESOURCE_EXHAUSTED' in str(e) or '429' in str(e):
+            self.pause(platform, DEFAULT_PAUSE_SECONDS, '(throttled)')
+            return
+        self.observe_error_code(platform, code)
+
+    def observe_imgur_credits(self, credits):
+        """
+        Learns from the credits imgurpython records after each request.
+        """
+        if not credits:
+            return
+        for remaining_key, reset_key in (('UserRemaining', 'UserReset'), ('ClientRemaining', None)):
+            remaining = credits.get(remaining_key)
+            if remaining is None:
+                continue
+            try:
+                remaining = int(remaining)
+            except (TypeError, ValueError):
+                continue
+            if remaining > 0:
+                continue
+            seconds = DEFAULT_PAUSE_SECONDS
+            if reset_key and credits.get(reset_key):
+                seconds = max(60, int(credits[reset_key]) - time.time())
+            self.pause('imgur', seconds, f'({remaining_key} exhausted)')
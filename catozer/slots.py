@@ -0,0 +1,163 @@
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta, time
+
+Logger = logging.getLogger(__name__)
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+# The posts table is the source of truth for taken slots; two posts can not share one.
+# Existing duplicates have to be rescheduled by hand, the schema is not applied until then
+SLOTS_SCHEMA = """
+DO $$
+BEGIN
+    CREATE UNIQUE INDEX IF NOT EXISTS posts_schedule_time_unique ON posts (schedule_time);
+EXCEPTION WHEN unique_violation THEN
+    RAISE EXCEPTION 'Several posts share a schedule_time, reschedule them before starting: %',
+        (SELECT string_agg(schedule_time::text, ', ') FROM (
+            SELECT schedule_time FROM posts GROUP BY schedule_time HAVING COUNT(*) > 1 LIMIT 10) d);
+END $$;
+"""
+
+
+class SlotTaken(Exception):
+    """
+    Raised when a reserved slot turns out to be held by another post.
+    """
+
+
+def _parse_time(value):
+    value = value.strip()
+    if ':' in value:
+        hour, minute = value.split(':')
+        return time(hour=int(hour), minute=int(minute))
+    return time(hour=int(value))
+
+
+def parse_slot_times(spec):
+    """
+    Parses the posting times per weekday.
+
+    The spec is a `;` separated list; an entry without a weekday sets the
+    default for all days, e.g. `10,18;sat=11,15:30;sun=` posts at 10:00 and
+    18:00, on Saturdays at 11:00 and 15:30 and never on Sundays.
+
+    Returns:
+        dict: weekday index (0 = Monday) -> sorted list of `time`.
+    """
+    default = []
+    per_day = {}
+    for entry in spec.split(';'):
+        entry = entry.strip()
+        if not entry:
+            continue
+        if '=' in entry:
+            day, times = entry.split('=', 1)
+            day = WEEKDAYS.index(day.strip().lower()[:3])
+            per_day[day] = sorted(_parse_time(t) for t in times.split(',') if t.strip())
+        else:
+            default = sorted(_parse_time(t) for t in entry.split(',') if t.strip())
+
+    return {day: per_day.get(day, default) for day in range(7)}
+
+
+class SlotAllocator:
+    """
+    Hands out free posting slots.
+
+    All slots of the next `horizon_days` are precomputed into a min-heap; taken
+    slots are skipped lazily, so finding the next free slot is O(log n)
+    instead of walking the calendar day by day.
+
+    Args:
+        times_by_weekday (dict): See `parse_slot_times`.
+        load_taken (callable): Returns the datetimes of already scheduled posts.
+        horizon_days (int): How many days are precomputed at once.
+        reload_seconds (float): Taken slots are reloaded from the DB after this long.
+    """
+
+    def __init__(self, times_by_weekday, load_taken, horizon_days=90, reload_seconds=60 * 60):
+        if not any(times_by_weekday.values()):
+            raise ValueError('At least one posting time has to be configured')
+
+        self.times_by_weekday = times_by_weekday
+        self.load_taken = load_taken
+        self.horizon_days = horizon_days
+        self.reload_seconds = reload_seconds
+
+        self._lock = threading.Lock()
+        self._taken = set()
+        self._heap = []
+        self._until = None
+        self._loaded_at = None
+
+    def _slots_of_day(self, day):
+        return [datetime.combine(day, t) for t in self.times_by_weekday[day.weekday()]]
+
+    def _extend(self, until):
+        day = self._until
+        while day < until:
+            for slot in self._slots_of_day(day):
+                if slot not in self._taken:
+                    heapq.heappush(self._heap, slot)
+            day += timedelta(days=1)
+        self._until = until
+
+    def _reload(self, now):
+        self._taken = {t.replace(tzinfo=None, second=0, microsecond=0) for t in self.load_taken()}
+        self._heap = []
+        self._until = now.date()
+        self._extend(now.date() + timedelta(days=self.horizon_days))
+        self._loaded_at = now
+
+    def _ensure_loaded(self, now):
+        if self._loaded_at is None or (now - self._loaded_at).total_seconds() > self.reload_seconds:
+            self._reload(now)
+
+    def _pop_free(self, now):
+        while True:
+            if not self._heap:
+                self._extend(self._until + timedelta(days=self.horizon_days))
+                continue
+            slot = heapq.heappop(self._heap)
+            if slot >= now and slot not in self._taken:
+                return slot
+
+    def reserve(self, now=None):
+        """
+        Takes the next free future slot out of the calendar.
+        """
+        return self.reserve_many(1, now)[0]
+
+    def reserve_many(self, n, now=None):
+        now = now or datetime.now()
+        with self._lock:
+            self._ensure_loaded(now)
+            slots = [self._pop_free(now) for _ in range(n)]
+            self._taken.update(slots)
+            return slots
+
+    def peek(self, now=None):
+        """
+        The next free slot without reserving it.
+        """
+        now = now or datetime.now()
+        with self._lock:
+            self._ensure_loaded(now)
+            slot = self._pop_free(now)
+            heapq.heappush(self._heap, slot)
+            return slot
+
+    def release(self, slot):
+        """
+        Gives back a reserved slot that ended up unused.
+        """
+        with self._lock:
+            self._taken.discard(slot)
+            if self._until is None or slot.date() < self._until:
+                heapq.heappush(self._heap, slot)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
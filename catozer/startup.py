@@ -0,0 +1,129 @@
+import importlib.abc
+import logging
+import sys
+import threading
+import time
+
+Logger = logging.getLogger(__name__)
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+class _TimedLoader:
+    def __init__(self, timer, name, loader):
+        self._timer = timer
+        self._name = name
+        self._loader = loader
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer._enter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer._exit(self._name)
+
+    def __getattr__(self, name):
+        # Everything else (get_resource_reader, is_package, ...) is the wrapped loader's
+        return getattr(self._loader, name)
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """
+    Records how long every module takes to import, like `python -X importtime`
+    but readable from inside the process for the startup report.
+
+    Install it before the imports that should be measured (see catozer.py).
+    """
+
+    def __init__(self):
+        self.times = {}
+        self._stack = []
+        self._finding = threading.local()
+
+    @classmethod
+    def install(cls):
+        timer = cls()
+        sys.meta_path.insert(0, timer)
+        return timer
+
+    @classmethod
+    def installed(cls):
+        return next((finder for finder in sys.meta_path if isinstance(finder, cls)), None)
+
+    def find_spec(self, fullname, path, target=None):
+        if getattr(self._finding, 'active', False):
+            return None
+
+        self._finding.active = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._finding.active = False
+
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+            spec.loader = _TimedLoader(self, fullname, spec.loader)
+        return spec
+
+    def _enter(self):
+        self._stack.append([time.perf_counter(), 0.0])
+
+    def _exit(self, name):
+        started, children = self._stack.pop()
+        elapsed = time.perf_counter() - started
+        self.times[name] = (elapsed - children, elapsed)
+        if self._stack:
+            self._stack[-1][1] += elapsed
+
+    def top(self, n=15):
+        """
+        The `n` slowest top-level packages as (name, cumulative seconds), and the total.
+        """
+        packages = {}
+        for name, (own, _) in self.times.items():
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + own
+        total = sum(packages.values())
+        return sorted(packages.items(), key=lambda item: -item[1])[:n], total
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def startup_report(timings, n=15):
+    """
+    Startup phases, the slowest imports (if an `ImportTimer` is installed) and
+    the peak memory, as text for the log.
+    """
+    lines = ['Startup report:']
+    for stage, ms in timings.items():
+        lines.append(f'  {stage:<24} {ms:8.1f} ms')
+
+    timer = ImportTimer.installed()
+    if timer is not None:
+        packages, total = timer.top(n)
+        lines.append(f'  imports (total)          {total * 1000:8.1f} ms')
+        for package, seconds in packages:
+            lines.append(f'    {package:<22} {seconds * 1000:8.1f} ms')
+
+    memory = peak_memory_mb()
+    if memory is not None:
+        lines.append(f'  peak memory              {memory:8.1f} MiB')
+    return '\n'.join(lines)
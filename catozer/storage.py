@@ -0,0 +1,319 @@
+import logging
+import os
+
+from catozer.images import ensure_variant, variant_name, VARIANTS
+
+Logger = logging.getLogger(__name__)
+
+STORAGE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    original TEXT,
+    size BIGINT NOT NULL DEFAULT 0,
+    content_hash TEXT,
+    backend TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    deleted_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS files_original_idx ON files (original);
+CREATE INDEX IF NOT EXISTS files_retention_idx ON files (created_at) WHERE kind = 'original' AND deleted_at IS NULL;
+"""
+
+# Variants used in place of a removed original, best first
+FALLBACK_VARIANTS = ('publish', ) + tuple(v for v in reversed(VARIANTS) if v.startswith('thumb')) + ('caption', )
+
+
+def check_name(name):
+    # Names come from URLs; only plain file names are stored
+    if not name or name != os.path.basename(name) or name.startswith('.'):
+        raise ValueError(f'Invalid file name: {name!r}')
+    return name
+
+
+class LocalBackend:
+    """
+    Keeps files in a local directory.
+    """
+
+    name = 'local'
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+
+    def prepare(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def local_path(self, name):
+        return os.path.join(self.directory, check_name(name))
+
+    def fetch(self, name):
+        """
+        Local path of a stored file, or None if it is not stored.
+        """
+        path = self.local_path(name)
+        return path if os.path.isfile(path) else None
+
+    def store(self, name, path):
+        target = self.local_path(name)
+        if os.path.abspath(path) != target:
+            os.replace(path, target)
+        return os.path.getsize(target)
+
+    def delete(self, name):
+        try:
+            os.remove(self.local_path(name))
+        except FileNotFoundError:
+            pass
+
+    def listing(self):
+        """
+        Stored files as name -> size in bytes.
+        """
+        listing = {}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path) and not name.endswith(('.tmp', '.part')):
+                listing[name] = os.path.getsize(path)
+        return listing
+
+
+class S3Backend(LocalBackend):
+    """
+    Keeps files in an S3-compatible bucket (AWS, MinIO, ...) with the local
+    directory as a read-through cache, since images are decoded and served
+    from disk.
+
+    Requires `boto3`. Any service speaking the S3 API can stand in for S3 by
+    pointing `endpoint_url` at it.
+    """
+
+    name = 's3'
+
+    def __init__(self, directory, bucket, prefix='', endpoint_url=None, client=None):
+        super().__init__(directory)
+        self.bucket = bucket
+        self.prefix = prefix
+        if client is None:
+            try:
+                import boto3
+            except ImportError as e:
+                raise RuntimeError('STORAGE_BACKEND=s3 needs boto3 to be installed') from e
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.client = client
+
+    def key(self, name):
+        return f'{self.prefix}{check_name(name)}'
+
+    def fetch(self, name):
+        path = super().fetch(name)
+        if path is not None:
+            return path
+
+        path = self.local_path(name)
+        tmp_path = f'{path}.part'
+        try:
+            self.client.download_file(self.bucket, self.key(name), tmp_path)
+        except Exception as e:
+            Logger.info(f'{name} is not in bucket {self.bucket}: {e}')
+            return None
+        os.replace(tmp_path, path)
+        return path
+
+    def store(self, name, path):
+        size = super().store(name, path)
+        self.client.upload_file(self.local_path(name), self.bucket, self.key(name))
+        return size
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        super().delete(name)
+
+    def listing(self):
+        # The bucket is the source of truth; the local cache may hold only some of the files
+        listing = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            listing.update((obj['Key'][len(self.prefix):], obj['Size']) for obj in page.get('Contents', []))
+        return listing
+
+
+class Storage:
+    """
+    Stores the downloaded originals and their derived variants.
+
+    Every stored file is indexed in the `files` table, so lookups and the
+    retention pass work from the index instead of scanning the directory.
+    Retention only removes originals whose posts are published everywhere,
+    oldest first, once they are older than `max_age_days` or the originals
+    take more than `max_bytes`; the variants stay and are served instead.
+
+    Args:
+        pool (ConnectionPool): Pool used for the files index.
+        backend (LocalBackend): Where the files are kept.
+        max_bytes (int): Size budget for originals (None for no limit).
+        max_age_days (float): Published originals older than this are removed (None to keep).
+    """
+
+    def __init__(self, pool, backend, max_bytes=None, max_age_days=None):
+        self.pool = pool
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+    @property
+    def directory(self):
+        return self.backend.directory
+
+    def prepare(self):
+        """
+        Creates the local directory; called on startup rather than on import.
+        """
+        self.backend.prepare()
+
+    def add(self, name, path=None, kind='original', original=None, content_hash=None):
+        """
+        Stores a file written to `path` (default: its local path) and indexes it.
+        """
+        size = self.backend.store(name, path or self.backend.local_path(name))
+        self._index(name, size, kind, original, content_hash)
+
+    def _index(self, name, size, kind='original', original=None, content_hash=None):
+        with self.pool.cursor() as cur:
+            cur.execute("""
+            INSERT INTO files (name, kind, original, size, content_hash, backend) VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (name) DO UPDATE SET size = EXCLUDED.size, backend = EXCLUDED.backend,
+                content_hash = COALESCE(EXCLUDED.content_hash, files.content_hash), deleted_at = NULL
+            """, (name, kind, original, size, content_hash, self.backend.name))
+
+    def add_variants(self, image_name, variants):
+        """
+        Indexes the variants returned by `preprocess_image`.
+        """
+        for path in set(variants.values()):
+            name = os.path.basename(path)
+            if name != image_name:
+                self.add(name, path, kind='variant', original=image_name)
+
+    def path(self, name):
+        """
+        Local path of a stored file, or None if it does not exist (anymore).
+        """
+        return self.backend.fetch(name)
+
+    def variant(self, image_name, variant):
+        """
+        Local path of a variant of an original, rendering and storing it if it is
+        missing. Falls back to another variant when the original was removed.
+
+        Returns:
+            str: The path, or None if neither the variant nor a fallback exists.
+        """
+        name = variant_name(image_name, variant)
+        path = self.path(name)
+        if path is not None:
+            return path
+
+        if self.path(image_name) is not None:
+            path = ensure_variant(self.directory, image_name, variant)
+            if os.path.basename(path) == name:
+                self.add(name, path, kind='variant', original=image_name)
+            return path
+
+        for fallback in FALLBACK_VARIANTS:
+            path = self.path(variant_name(image_name, fallback))
+            if path is not None:
+                return path
+        return None
+
+    def usage(self):
+        """
+        Bytes stored per kind of file.
+        """
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT kind, COALESCE(SUM(size), 0) FROM files WHERE deleted_at IS NULL GROUP BY kind")
+            return dict(cur.fetchall())
+
+    def reindex(self):
+        """
+        Indexes files that are stored but not in the index yet, e.g. the
+        downloads of an installation that predates the index. Only the index
+        is written; the files stay where they are (nothing is uploaded again).
+
+        Returns:
+            int: Number of newly indexed files.
+        """
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT name FROM files")
+            known = {row[0] for row in cur.fetchall()}
+
+        added = 0
+        for name, size in self.backend.listing().items():
+            if name in known:
+                continue
+            stem, ext = os.path.splitext(name)
+            base, _, variant = stem.rpartition('.')
+            if base and (variant in VARIANTS or variant.startswith('thumb')):
+                self._index(name, size, kind='variant', original=f'{base}{ext}')
+            else:
+                self._index(name, size)
+            added += 1
+
+        if added:
+            Logger.info(f'Indexed {added} stored files')
+        return added
+
+    def _expired_originals(self):
+        # Originals of posts published on every platform; files without a post are left alone
+        with self.pool.cursor(dict_rows=True) as cur:
+            cur.execute("""
+            SELECT f.name, f.size,
+                   COALESCE(f.created_at < NOW() - %s::float * INTERVAL '1 day', false) AS expired
+            FROM files f
+            WHERE f.kind = 'original' AND f.deleted_at IS NULL
+              AND EXISTS (SELECT 1 FROM posts p WHERE p.image_name = f.name)
+              AND NOT EXISTS (SELECT 1 FROM posts p WHERE p.image_name = f.name
+                                                      AND (NOT p.posted_on_fb OR NOT p.posted_on_ig))
+            ORDER BY f.created_at
+            """, (self.max_age_days, ))
+            candidates = cur.fetchall()
+            cur.execute("SELECT COALESCE(SUM(size), 0) AS total FROM files WHERE kind = 'original' AND deleted_at IS NULL")
+            total = cur.fetchone()['total']
+        return candidates, total
+
+    def enforce_retention(self):
+        """
+        Removes published originals that are past the age limit, then the oldest
+        published ones until the originals fit into the size budget.
+
+        Returns:
+            tuple: (number of removed files, bytes freed)
+        """
+        if self.max_bytes is None and self.max_age_days is None:
+            return 0, 0
+
+        candidates, total = self._expired_originals()
+        removed = []
+        freed = 0
+        for candidate in candidates:
+            over_budget = self.max_bytes is not None and total - freed > self.max_bytes
+            if not candidate['expired'] and not over_budget:
+                continue
+
+            # Keep the original if no variant is left to serve in its place
+            if not any(self.path(variant_name(candidate['name'], v)) for v in FALLBACK_VARIANTS):
+                continue
+
+            self.backend.delete(candidate['name'])
+            removed.append(candidate['name'])
+            freed += candidate['size']
+
+        if removed:
+            with self.pool.cursor() as cur:
+                cur.execute("UPDATE files SET deleted_at = NOW() WHERE name = ANY(%s)", (removed, ))
+            Logger.info(f'Storage retention removed {len(removed)} originals ({freed / (1 << 20):.1f} MiB)')
+
+        if self.max_bytes is not None and total - freed > self.max_bytes:
+            Logger.warning(f'Originals take {(total - freed) / (1 << 20):.1f} MiB, over the budget of '
+                           f'{self.max_bytes / (1 << 20):.1f} MiB, but nothing else is published yet')
+        return len(removed), freed
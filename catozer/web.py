@@ -0,0 +1,445 @@
+import gzip
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+
+import requests
+import flask
+from flask import Flask, render_template, request, jsonify
+import waitress
+
+from catozer.images import file_etag
+from catozer.main import (
+    CATOZER_DEBUG,
+    CONFIG,
+    IG_CLIENT_ID,
+    IG_CLIENT_SECRET,
+    POST_STATUS_FILTERS,
+    Clients,
+    ImageStore,
+    Jobs,
+    Metrics,
+    Profiler,
+    db_config_fields,
+    decode_posts_cursor,
+    default_config,
+    get_post,
+    get_posts_page,
+    get_unpublished_post_ids,
+    update_config_field,
+    update_config_fields,
+)
+
+Logger = logging.getLogger(__name__)
+
+# #(Server)
+ServerApp = Flask(__name__, static_url_path='', static_folder='../web/static', template_folder='../web/templates')
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "1313"))
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "8"))
+
+# How TLS is terminated in production:
+#   cert  - the app terminates TLS itself with cert.pem/key.pem, as it always did (waitress can
+#           not, so a threaded Werkzeug server is used); the default
+#   proxy - opt-in: waitress serves plain HTTP behind a TLS terminating reverse proxy
+#           (X-Forwarded-* is trusted)
+#   off   - plain HTTP without a proxy
+SERVER_TLS = os.getenv("SERVER_TLS", "cert")
+SERVER_TRUSTED_PROXY = os.getenv("SERVER_TRUSTED_PROXY", "127.0.0.1")
+
+# Responses smaller than this are not worth compressing
+GZIP_MIN_SIZE = 500
+GZIP_MIMETYPES = {'text/html', 'application/json', 'text/css', 'application/javascript'}
+
+WebServer = None
+
+RequestLatency = Metrics.histogram('catozer_http_request_seconds', 'Duration of dashboard requests',
+                                   ('route', 'method', 'status'))
+
+# Longest profile /metrics/profile records in one run
+PROFILE_MAX_SECONDS = 60
+
+@ServerApp.before_request
+def start_request_timer():
+    flask.g.request_started = time.perf_counter()
+
+# Registered before gzip_response, so it runs after it and the compression is included
+@ServerApp.after_request
+def observe_request(response):
+    started = flask.g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        RequestLatency.observe(time.perf_counter() - started, route=route, method=request.method,
+                               status=str(response.status_code))
+    return response
+
+@ServerApp.after_request
+def gzip_response(response):
+    if (response.direct_passthrough
+            or response.status_code != 200
+            or response.mimetype not in GZIP_MIMETYPES
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Length'] = str(len(response.get_data()))
+    response.vary.add('Accept-Encoding')
+    return response
+
+def run_server():
+    global WebServer
+
+    # Templates are only re-read from disk while developing
+    ServerApp.config['TEMPLATES_AUTO_RELOAD'] = CATOZER_DEBUG
+
+    if CATOZER_DEBUG:
+        ServerApp.run(ssl_context=('cert.pem', 'key.pem'), host=SERVER_HOST, port=SERVER_PORT)
+        return
+
+    if SERVER_TLS == 'cert':
+        ServerApp.run(ssl_context=('cert.pem', 'key.pem'), host=SERVER_HOST, port=SERVER_PORT,
+                      threaded=True, use_reloader=False)
+        return
+
+    options = {}
+    if SERVER_TLS == 'proxy':
+        options = {
+            'trusted_proxy': SERVER_TRUSTED_PROXY,
+            'trusted_proxy_headers': 'x-forwarded-proto x-forwarded-host x-forwarded-for',
+            'clear_untrusted_proxy_headers': True,
+        }
+
+    Logger.info(f'Starting waitress on {SERVER_HOST}:{SERVER_PORT} with {SERVER_THREADS} threads')
+    WebServer = waitress.create_server(ServerApp, host=SERVER_HOST, port=SERVER_PORT,
+                                       threads=SERVER_THREADS, ident='catozer', **options)
+    try:
+        WebServer.run()
+    except OSError:
+        # Raised by the closed listening socket on shutdown
+        pass
+
+class WebService:
+    """
+    Runs the dashboard server on a background thread; stopped by `shutdown()` in main.
+    """
+
+    def start(self):
+        threading.Thread(target=run_server, name='catozer-web', daemon=True).start()
+
+    def stop(self):
+        if WebServer is not None:
+            WebServer.close()
+
+# Widths served by /images?w=...; other requested widths are rounded up to one of these
+IMAGE_WIDTHS = (160, 320, 640, 1080)
+
+# Image names are Telegram file ids, so a URL always refers to the same content
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+def thumbnail_url(image_name, width=640):
+    return f'/images/{urllib.parse.quote(image_name)}?w={width}'
+
+@ServerApp.context_processor
+def image_helpers():
+    return {'thumbnail_url': thumbnail_url}
+
+DASHBOARD_PAGE_SIZE = 30
+MAX_PAGE_SIZE = 200
+
+def posts_page_args():
+    """
+    Reads the pagination and filter query parameters shared by / and /api/posts.
+    """
+    def parse_date(name):
+        value = request.args.get(name)
+        return datetime.fromisoformat(value) if value else None
+
+    status = request.args.get('status') or None
+    if status not in (None, *POST_STATUS_FILTERS.keys()):
+        raise ValueError(f'Unknown status: {status}')
+
+    end = parse_date('to')
+    if end is not None and len(request.args.get('to')) <= 10:
+        # A plain date includes the whole day
+        end += timedelta(days=1)
+
+    cursor = request.args.get('cursor') or None
+    if cursor is not None:
+        try:
+            decode_posts_cursor(cursor)
+        except Exception:
+            raise ValueError('Invalid cursor')
+
+    try:
+        limit = int(request.args.get('limit', DASHBOARD_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('Invalid limit')
+
+    return {
+        'cursor': cursor,
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+        'start': parse_date('from'),
+        'end': end,
+        'status': status,
+    }
+
+def post_json(post):
+    return {
+        'id': post['id'],
+        'caption': post['caption'],
+        'text': post['text'],
+        'schedule_time': post['schedule_time'].isoformat(),
+        'day': post['schedule_time'].strftime("%d-%m-%Y"),
+        'image_name': post['image_name'],
+        'thumbnail': thumbnail_url(post['image_name']),
+        'posted_on_fb': post['posted_on_fb'],
+        'posted_on_ig': post['posted_on_ig'],
+    }
+
+@ServerApp.route("/")
+def index():
+    try:
+        args = posts_page_args()
+    except ValueError as e:
+        return str(e), 400
+
+    posts, next_cursor = get_posts_page(**args)
+    days = {}
+    for post in posts:
+        day = post['schedule_time'].strftime("%d-%m-%Y")
+        if day not in days.keys():
+            days[day] = {}
+            days[day]['posts'] = []
+        days[day]['posts'].append(post)
+
+    return render_template('index.html', days=days, next_cursor=next_cursor, filters=request.args)
+
+@ServerApp.route("/api/posts")
+def api_posts():
+    try:
+        args = posts_page_args()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    posts, next_cursor = get_posts_page(**args)
+    return jsonify({'posts': [post_json(post) for post in posts], 'next_cursor': next_cursor})
+
+@ServerApp.route("/config")
+def config():
+    db_config = db_config_fields()
+
+    Imgur = Clients.get('imgur_app')
+    imgur_link = Imgur.get_auth_url('pin')
+
+    return render_template('config.html', tokens=db_config,
+                           messages=[],
+                           imgur_link=imgur_link,
+                           config_version=CONFIG.version)
+
+@ServerApp.route("/api/ig_token")
+def api_ig_token():
+    app_id = "1038808407801073"
+    redirect = "https://localhost:1313/api/ig_token/callback"
+    perms = "instagram_business_basic,instagram_business_manage_messages,instagram_business_manage_comments,instagram_business_content_publish"
+    params = {
+        'client_id': app_id,
+        'redirect_uri': redirect,
+        'scope': perms,
+        'response_type': 'code',
+    }
+
+    auth_link = "https://www.instagram.com/oauth/authorize"
+    url = f"{auth_link}?client_id={app_id}&redirect_uri={redirect}&response_type=code&scope={perms}&code=1234"
+    url = f"{auth_link}?{urllib.parse.urlencode(params)}"
+
+    return flask.redirect(url, code=302)
+
+@ServerApp.route("/api/ig_token/callback")
+def api_ig_token_callback():
+    code = request.args.get('code')
+
+    redirect = "https://localhost:1313/api/ig_token/callback"
+    payload = {
+        'client_id': IG_CLIENT_ID,
+        'client_secret': IG_CLIENT_SECRET,
+        'grant_type': 'authorization_code',
+        'redirect_uri': redirect,
+        'code': code,
+    }
+    response = requests.post('https://api.instagram.com/oauth/access_token', data=payload)
+    response = response.json()
+    short_access_token = response['access_token']
+
+    redirect = "https://localhost:1313/api/ig_token/callback"
+    payload = {
+        'client_secret': IG_CLIENT_SECRET,
+        'grant_type': 'ig_exchange_token',
+        'access_token' : short_access_token
+    }
+
+    auth_link = 'https://graph.instagram.com/access_token'
+    url = f"{auth_link}?{urllib.parse.urlencode(payload)}"
+    response = requests.get(url)
+    response = response.json()
+    short_access_token = response['access_token']
+
+    update_config_field('IG_TOKEN', short_access_token)
+
+    return flask.redirect("/config", code=302)
+
+@ServerApp.route("/api/imgur_pin", methods=['POST'])
+def api_imgur_pin():
+    pin = request.form.get('pin')
+    Logger.info('Authorizing Imgur with a PIN')
+
+    Imgur = Clients.get('imgur_app')
+
+    credentials = Imgur.authorize(pin, 'pin')
+    update_config_fields({'IMGUR_ACCESS_TOKEN': credentials['access_token'],
+                          'IMGUR_REFRESH_TOKEN': credentials['refresh_token']})
+    Logger.info(f"Imgur authorized for account {credentials.get('account_username')}")
+
+    return flask.redirect("/config", code=302)
+
+def config_value(value):
+    # Unset values are rendered as empty fields, so an empty field stays unset (NULL)
+    value = (value or '').strip()
+    return value or None
+
+@ServerApp.route("/api/set_config", methods=['POST'])
+def api_set_config_batch():
+    # All fields of the config page are saved together in one transaction; only known
+    # keys are written, and CONFIG.update skips the ones that did not change
+    known = default_config()
+    changes = {key: config_value(value) for key, value in request.form.items() if key in known}
+    update_config_fields(changes)
+
+    return flask.redirect("/config", code=302)
+
+@ServerApp.route("/api/set_config/<key>", methods=['POST'])
+def api_set_config(key):
+    if key not in default_config():
+        flask.abort(404)
+    update_config_field(key, config_value(request.form.get('value')))
+
+    return flask.redirect("/config", code=302)
+
+def job_json(job):
+    data = {
+        'id': job['id'],
+        'kind': job['kind'],
+        'post_id': job['post_id'],
+        'status': job['status'],
+        'error': job['error'],
+        'merged': job.get('merged', False),
+    }
+    if job['status'] == 'done':
+        post = get_post(job['post_id'])
+        if post is not None:
+            data['post'] = {'caption': post['caption'], 'text': post['text']}
+    return data
+
+def parse_post_ids(values):
+    """
+    Post ids from a request: ints or strings of digits.
+
+    Raises:
+        ValueError: `values` is not a list of post ids.
+    """
+    if not isinstance(values, (list, tuple)):
+        raise ValueError('post_ids must be a list of post ids')
+    post_ids = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).strip().isdigit():
+            raise ValueError(f'Invalid post id: {value!r}')
+        post_ids.append(int(value))
+    return post_ids
+
+@ServerApp.route("/api/regen/<int:post_id>", methods=['GET', 'POST'])
+def api_regen_post(post_id):
+    job = Jobs.enqueue('regen', post_id)
+
+    if request.method == 'POST' or request.accept_mimetypes.best == 'application/json':
+        return jsonify(job_json(job)), 202
+    return flask.redirect("/", code=302)
+
+@ServerApp.route("/api/regen", methods=['POST'])
+def api_regen_bulk():
+    data = request.get_json(silent=True) or request.form
+
+    if data.get('all') in (True, '1', 'true'):
+        post_ids = get_unpublished_post_ids()
+    else:
+        post_ids = data.get('post_ids') or []
+        if isinstance(post_ids, str):
+            post_ids = post_ids.split(',')
+        try:
+            post_ids = parse_post_ids(post_ids)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    jobs = Jobs.enqueue_many('regen', post_ids) if post_ids else []
+    return jsonify({'jobs': [job_json(job) for job in jobs]}), 202
+
+@ServerApp.route("/api/jobs/<int:job_id>")
+def api_job(job_id):
+    job = Jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'not found'}), 404
+    return jsonify(job_json(job))
+
+@ServerApp.route("/metrics")
+def metrics():
+    return Metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@ServerApp.route("/metrics/profile", methods=['GET', 'POST'])
+def metrics_profile():
+    """
+    POST ?seconds=N (default 10) samples all threads for N seconds in the background,
+    so no server thread waits for it. GET returns the collapsed stacks of the last run,
+    e.g. for flamegraph.pl, or 202 while it still runs. If the profiler runs since
+    startup (CATOZER_PROFILER=1), GET returns the stacks recorded so far.
+    """
+    headers = {'Content-Type': 'text/plain; charset=utf-8'}
+    if request.method == 'POST':
+        if Profiler.running:
+            return 'The profiler is already running\n', 409, headers
+        seconds = min(request.args.get('seconds', 10, type=float), PROFILE_MAX_SECONDS)
+        Profiler.start(seconds=seconds)
+        return f'Sampling for {seconds:g}s, GET /metrics/profile afterwards\n', 202, headers
+
+    remaining = Profiler.remaining
+    if remaining is not None:
+        return f'Still sampling, {remaining:.0f}s left\n', 202, headers
+    return Profiler.collapsed(), 200, headers
+
+@ServerApp.route("/images/<path:filename>")
+def images(filename):
+    width = request.args.get('w', type=int)
+    try:
+        if width:
+            # Thumbnails are generated on first request and stored next to the original
+            width = next((w for w in IMAGE_WIDTHS if w >= width), IMAGE_WIDTHS[-1])
+            path = ImageStore.variant(filename, f'thumb{width}')
+        else:
+            # Originals removed by the retention are served as their publish variant
+            path = ImageStore.path(filename) or ImageStore.variant(filename, 'publish')
+    except ValueError:
+        flask.abort(404)
+    if path is None:
+        flask.abort(404)
+
+    response = flask.send_file(path, etag=file_etag(path), conditional=True, max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
@@ -3,6 +3,6 @@ from setuptools import setup, find_packages
 setup(
     name='catozer',
     version='0.0.1',
-    packages=find_packages(),
+    packages=find_packages(exclude=['bench', 'bench.*', 'tests', 'tests.*']),
     install_requires=[],
 )
@@ -0,0 +1,51 @@
+import json
+import logging
+
+import pytest
+
+from catozer.logs import JsonFormatter, LogContext, LogPipeline, log_context, parse_levels
+
+
+def test_parse_levels():
+    levels = parse_levels(' catozer.api=debug, telegram = WARNING;httpx=ERROR ')
+
+    assert levels == {'catozer.api': 'DEBUG', 'telegram': 'WARNING', 'httpx': 'ERROR'}
+
+
+@pytest.mark.parametrize('spec', [None, '', ' , ;'])
+def test_parse_levels_of_nothing(spec):
+    assert parse_levels(spec) == {}
+
+
+@pytest.mark.parametrize('spec', ['catozer.api', 'a=b=DEBUG', 'catozer.api=LOUD'])
+def test_parse_levels_rejects_invalid_entries(spec):
+    with pytest.raises(ValueError):
+        parse_levels(spec)
+
+
+def test_set_levels_restores_previous_levels():
+    logger = logging.getLogger('catozer.tests.levels')
+    logger.setLevel(logging.ERROR)
+    pipeline = LogPipeline()
+
+    pipeline.set_levels({'catozer.tests.levels': 'DEBUG'})
+    assert logger.level == logging.DEBUG
+    assert pipeline.levels() == {'catozer.tests.levels': 'DEBUG'}
+
+    pipeline.set_levels({})
+    assert logger.level == logging.ERROR
+    assert pipeline.levels() == {}
+
+
+def test_json_lines_carry_the_log_context():
+    record = logging.LogRecord('catozer.main', logging.INFO, __file__, 1, 'Posted %s', ('post', ), None)
+    with log_context(post_id=7, platform='ig'):
+        record.context = LogContext.get()
+
+    entry = json.loads(JsonFormatter().format(record))
+
+    assert entry['msg'] == 'Posted post'
+    assert entry['level'] == 'INFO'
+    assert entry['post_id'] == 7
+    assert entry['platform'] == 'ig'
+    assert LogContext.get() == {}
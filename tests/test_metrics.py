@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from catozer.metrics import MetricsRegistry, timed
+
+
+def test_render_counter_and_gauge():
+    metrics = MetricsRegistry()
+    sent = metrics.counter('catozer_sent_total', 'Messages sent', ('platform', ))
+    metrics.gauge('catozer_queued', 'Queued posts', fn=lambda: 3)
+    sent.inc(platform='fb')
+    sent.inc(2, platform='fb')
+    sent.inc(platform='ig')
+
+    assert metrics.render() == (
+        '# HELP catozer_sent_total Messages sent\n'
+        '# TYPE catozer_sent_total counter\n'
+        'catozer_sent_total{platform="fb"} 3\n'
+        'catozer_sent_total{platform="ig"} 1\n'
+        '# HELP catozer_queued Queued posts\n'
+        '# TYPE catozer_queued gauge\n'
+        'catozer_queued 3\n'
+    )
+
+
+def test_render_histogram_buckets_are_cumulative():
+    metrics = MetricsRegistry()
+    latency = metrics.histogram('catozer_seconds', 'Latency', ('fn', ), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        latency.observe(value, fn='load')
+
+    lines = metrics.render().splitlines()
+
+    assert lines[2:] == [
+        'catozer_seconds_bucket{fn="load",le="0.1"} 1',
+        'catozer_seconds_bucket{fn="load",le="1"} 3',
+        'catozer_seconds_bucket{fn="load",le="+Inf"} 4',
+        'catozer_seconds_sum{fn="load"} 6.05',
+        'catozer_seconds_count{fn="load"} 4',
+    ]
+
+
+def test_render_escapes_label_values():
+    metrics = MetricsRegistry()
+    metrics.gauge('catozer_info', 'Info', ('name', )).set(1, name='a "b"\\c\n')
+
+    assert 'catozer_info{name="a \\"b\\"\\\\c\\n"} 1' in metrics.render()
+
+
+def test_failing_gauge_is_left_out():
+    metrics = MetricsRegistry()
+    metrics.gauge('catozer_broken', 'Broken', fn=lambda: 1 / 0)
+
+    assert metrics.render().splitlines() == ['# HELP catozer_broken Broken', '# TYPE catozer_broken gauge']
+
+
+def test_collectors_run_once_per_render():
+    metrics = MetricsRegistry()
+    queued = metrics.gauge('catozer_queued', 'Queued posts')
+    backlog = metrics.gauge('catozer_backlog', 'Backlog')
+    calls = []
+
+    @metrics.collector
+    def collect():
+        calls.append(1)
+        queued.set(3)
+        backlog.set(2)
+
+    rendered = metrics.render()
+
+    assert calls == [1]
+    assert 'catozer_queued 3' in rendered
+    assert 'catozer_backlog 2' in rendered
+
+
+def test_labels_have_to_match():
+    counter = MetricsRegistry().counter('catozer_total', 'Total', ('platform', ))
+
+    with pytest.raises(ValueError):
+        counter.inc(kind='fb')
+
+
+def test_timed_labels_calls_with_the_function_name():
+    metrics = MetricsRegistry()
+    latency = metrics.histogram('catozer_db_seconds', 'DB', ('fn', ))
+
+    @timed(latency)
+    def load_posts():
+        return 'posts'
+
+    @timed(latency)
+    async def load_chatters():
+        return 'chatters'
+
+    assert load_posts() == 'posts'
+    assert asyncio.run(load_chatters()) == 'chatters'
+
+    rendered = metrics.render()
+    assert 'catozer_db_seconds_count{fn="load_posts"} 1' in rendered
+    assert 'catozer_db_seconds_count{fn="load_chatters"} 1' in rendered
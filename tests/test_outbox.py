@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+
+from catozer.outbox import Outbox
+
+NOW = datetime(2026, 1, 5, 12, 0, tzinfo=timezone.utc)
+
+
+def make_outbox():
+    return Outbox(pool=None, sender=None, coalesce_seconds=600)
+
+
+def row(message, minutes_ago=0, kind='ig_failure', label='Instagram failures'):
+    return {'kind': kind, 'label': label, 'message': message, 'created_at': NOW - timedelta(minutes=minutes_ago)}
+
+
+def test_digest_of_one_alert_is_the_alert():
+    assert make_outbox()._digest([row('⛔ Could not post')]) == '⛔ Could not post'
+
+
+def test_digest_counts_alerts_and_quotes_the_latest():
+    rows = [row('first', 3), row('second', 2), row('third', 1)]
+
+    assert make_outbox()._digest(rows) == '⛔ 3 Instagram failures in the last 10 min. Latest: third'
+
+
+def test_digest_spans_more_than_one_window_and_falls_back_to_kind():
+    rows = [row('first', 45, label=None), row('second', 0, label=None)]
+
+    assert make_outbox()._digest(rows) == "⛔ 2 'ig_failure' alerts in the last 45 min. Latest: second"
+
+
+def test_due_when_nothing_was_sent_yet():
+    assert make_outbox()._is_due([row('a')], None, NOW)
+
+
+def test_due_when_last_delivery_is_a_window_ago():
+    assert make_outbox()._is_due([row('a')], NOW - timedelta(minutes=10), NOW)
+
+
+def test_held_back_within_the_window():
+    assert not make_outbox()._is_due([row('a', 1)], NOW - timedelta(minutes=2), NOW)
+
+
+def test_not_held_back_longer_than_one_window():
+    rows = [row('a', 10), row('b', 0)]
+
+    assert make_outbox()._is_due(rows, NOW - timedelta(minutes=1), NOW)
+
+
+def test_retention_is_at_least_one_window():
+    assert Outbox(None, None, coalesce_seconds=3600, retention_seconds=60).retention_seconds == 3600
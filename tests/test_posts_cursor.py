@@ -0,0 +1,25 @@
+from datetime import datetime
+
+import pytest
+
+from catozer.main import decode_posts_cursor, encode_posts_cursor
+
+
+def test_cursor_round_trip():
+    post = {'id': 42, 'schedule_time': datetime(2026, 1, 5, 10, 30)}
+
+    assert decode_posts_cursor(encode_posts_cursor(post)) == (datetime(2026, 1, 5, 10, 30), 42)
+
+
+def test_cursor_is_url_safe():
+    post = {'id': 1, 'schedule_time': datetime(2026, 12, 31, 23, 59, 59, 999999)}
+
+    cursor = encode_posts_cursor(post)
+
+    assert all(c.isalnum() or c in '-_=' for c in cursor)
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor', 'bm8gc2VwYXJhdG9y', 'eHx5'])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_posts_cursor(cursor)
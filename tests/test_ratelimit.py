@@ -0,0 +1,99 @@
+import pytest
+
+from catozer import ratelimit
+from catozer.ratelimit import RateLimited, RateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, 'time', clock)
+    return clock
+
+
+def test_bucket_starts_full_and_empties(clock):
+    bucket = TokenBucket(3, rate=1)
+
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait_time() == pytest.approx(1)
+
+
+def test_bucket_refills_at_rate_up_to_capacity(clock):
+    bucket = TokenBucket(2, rate=0.5, tokens=0)
+
+    clock.now += 2
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+    clock.now += 1000
+    assert bucket.wait_time() == 0
+    assert bucket.tokens == 2
+
+
+def test_bucket_tokens_are_capped_on_load(clock):
+    assert TokenBucket(5, rate=1, tokens=50).tokens == 5
+
+
+def test_bucket_pause_blocks_until_it_ends(clock):
+    bucket = TokenBucket(10, rate=1)
+    bucket.pause(60)
+    bucket.pause(30)
+
+    assert bucket.wait_time() == pytest.approx(60)
+    assert not bucket.try_acquire()
+
+    clock.now += 60
+    assert bucket.try_acquire()
+
+
+def test_bucket_drain_and_release(clock):
+    bucket = TokenBucket(10, rate=1)
+
+    bucket.drain(0.5)
+    assert bucket.tokens == pytest.approx(5)
+
+    bucket.release(100)
+    assert bucket.tokens == 10
+
+
+def test_limiter_raises_when_no_token_in_time(clock):
+    limiter = RateLimiter(None, {'gemini': (1, 60)})
+
+    limiter.acquire('gemini')
+    with pytest.raises(RateLimited) as e:
+        limiter.acquire('gemini', timeout=10)
+
+    assert e.value.platform == 'gemini'
+    assert e.value.retry_in == pytest.approx(60)
+
+    limiter.release('gemini')
+    limiter.acquire('gemini')
+
+
+def test_parse_limits_overrides_and_ignores_invalid_values():
+    limits = RateLimiter.parse_limits({'RATE_LIMIT_INSTAGRAM': '25/86400', 'RATE_LIMIT_IMGUR': 'lots'})
+
+    assert limits['instagram'] == (25, 86400)
+    assert limits['imgur'] == ratelimit.DEFAULT_LIMITS['imgur']
+
+
+def test_limiter_takes_all_tokens_of_an_operation_at_once(clock):
+    limiter = RateLimiter(None, {'facebook': (3, 60)})
+
+    limiter.acquire('facebook', n=2)
+    with pytest.raises(RateLimited):
+        limiter.acquire('facebook', n=2)
+
+    limiter.release('facebook', n=2)
+    limiter.acquire('facebook', n=3)
@@ -0,0 +1,87 @@
+from datetime import datetime, time
+
+import pytest
+
+from catozer.slots import SlotAllocator, parse_slot_times
+
+EVERY_DAY_AT_10 = {day: [time(10)] for day in range(7)}
+
+# A Monday
+MONDAY_9AM = datetime(2026, 1, 5, 9, 0)
+
+
+def test_parse_slot_times_default_and_per_day():
+    times = parse_slot_times('18,10;sat=11,15:30;sun=')
+
+    assert times[0] == [time(10), time(18)]
+    assert times[4] == [time(10), time(18)]
+    assert times[5] == [time(11), time(15, 30)]
+    assert times[6] == []
+
+
+def test_parse_slot_times_accepts_full_weekday_names_and_blanks():
+    times = parse_slot_times(' 9 ; Monday = 8:15 ;;')
+
+    assert times[0] == [time(8, 15)]
+    assert times[1] == [time(9)]
+
+
+def test_parse_slot_times_rejects_unknown_weekday():
+    with pytest.raises(ValueError):
+        parse_slot_times('10;xyz=11')
+
+
+def test_allocator_needs_a_posting_time():
+    with pytest.raises(ValueError):
+        SlotAllocator({day: [] for day in range(7)}, load_taken=list)
+
+
+def test_reserve_returns_next_free_slot_in_order():
+    slots = SlotAllocator(EVERY_DAY_AT_10, load_taken=list)
+
+    assert slots.reserve(MONDAY_9AM) == datetime(2026, 1, 5, 10, 0)
+    assert slots.reserve(MONDAY_9AM) == datetime(2026, 1, 6, 10, 0)
+
+
+def test_reserve_skips_past_and_taken_slots():
+    taken = [datetime(2026, 1, 6, 10, 0, 42)]
+    slots = SlotAllocator(EVERY_DAY_AT_10, load_taken=lambda: taken)
+
+    now = datetime(2026, 1, 5, 11, 0)
+    assert slots.reserve(now) == datetime(2026, 1, 7, 10, 0)
+
+
+def test_reserve_many_beyond_the_horizon():
+    slots = SlotAllocator(EVERY_DAY_AT_10, load_taken=list, horizon_days=2)
+
+    reserved = slots.reserve_many(5, MONDAY_9AM)
+
+    assert reserved == [datetime(2026, 1, 5 + i, 10, 0) for i in range(5)]
+
+
+def test_peek_does_not_reserve():
+    slots = SlotAllocator(EVERY_DAY_AT_10, load_taken=list)
+
+    assert slots.peek(MONDAY_9AM) == datetime(2026, 1, 5, 10, 0)
+    assert slots.reserve(MONDAY_9AM) == datetime(2026, 1, 5, 10, 0)
+
+
+def test_release_makes_slot_available_again():
+    slots = SlotAllocator(EVERY_DAY_AT_10, load_taken=list)
+    first, second = slots.reserve_many(2, MONDAY_9AM)
+
+    slots.release(first)
+
+    assert slots.reserve(MONDAY_9AM) == first
+    assert slots.reserve(MONDAY_9AM) == datetime(2026, 1, 7, 10, 0)
+
+
+def test_invalidate_reloads_taken_slots():
+    taken = []
+    slots = SlotAllocator(EVERY_DAY_AT_10, load_taken=lambda: taken)
+    assert slots.peek(MONDAY_9AM) == datetime(2026, 1, 5, 10, 0)
+
+    taken.append(datetime(2026, 1, 5, 10, 0))
+    slots.invalidate()
+
+    assert slots.reserve(MONDAY_9AM) == datetime(2026, 1, 6, 10, 0)